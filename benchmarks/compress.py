@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of writing .nii.gz, dipy's save_nifti (one thread of zlib) against
+save_nifti of fun/pgzip.py (blocks compressed on several threads) on a
+synthetic subject (benchmarks/phantom.py). For each thread count and level
+reports the MB/s of image data, the size of the file and checks that nibabel
+reads back the same array.
+
+From the root of the repository:
+    python -m benchmarks.compress
+    python -m benchmarks.compress -t 1 4 8 16 -l 1 6 --shape 110 110 70 -o compress.json
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import nibabel as nib
+from dipy.io.image import load_nifti, save_nifti
+
+from benchmarks.phantom import mk_subject, SHAPE
+from benchmarks.harness import Bench
+from fun.pgzip import save_nifti as psave_nifti
+
+args = argparse.ArgumentParser(description='Benchmark the parallel gzip writer against save_nifti of dipy')
+args.add_argument('-s', '--shape', type=int, nargs=3, default=list(SHAPE), help='Volume size of the phantom')
+args.add_argument('-t', '--threads', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()], help='Thread counts of the parallel writer')
+args.add_argument('-l', '--levels', type=int, nargs='+', default=[1, 6], help='gzip levels')
+args.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs of each writer')
+args.add_argument('-o', '--output', type=str, default=None, help='Save the results as json')
+args = args.parse_args()
+
+output = None if args.output is None else os.path.abspath(args.output)
+b = Bench(args.repeat, trace=False)
+
+with tempfile.TemporaryDirectory(prefix='dwiprep_gz_') as wd:
+
+    paths = mk_subject(os.path.join(wd, 'datain'), os.path.join(wd, 'dataout'), 'sub-10000', tuple(args.shape))
+    data, affine = load_nifti(paths['AP_gib_mppca'])
+    data = np.asarray(data, dtype='float32')
+    mb = data.nbytes / 1024**2
+    print(f'{data.shape} float32, {mb:0.0f} MB, {os.cpu_count()} cores\n')
+    b.header()
+
+    sizes = {}
+    out = os.path.join(wd, 'out.nii.gz')
+    for level in args.levels:
+        name = f'dipy save_nifti level {level}'
+        # nibabel compresses with its default level, set it for the run
+        default = nib.openers.Opener.default_compresslevel
+        nib.openers.Opener.default_compresslevel = level
+        b.run(name, lambda: save_nifti(out, data, affine), mb, 'MB')
+        nib.openers.Opener.default_compresslevel = default
+        sizes[name] = os.path.getsize(out)
+
+        for t in sorted(set(args.threads)):
+            name = f'pgzip level {level} threads {t}'
+            b.run(name, lambda: psave_nifti(out, data, affine, level=level, threads=t), mb, 'MB')
+            sizes[name] = os.path.getsize(out)
+            if not np.array_equal(nib.load(out).get_fdata(dtype='float32'), data):
+                exit(f'{name}: the image read back differs from the one written')
+
+print(f'\n{"":<40} {"MB":>10} {"ratio":>10} {"speedup":>10}')
+base = {}
+for r in b.results:
+    level = r['name'].split('level ')[1].split(' ')[0]
+    if r['name'].startswith('dipy'):
+        base[level] = r['median s']
+    r['file MB'] = sizes[r['name']] / 1024**2
+    r['ratio'] = mb / r['file MB']
+    r['speedup'] = base[level] / r['median s']
+    print(f'{r["name"]:<40} {r["file MB"]:>10.1f} {r["ratio"]:>10.2f} {r["speedup"]:>10.2f}')
+
+if output is not None:
+    b.save(output, shape=args.shape, cores=os.cpu_count(), levels=args.levels, threads=args.threads)
+    print(f'Saved to {output}')
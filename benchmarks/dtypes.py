@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the data type policy of fun/dtypes.py on a synthetic subject
+(benchmarks/phantom.py), the working set of patch2self() in float64 and in
+float32, and the types the denoised image can be saved as:
+    - load_nifti of raw and gibbs AP/PA in the compute type
+    - estimate_sigma of gibbs AP, patch2self of gibbs AP
+    - MB held by the 6 images of patch2self (raw, gibbs and denoised AP/PA)
+    - save of the denoised AP in each storage type, size of the file and the
+      error of the image read back
+and the differences of the sigmas and of the denoised image of float32 against
+float64, in units of the noise.
+
+From the root of the repository:
+    python -m benchmarks.dtypes
+    python -m benchmarks.dtypes --shape 100 100 64 -r 1 -o dtypes.json
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import nibabel as nib
+from dipy.io.image import load_nifti
+from dipy.denoise.noise_estimate import estimate_sigma
+from dipy.denoise.patch2self import patch2self
+
+from benchmarks.phantom import mk_subject
+from benchmarks.harness import Bench
+from fun.dtypes import compute, storage
+from fun.pgzip import save_nifti
+
+args = argparse.ArgumentParser(description='Benchmark float32 against float64 images and the storage types')
+args.add_argument('-s', '--shape', type=int, nargs=3, default=[64, 64, 40], help='Volume size of the phantom, patch2self is slow on the full size')
+args.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs of each function')
+args.add_argument('--no-trace', action='store_true', help='Do not measure the peak memory (tracemalloc doubles the run time)')
+args.add_argument('-o', '--output', type=str, default=None, help='Save the results as json')
+args = args.parse_args()
+
+output = None if args.output is None else os.path.abspath(args.output)
+b = Bench(args.repeat, trace=not args.no_trace)
+
+with tempfile.TemporaryDirectory(prefix='dwiprep_dtypes_') as wd:
+
+    paths = mk_subject(os.path.join(wd, 'datain'), os.path.join(wd, 'dataout'), 'sub-10000', tuple(args.shape))
+    bval = np.loadtxt(paths['bval'])
+    n = nib.load(paths['AP']).shape[3]
+    print(f'{tuple(args.shape)} x {n} volumes, {os.cpu_count()} cores\n')
+    b.header()
+
+    held = {}
+    sigma = {}
+    den = {}
+    for c in ['float64', 'float32']:
+        def load():
+            return {k: compute(np.asarray(load_nifti(paths[k])[0], dtype='float64'), c) \
+                for k in ['AP', 'PA', 'AP_gib', 'PA_gib']}
+        # float64 is what get_fdata gave, the raw data is taken as float as well
+        imgs = b.run(f'load raw and gibbs {c}', load, 4, 'imgs')
+        sigma[c] = b.run(f'estimate_sigma gibbs {c}', lambda: estimate_sigma(imgs['AP_gib'], N=32), n, 'vols')
+        den[c] = b.run(f'patch2self gibbs {c}', lambda: patch2self(imgs['AP_gib'], bval, model='ols', \
+            shift_intensity=True, clip_negative_vals=False, b0_threshold=50, out_dtype=c, verbose=False), n, 'vols')
+        # denoised PA is of the size of the PA gibbs
+        held[c] = (sum([a.nbytes for a in imgs.values()]) + den[c].nbytes + imgs['PA_gib'].nbytes) / 1024**2
+
+    noise = float(np.median(sigma['float64']))
+    sizes = {}
+    errors = {}
+    out = os.path.join(wd, 'p2s.nii.gz')
+    for s in [None, 'float32', 'int16']:
+        name = f'save p2s as {s or "float64"}'
+        data, dtype = storage(den['float64'], None, s)
+        b.run(name, lambda: save_nifti(out, data, np.eye(4), dtype=dtype), n, 'vols')
+        sizes[name] = os.path.getsize(out) / 1024**2
+        errors[name] = float(np.abs(nib.load(out).get_fdata() - den['float64']).max()) / noise
+
+print(f'\nMB held by the images of patch2self: float64 {held["float64"]:0.0f}, float32 {held["float32"]:0.0f}')
+print(f'\nfloat32 against float64, noise sigma {noise:0.2f}')
+ds = np.abs(sigma['float32'].astype('float64') - sigma['float64']) / sigma['float64']
+dp = np.abs(den['float32'].astype('float64') - den['float64']) / noise
+print(f'{"sigma, relative":<40} {ds.max():>12.2e} max {ds.mean():>12.2e} mean')
+print(f'{"patch2self, in sigmas":<40} {dp.max():>12.2e} max {dp.mean():>12.2e} mean')
+print(f'\n{"":<40} {"file MB":>10} {"max error in sigmas":>20}')
+for k in sizes:
+    print(f'{k:<40} {sizes[k]:>10.1f} {errors[k]:>20.2e}')
+
+if output is not None:
+    b.save(output, shape=args.shape, cores=os.cpu_count(), held_mb=held, file_mb=sizes, \
+        errors_sigmas=errors, sigma_rel_max=float(ds.max()), p2s_sigmas_max=float(dp.max()))
+    print(f'Saved to {output}')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+class Bench():
+
+    # Times python functions of the pipeline, wall time, throughput and peak memory
+    # Each function is run `repeat` times, the median time is reported, the peak
+    # memory is taken from one more run traced with tracemalloc (numpy arrays are
+    # traced too), the resident set size of the process is reported alongside
+    #
+    # b = Bench(repeat=3)
+    # b.run('estimate_sigma raw', lambda: estimate_sigma(img), n=img.shape[3], unit='vols')
+    # b.report()
+    # b.save('bench.json')
+
+    def __init__(self, repeat=3, trace=True):
+
+        import gc
+        import json
+        import resource
+        import tracemalloc
+        from time import perf_counter
+        from statistics import median
+
+        self.gc = gc
+        self.json = json
+        self.resource = resource
+        self.tracemalloc = tracemalloc
+        self.perf_counter = perf_counter
+        self.median = median
+
+        self.repeat = max(1, int(repeat))
+        self.trace = trace # tracemalloc slows the function down, its run is not timed
+        self.results = []
+
+    def run(self, name, func, n=1, unit='calls'):
+        # Run func repeat times, n: number of items processed by one call (vols, subjects...)
+        # Returns the result of the last call
+        times = []
+        for r in range(self.repeat):
+            self.gc.collect()
+            t0 = self.perf_counter()
+            out = func()
+            times.append(self.perf_counter() - t0)
+
+        peak = None
+        if self.trace:
+            self.gc.collect()
+            self.tracemalloc.start()
+            func()
+            peak = self.tracemalloc.get_traced_memory()[1] / 1024**2
+            self.tracemalloc.stop()
+
+        t = self.median(times)
+        self.results.append({'name': name, 'repeat': self.repeat, 'median s': t, 'min s': min(times), \
+            'n': n, 'unit': unit, 'per s': n / t if t > 0 else float('inf'), 'peak MB': peak, \
+            'maxrss MB': self.resource.getrusage(self.resource.RUSAGE_SELF).ru_maxrss / 1024})
+        print(self.line(self.results[-1]))
+        return out
+
+    def line(self, r):
+        peak = '' if r['peak MB'] is None else f'{r["peak MB"]:0.1f}'
+        return f'{r["name"][:40]:<40} {r["median s"]:>10.3f} {r["min s"]:>10.3f} {r["per s"]:>10.2f} {r["unit"]:<8} {peak:>10} {r["maxrss MB"]:>10.1f}'
+
+    def header(self):
+        print(f'{"":<40} {"median s":>10} {"min s":>10} {"per s":>10} {"":<8} {"peak MB":>10} {"maxrss MB":>10}')
+
+    def report(self):
+        self.header()
+        for r in self.results:
+            print(self.line(r))
+
+    def save(self, path, **meta):
+        # results and anything that describes the run, e.g. shape of the phantom
+        with open(path, 'w') as f:
+            self.json.dump({'meta': meta, 'results': self.results}, f, indent=2)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of the python hot paths of DwiPreprocessingClab
+Runs on synthetic subjects (benchmarks/phantom.py) in a temporary directory,
+no FSL, MRtrix3, container, network or NAS is needed. Times the real methods:
+    - load_nifti of raw (.nii) and processed (.nii.gz) data
+    - estimate_sigma of raw, gibbs and denoised data, and the three at once with
+      fun/sigma.py, as in mppca and patch2self, and over the brain only
+    - b0 extraction, acqparams and eddy index, as in topup and eddy
+    - gif_dwi_4d and plt_compare_4d, as in the gibbs QA
+    - QA figures of every volume, as in mppca and patch2self
+    - QaHtml main and subject pages
+and reports the median time, throughput and peak memory of each.
+
+From the root of the repository:
+    python -m benchmarks.hotpaths
+    python -m benchmarks.hotpaths --shape 64 64 40 --qa-vols 4 -r 1 -o bench.json
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+# run from anywhere, main.py and fun/ are in the root of the repository
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # no display on the servers
+
+from benchmarks.phantom import mk_subject, SHAPE
+from benchmarks.harness import Bench
+from fun.masks import brain_mask
+
+args = argparse.ArgumentParser(description='Benchmark the python hot paths on synthetic subjects')
+args.add_argument('-s', '--shape', type=int, nargs=3, default=list(SHAPE), help='Volume size of the phantom, at least 56 in each dimension for the QA plots')
+args.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs of each function')
+args.add_argument('--qa-vols', type=int, default=10, help='Volumes plotted by the QA benchmarks, all volumes of a subject take ~10x longer')
+args.add_argument('--subs', type=int, default=1000, help='Subjects listed by the QaHtml benchmark')
+args.add_argument('--no-trace', action='store_true', help='Skip the tracemalloc run of each function')
+args.add_argument('-o', '--output', type=str, default=None, help='Save the results as json')
+args = args.parse_args()
+
+shape = tuple(args.shape)
+if min(shape) < 56 and args.qa_vols > 0:
+    # gif_dwi_4d plots slice 55 and plt_p2s_vols slice 42
+    exit('The QA plots need at least 56 voxels in each dimension')
+output = None if args.output is None else os.path.abspath(args.output)
+
+b = Bench(args.repeat, not args.no_trace)
+
+with tempfile.TemporaryDirectory(prefix='dwiprep_bench_') as wd:
+
+    # the pipeline works in ./tmp and ./logs, keep them in the temporary directory
+    os.chdir(wd)
+    sub = 'sub-10000'
+    print(f'Writing a phantom of {shape} to {wd}')
+    paths = mk_subject(os.path.join(wd, 'datain'), os.path.join(wd, 'dataout'), sub, shape)
+
+    from main import DwiPreprocessingClab
+    from dipy.denoise.noise_estimate import estimate_sigma
+    from dipy.core.gradients import gradient_table
+    from fun.qahtml import QaHtml
+
+    dwi = DwiPreprocessingClab(task='benchmark', mode='a', datain=os.path.join(wd, 'datain'), \
+        dataout=os.path.join(wd, 'dataout'), telegram=False, log=False, check_container=False)
+
+    # tmp dir of the subject as left by the earlier stages
+    tmp = os.path.join('tmp', sub)
+    for d in ['imgs', os.path.join('imgs', 'gibbs'), os.path.join('imgs', 'mrtrix3_mppca'), \
+        os.path.join('imgs', 'patch2self'), 'gif']:
+        os.makedirs(os.path.join(tmp, d), exist_ok=True)
+    for p in paths.values():
+        dwi.copyfile(p, os.path.join(tmp, os.path.basename(p)))
+    for d in ['AP', 'PA']:
+        dwi.copyfile(os.path.join(wd, 'dataout', sub, f'{sub}_{d}.json'), os.path.join(tmp, f'{sub}_{d}.json'))
+
+    ap = {k: os.path.join(tmp, os.path.basename(paths[f'AP{k}'])) for k in ['', '_gib', '_gib_mppca']}
+    pa = {k: os.path.join(tmp, os.path.basename(paths[f'PA{k}'])) for k in ['', '_gib', '_gib_mppca']}
+    bval = np.loadtxt(os.path.join(tmp, f'{sub}_AP.bval'))
+    bvec = np.loadtxt(os.path.join(tmp, f'{sub}_AP.bvec'))
+    nv = len(bval)
+    print(f'{sub}: AP {nv} vols, PA 5 vols\n')
+    b.header()
+
+    # loading
+    raw = b.run('load_nifti raw .nii', lambda: dwi.load_nifti(ap[''])[0], nv, 'vols')
+    gib = b.run('load_nifti gib .nii.gz', lambda: dwi.load_nifti(ap['_gib'])[0], nv, 'vols')
+    mpp = b.run('load_nifti mppca .nii.gz', lambda: dwi.load_nifti(ap['_gib_mppca'])[0], nv, 'vols')
+
+    # noise
+    sraw = b.run('estimate_sigma raw', lambda: estimate_sigma(raw, N=dwi.n_coils), nv, 'vols')
+    sgib = b.run('estimate_sigma gib', lambda: estimate_sigma(gib, N=dwi.n_coils), nv, 'vols')
+    smpp = b.run('estimate_sigma mppca', lambda: estimate_sigma(mpp, N=dwi.n_coils), nv, 'vols')
+    # the three at once, as mppca and patch2self estimate them, see fun/sigma.py
+    sall = b.run('estimate_sigmas raw gib mppca', lambda: dwi.estimate_sigmas([raw, gib, mpp]), 3 * nv, 'vols')
+    if not all([np.array_equal(x, y) for x, y in zip(sall, [sraw, sgib, smpp])]):
+        print('estimate_sigmas: the sigmas differ from estimate_sigma')
+    # over the brain only, the box around it is read, see fun/masks.py
+    brain = brain_mask(raw, gradient_table(bval, bvecs=bvec).b0s_mask)
+    b.run('estimate_sigmas raw gib mppca brain', lambda: dwi.estimate_sigmas([raw, gib, mpp], mask=brain), 3 * nv, 'vols')
+
+    # topup and eddy inputs
+    gtab = gradient_table(bval, bvecs=bvec)
+    b0s = lambda: dwi.mk_b0s(ap['_gib_mppca'], pa['_gib_mppca'], os.path.join(tmp, f'{sub}_AP_gib_mppca_b0s.nii.gz'), \
+        os.path.join(tmp, f'{sub}_PA_gib_mppca_b0s.nii.gz'), gtab.b0s_mask)
+    n_ap, n_pa = b.run('mk_b0s', b0s, 1, 'subs')
+    b.run('mk_acqparams', lambda: dwi.mk_acqparams(sub, os.path.join(tmp, 'acqparams.txt'), n_ap, n_pa), 1, 'subs')
+    b.run('mk_index', lambda: dwi.mk_index(ap['_gib_mppca'], os.path.join(tmp, f'{sub}_index.txt')), 1, 'subs')
+
+    if args.qa_vols > 0:
+        # QA, on the first volumes only, the time grows with the number of volumes
+        k = min(args.qa_vols, nv)
+        vols = list(range(k))
+        cut = os.path.join(tmp, f'{sub}_AP_cut.nii.gz')
+        dwi.save_nifti(cut, raw[..., :k], np.diag([2., 2., 2., 1.]))
+        gif = os.path.join(tmp, 'gif', f'{sub}_AP_raw.gif')
+        b.run('gif_dwi_4d', lambda: dwi.gif_dwi_4d(sub, cut, gif, f'{sub} ap raw'), k, 'vols')
+        out = os.path.join(tmp, 'imgs', 'gibbs', f'{sub}_AP_compare_raw_gibbs')
+        b.run('plt_compare_4d', lambda: dwi.plt_compare_4d(ap[''], ap['_gib'], out, sub, vols), k, 'vols')
+
+        resi = gib[..., :k] - mpp[..., :k]
+        b.run('plt_mppca_vols', lambda: dwi.plt_mppca_vols(sub, 'AP', bval[:k], raw[..., :k], gib[..., :k], \
+            mpp[..., :k], resi, sraw, sgib, smpp), k, 'vols')
+        b.run('plt_p2s_vols', lambda: dwi.plt_p2s_vols(sub, 'AP', bval[:k], raw[..., :k], gib[..., :k], \
+            mpp[..., :k], sraw, sgib, smpp), k, 'vols')
+
+    # QA html
+    subs = [f'sub-{10000+i}' for i in range(args.subs)]
+    qa = QaHtml(os.path.join(wd, 'qa'), subs, 'DWI Preprocessing')
+    b.run('QaHtml create_main_page', qa.create_main_page, len(subs), 'subs')
+    b.run('QaHtml create_sub_page', lambda: [qa.create_sub_page(s) for s in subs], len(subs), 'subs')
+
+    os.chdir(root)
+
+print()
+b.report()
+if output is not None:
+    b.save(output, shape=shape, vols=nv, qa_vols=args.qa_vols, subs=args.subs, repeat=args.repeat)
+    print(f'Saved to {output}')
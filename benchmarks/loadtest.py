@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Load test of the schedulers of DwiPreprocessingClab with the fake backend
+A cohort of synthetic subjects (benchmarks/phantom.py, raw data hard linked) is
+processed by run_parallel(), run_mixed(), run_queue() or the loop of the stage
+itself (--mode loop, where --prefetch copies the inputs ahead) with the stand-ins of
+fun/faketools.py in place of FSL and MRtrix3, so the cost of the scheduling,
+copying, python steps and QA around the tools is measured before the settings
+of a production run are changed. Reports the throughput, the failed subjects and
+the time of each step from the timing spans.
+
+From the root of the repository:
+    python -m benchmarks.loadtest -n 1000 -j 16 --stage pipeline
+    python -m benchmarks.loadtest -n 20 -j 4 --stage gibbs --scale 0.1 --mode queue
+    python -m benchmarks.loadtest -n 20 --stage mppca --mode loop --prefetch 2
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+from glob import glob
+from time import perf_counter
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import matplotlib
+matplotlib.use('Agg')
+
+from benchmarks.phantom import mk_cohort
+
+args = argparse.ArgumentParser(description='Load test the schedulers with fake tools and synthetic subjects')
+args.add_argument('-n', '--subjects', type=int, default=1000, help='Number of synthetic subjects')
+args.add_argument('-j', '--jobs', type=int, default=4, help='Subjects at a time (parallel and queue)')
+args.add_argument('-t', '--threads', type=int, default=-1, help='Threads of the run, all cores if -1')
+args.add_argument('--stage', type=str, default='pipeline', choices=['gibbs', 'mppca', 'patch2self', 'topup', 'pipeline'], help='Stage to run')
+args.add_argument('--mode', type=str, default='parallel', choices=['parallel', 'mixed', 'queue', 'loop'], help='run_parallel, run_mixed, run_queue or the loop of the stage')
+args.add_argument('--working-format', type=str, default='nii.gz', choices=['nii.gz', 'nii'], help='Images in tmp, nii for uncompressed')
+args.add_argument('--array-cache', type=float, default=0, help='GB of images of a subject kept in memory')
+args.add_argument('--compute-dtype', type=str, default=None, choices=['float32', 'float64'], help='Float images loaded as, as on disk if not given')
+args.add_argument('--storage-dtype', type=str, default=None, choices=['float32', 'int16'], help='Float images saved as, as computed if not given')
+args.add_argument('--catalog', action='store_true', help='Find the subjects and raw files through the sqlite catalog')
+args.add_argument('--stat-cache', action='store_true', help='Reuse the noise sigmas and b0 masks of the images seen before (kept in the workdir)')
+args.add_argument('--stat-mask', type=str, default=None, choices=['brain', 'background'], help='Noise sigmas over the brain or the background, whole field of view if not given')
+args.add_argument('--p2s-slab-mb', type=int, default=None, help='patch2self over slabs of this many MB, dipy on the whole image if not given')
+args.add_argument('--p2s-threads', type=int, default=None, help='BLAS threads of patch2self, all if not given')
+args.add_argument('--p2s-sample', type=float, default=None, help='patch2self regressions trained on this fraction (<= 1) or number of brain voxels, all if not given')
+args.add_argument('--p2s-sample-mode', type=str, default='random', choices=['random', 'stratified'], help='How the brain voxels of --p2s-sample are drawn')
+args.add_argument('--p2s-check', type=int, default=0, help='First subjects held out to compare the sampled patch2self with the fit on all the voxels')
+args.add_argument('--prefetch', type=int, default=0, help='Subjects ahead whose inputs are prefetched (loop)')
+args.add_argument('--shape', type=int, nargs=3, default=[56, 56, 56], help='Volume size of the phantom, at least 56 for the QA plots')
+args.add_argument('--dwis', type=int, default=6, help='Diffusion weighted volumes of the phantom besides 10 b0s')
+args.add_argument('--profile', type=str, default=None, help='json with sleep, cpu and fail of the tools, see fun/faketools.py')
+args.add_argument('--scale', type=float, default=1.0, help='Factor for the times of the tools')
+args.add_argument('--workdir', type=str, default=None, help='Keep the data, logs and spans here instead of a temporary directory')
+args.add_argument('-o', '--output', type=str, default=None, help='Save the results as json')
+args = args.parse_args()
+
+output = None if args.output is None else os.path.abspath(args.output)
+profile = None if args.profile is None else os.path.abspath(args.profile)
+
+with tempfile.TemporaryDirectory(prefix='dwiprep_load_') as wd:
+
+    if args.workdir is not None:
+        wd = os.path.abspath(args.workdir)
+        os.makedirs(wd, exist_ok=True)
+    os.chdir(wd)
+    datain, dataout = os.path.join(wd, 'datain'), os.path.join(wd, 'dataout')
+
+    # gibbs and pipeline start from the raw data, the other stages from the outputs of the previous ones
+    t0 = perf_counter()
+    subs = mk_cohort(datain, None if args.stage in ['gibbs', 'pipeline'] else dataout, args.subjects, \
+        tuple(args.shape), shells={1000: args.dwis})
+    if args.stage in ['gibbs', 'pipeline']:
+        for sub in subs:
+            os.makedirs(os.path.join(dataout, sub), exist_ok=True)
+    print(f'{len(subs)} subjects written to {wd} in {perf_counter()-t0:0.1f} s')
+
+    from main import DwiPreprocessingClab
+    from fun.spans import summarise
+
+    dwi = DwiPreprocessingClab(task='loadtest', mode='a', datain=datain, dataout=dataout, threads=args.threads, \
+        telegram=False, log=True, check_container=False, backend='fake', fake_profile=profile, fake_scale=args.scale, \
+        prefetch=args.prefetch, working_format=args.working_format, \
+        array_cache=args.array_cache, compute_dtype=args.compute_dtype, storage_dtype=args.storage_dtype, \
+        catalog=os.path.join(wd, 'catalog.sqlite') if args.catalog else None, \
+        stat_cache=os.path.join(wd, 'stats') if args.stat_cache else None, stat_mask=args.stat_mask, \
+        p2s_slab_mb=args.p2s_slab_mb, p2s_threads=args.p2s_threads, p2s_sample=args.p2s_sample, \
+        p2s_sample_mode=args.p2s_sample_mode, p2s_check=subs[:args.p2s_check])
+
+    t0 = perf_counter()
+    if args.mode == 'parallel':
+        results = dwi.run_parallel(args.stage, args.jobs, skip_processed=False)
+    elif args.mode == 'mixed':
+        results = dwi.run_mixed([args.stage], skip_processed=False)
+    elif args.mode == 'queue':
+        results = dwi.run_queue(args.stage, os.path.join(wd, 'queue'), jobs=args.jobs, skip_processed=False)
+    else:
+        getattr(dwi, args.stage)(skip_processed=False)
+        last = 'eddy' if args.stage == 'pipeline' else args.stage
+        results = [{'sub': sub, 'status': len(dwi.stage_outputs(sub, last)) > 0} for sub in subs]
+    wall = perf_counter() - t0
+    if args.p2s_sample is not None and args.p2s_check > 0 and args.stage == 'patch2self':
+        print(dwi.p2s_sample_report()[1])
+    dwi.log_close()
+
+    rows = summarise(glob(os.path.join('logs', '*_spans.jsonl')))
+    os.chdir(root)
+
+failed = [r['sub'] for r in results if not r['status']]
+tools = sum([r['total'] for r in rows if r['kind'] == 'cmd'])
+subjects = sum([r['total'] for r in rows if r['kind'] == 'subject'])
+
+print(f'\n{args.stage} with {args.mode} scheduling, {len(subs)} subjects, {args.jobs} jobs')
+print(f'wall time {wall/60:0.1f} min, {len(subs)/wall*3600:0.0f} subjects/h, {len(failed)} failed')
+if subjects > 0:
+    print(f'time in the subjects {subjects/3600:0.2f} h, of which {tools/subjects*100:0.0f}% in the (fake) tools')
+print(f'\n{"kind":<8} {"path":<40} {"n":>6} {"failed":>6} {"median s":>10} {"p95 s":>10} {"total h":>8}')
+for r in rows:
+    if r['kind'] in ['stage', 'subject', 'step', 'cmd', 'io']:
+        print(f'{r["kind"]:<8} {r["path"][-40:]:<40} {r["n"]:>6} {r["failed"]:>6} {r["median"]:>10.2f} {r["p95"]:>10.2f} {r["total"]/3600:>8.3f}')
+
+if output is not None:
+    with open(output, 'w') as f:
+        json.dump({'meta': vars(args), 'wall': wall, 'subjects': len(subs), 'failed': failed, 'spans': rows}, f, indent=2)
+    print(f'Saved to {output}')
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of patch2self over slabs (fun/p2s.py) against dipy's patch2self on
+the gibbs AP of a synthetic subject (benchmarks/phantom.py), as patch2self()
+calls them. Each run is a process of its own, its peak resident memory (memory
+mapped temporary files of dipy included) is taken from /proc (Linux) after the
+image is loaded. With --sample the regressions of the slabs of the first size
+are also trained on that fraction of the brain voxels (median_otsu of the mean
+b0, made before the timer starts). Reports for each:
+    - seconds, volumes/s and subjects/h (AP only) at the given BLAS threads
+    - peak GB of the process and GB over the loaded image
+    - subjects/h per GB of peak memory, how many subjects a node can take
+    - mean and max difference to dipy's image, in units of the noise sigma
+    - mean difference to the slabs fitted on all the voxels, over the brain
+
+From the root of the repository:
+    python -m benchmarks.p2s_slabs
+    python -m benchmarks.p2s_slabs --slab-mb 32 128 512 -t 1 4 -o p2s_slabs.json
+    python -m benchmarks.p2s_slabs --sample 0.1 0.01 --sample-mode random stratified
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess as sp
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+
+args = argparse.ArgumentParser(description='Benchmark patch2self over slabs against dipy, time and memory')
+args.add_argument('-s', '--shape', type=int, nargs=3, default=[100, 100, 64], help='Volume size of the phantom')
+args.add_argument('--slab-mb', type=int, nargs='+', default=[32, 256], help='Slab sizes of fun/p2s.py')
+args.add_argument('--sample', type=float, nargs='*', default=[], help='Fractions (<= 1) or numbers of brain voxels the regressions are trained on')
+args.add_argument('--sample-mode', type=str, nargs='+', default=['random'], choices=['random', 'stratified'], help='How the voxels of --sample are drawn')
+args.add_argument('-t', '--threads', type=int, nargs='+', default=[1], help='BLAS threads of each run')
+args.add_argument('--compute-dtype', type=str, default='float32', choices=['float32', 'float64'], help='Type the image is loaded as')
+args.add_argument('-o', '--output', type=str, default=None, help='Save the results as json')
+args.add_argument('--worker', type=str, nargs=5, default=None, help=argparse.SUPPRESS) # image bval mode threads out
+args = args.parse_args()
+
+
+def hwm(reset=False):
+    # Peak resident GB of this process (VmHWM), reset to the current size first
+    # if asked, so that the peak of loading the image is not counted
+    if reset:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM'):
+                return int(line.split()[1]) / 1024**2
+
+
+def worker(img, bval, mode, threads, out):
+    # One run in this process, prints json with the time and the peak memory
+    import gc
+    from time import perf_counter
+    from threadpoolctl import threadpool_limits
+    from dipy.io.image import load_nifti
+    from dipy.denoise.patch2self import patch2self
+    from fun.p2s import patch2self_slabs
+    from fun.dtypes import compute
+    from fun.masks import brain_mask
+
+    data = compute(load_nifti(img)[0], args.compute_dtype)
+    bvals = np.loadtxt(bval)
+    threads = int(threads)
+    # slabs MB[:sample:sample mode]
+    mode = mode.split(':')
+    brain = brain_mask(data, bvals <= 50) if len(mode) > 1 else None
+    gc.collect()
+    base = hwm(reset=True)
+    t0 = perf_counter()
+    if mode[0] == 'dipy':
+        with threadpool_limits(limits=threads, user_api='blas'):
+            den = patch2self(data, bvals, model='ols', shift_intensity=True, clip_negative_vals=False, \
+                b0_threshold=50, verbose=False)
+    else:
+        den = patch2self_slabs(data, bvals, b0_threshold=50, slab_mb=int(mode[0]), threads=threads, \
+            mask=brain, sample=float(mode[1]) if len(mode) > 1 else None, sample_mode=mode[-1])
+    t = perf_counter() - t0
+    peak = hwm()
+    np.save(out, den)
+    print(json.dumps({'s': t, 'peak GB': peak, 'loaded GB': base, 'image GB': data.nbytes / 1024**3}))
+
+
+if args.worker is not None:
+    worker(*args.worker)
+    exit(0)
+
+output = None if args.output is None else os.path.abspath(args.output)
+
+from benchmarks.phantom import mk_subject
+from dipy.io.image import load_nifti
+from fun.sigma import estimate_sigmas
+from fun.masks import brain_mask
+
+with tempfile.TemporaryDirectory(prefix='dwiprep_p2s_') as wd:
+
+    paths = mk_subject(os.path.join(wd, 'datain'), os.path.join(wd, 'dataout'), 'sub-10000', tuple(args.shape))
+    nv = len(np.loadtxt(paths['bval']))
+    noise = float(np.median(estimate_sigmas([load_nifti(paths['AP_gib'])[0]], N=32)[0]))
+    brain = brain_mask(load_nifti(paths['AP_gib'])[0], np.loadtxt(paths['bval']) <= 50)
+    sampled = [f'{args.slab_mb[0]}:{s:g}:{m}' for s in args.sample for m in args.sample_mode]
+    print(f'{tuple(args.shape)} x {nv} volumes, {os.cpu_count()} cores, {args.compute_dtype}\n')
+
+    results = []
+    ref = None
+    full = None
+    print(f'{"":<32} {"threads":>8} {"s":>8} {"vols/s":>8} {"subs/h":>8} {"peak GB":>8} {"over GB":>8} {"subs/h/GB":>10} {"mean sd":>8} {"max sd":>8} {"full sd":>8}')
+    for t in args.threads:
+        for mode in ['dipy'] + [str(m) for m in args.slab_mb] + sampled:
+            out = os.path.join(wd, f'{mode.replace(":", "_")}_{t}.npy')
+            r = sp.run([sys.executable, '-m', 'benchmarks.p2s_slabs', '--compute-dtype', args.compute_dtype, \
+                '--worker', paths['AP_gib'], paths['bval'], mode, str(t), out], cwd=root, capture_output=True, text=True)
+            if r.returncode != 0:
+                print(f'{mode} failed:\n{r.stderr[-2000:]}')
+                continue
+            res = json.loads(r.stdout.strip().splitlines()[-1])
+            den = np.load(out)
+            if mode == 'dipy':
+                ref = den.astype('float64')
+            if mode == str(args.slab_mb[0]):
+                full = den.astype('float64')
+            diff = np.abs(den.astype('float64') - ref) / noise if ref is not None else np.zeros(1)
+            fdiff = np.abs(den.astype('float64') - full)[brain].mean() / noise if full is not None else float('nan')
+            os.remove(out)
+            m = mode.split(':')
+            name = 'dipy' if mode == 'dipy' else f'slabs {m[0]} MB' + (f' {m[1]} {m[2]}' if len(m) > 1 else '')
+            res.update({'mode': name, 'threads': t, 'vols/s': nv / res['s'], \
+                'subs/h': 3600 / res['s'], 'over GB': res['peak GB'] - res['loaded GB'], \
+                'mean sd': float(diff.mean()), 'max sd': float(diff.max()), 'full sd': float(fdiff)})
+            res['subs/h/GB'] = res['subs/h'] / res['peak GB']
+            results.append(res)
+            print(f'{res["mode"]:<32} {t:>8} {res["s"]:>8.2f} {res["vols/s"]:>8.1f} {res["subs/h"]:>8.0f} {res["peak GB"]:>8.2f} ' + \
+                f'{res["over GB"]:>8.2f} {res["subs/h/GB"]:>10.0f} {res["mean sd"]:>8.3f} {res["max sd"]:>8.3f} {res["full sd"]:>8.3f}')
+
+print('\nsd: difference to dipy in units of the noise sigma of the image; full sd: mean difference to the slabs of ' + \
+    'the first size fitted on all the voxels, over the brain; over GB: peak above the loaded image')
+
+if output is not None:
+    with open(output, 'w') as f:
+        json.dump({'meta': vars(args), 'cores': os.cpu_count(), 'results': results}, f, indent=2)
+    print(f'Saved to {output}')
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Synthetic DWI subjects for benchmarking, no scanner data, FSL or MRtrix3 needed
+# A head-sized ellipsoid of white matter, grey matter and csf shells with a single
+# fibre direction in white matter, signal from the diffusion tensor of each tissue
+# and Rician noise. Written in the layout the pipeline expects:
+#   datain/sub-xxxxx/dwi/  raw AP (nii, json, bval, bvec) and PA (nii, json)
+#   dataout/sub-xxxxx/     _AP.nii, _PA.nii, jsons, bval, bvec and the outputs of
+#                          gibbs and mppca (_AP_gib.nii.gz, _AP_gib_mppca.nii.gz, ...)
+
+import os
+import json
+import numpy as np
+import nibabel as nib
+
+# Realistic size of a subject of the study, 2 mm iso, 10 b0s and two shells
+SHAPE = (100, 100, 64)
+N_B0 = 10
+SHELLS = {1000: 32, 2000: 64}
+PA_VOLS = 5 # 4 b0s and one b1000, as expected by topup()
+TRT = 0.0507 # TotalReadoutTime
+
+# Tissues, S0 and diffusivities (mm2/s) along and across the fibre
+TISSUES = {
+    'wm': {'s0': 800., 'dpar': 1.7e-3, 'dperp': 0.3e-3},
+    'gm': {'s0': 1000., 'dpar': 0.8e-3, 'dperp': 0.8e-3},
+    'csf': {'s0': 2000., 'dpar': 3.0e-3, 'dperp': 3.0e-3},
+}
+
+
+def gradients(n_b0=N_B0, shells=SHELLS):
+
+    # bvals and unit bvecs (3 x n), directions spread on the sphere
+    # b0s at the start, as in the acquisition
+
+    bvals = [0] * n_b0
+    for b, n in shells.items():
+        bvals += [b] * n
+    bvals = np.array(bvals, dtype=float)
+
+    n = int((bvals > 0).sum())
+    i = np.arange(n) + 0.5
+    phi = np.arccos(1 - 2 * i / n)
+    theta = np.pi * (1 + 5**0.5) * i
+    dirs = np.stack([np.cos(theta) * np.sin(phi), np.sin(theta) * np.sin(phi), np.cos(phi)])
+
+    bvecs = np.zeros((3, len(bvals)))
+    bvecs[:, bvals > 0] = dirs
+    return bvals, bvecs
+
+
+def tissues(shape=SHAPE):
+
+    # Masks of the tissues, nested ellipsoids: wm inside gm inside csf
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing='ij')
+    r = np.sqrt((x / 0.8)**2 + (y / 0.9)**2 + (z / 0.85)**2)
+    return {'wm': r < 0.6, 'gm': (r >= 0.6) & (r < 0.85), 'csf': (r >= 0.85) & (r < 0.95)}
+
+
+def signal(shape, bvals, bvecs, fibre=(1., 0., 0.)):
+
+    # Noise free signal, float32 (x, y, z, vols)
+    masks = tissues(shape)
+    out = np.zeros(shape + (len(bvals),), dtype=np.float32)
+    cos2 = (np.array(fibre) @ bvecs)**2 # angle between gradient and fibre
+    for t, m in masks.items():
+        p = TISSUES[t]
+        att = np.exp(-bvals * (p['dperp'] + (p['dpar'] - p['dperp']) * cos2))
+        out[m] = (p['s0'] * att).astype(np.float32)
+    return out
+
+
+def rician(data, sigma, rng):
+    # magnitude of the signal with complex gaussian noise
+    n1 = rng.normal(0, sigma, data.shape).astype(np.float32)
+    n2 = rng.normal(0, sigma, data.shape).astype(np.float32)
+    return np.sqrt((data + n1)**2 + n2**2)
+
+
+def mk_subject(datain, dataout, sub, shape=SHAPE, n_b0=N_B0, shells=SHELLS, sigma=20., seed=0):
+
+    # Writes one synthetic subject, returns dict of the paths written to dataout
+    # raw: int16 nii as from the scanner; gib and mppca: float32 nii.gz as saved by the pipeline
+    # dataout None writes the raw data only, enough for gibbs and pipeline
+
+    rng = np.random.default_rng(seed)
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = -np.array(shape) # centre the volume
+
+    bvals, bvecs = gradients(n_b0, shells)
+    clean = {'AP': signal(shape, bvals, bvecs)}
+    clean['PA'] = clean['AP'][..., list(range(4)) + [n_b0]] # 4 b0s and the first b1000
+
+    raw_dir = os.path.join(datain, sub, 'dwi')
+    os.makedirs(raw_dir, exist_ok=True)
+    np.savetxt(os.path.join(raw_dir, f'{sub}_ep2d_diff_AP_dwi.bval'), bvals[None], fmt='%d')
+    np.savetxt(os.path.join(raw_dir, f'{sub}_ep2d_diff_AP_dwi.bvec'), bvecs, fmt='%.6f')
+
+    paths = {}
+    for d in ['AP', 'PA']:
+        raw = rician(clean[d], sigma, rng)
+        raw16 = np.clip(np.round(raw), 0, 32767).astype(np.int16)
+        gib = raw.copy()
+        gib[1:-1] = (raw[:-2] + 2 * raw[1:-1] + raw[2:]) / 4 # mild smoothing in place of unringing
+        mppca = rician(clean[d], sigma / 4, rng)
+
+        side = {'TotalReadoutTime': TRT, 'PhaseEncodingDirection': 'j-' if d == 'AP' else 'j', \
+            'EchoTime': 0.089, 'RepetitionTime': 3.5}
+
+        # raw data in datain, as from the scanner export
+        raw_base = os.path.join(raw_dir, f'{sub}_ep2d_diff_{d}_dwi')
+        nib.save(nib.Nifti1Image(raw16, affine), raw_base + '.nii')
+        with open(raw_base + '.json', 'w') as f:
+            json.dump(side, f)
+
+        if dataout is None:
+            continue
+
+        # copies made by gibbs and the outputs of gibbs and mppca in dataout
+        out_dir = os.path.join(dataout, sub)
+        os.makedirs(out_dir, exist_ok=True)
+        nib.save(nib.Nifti1Image(raw16, affine), os.path.join(out_dir, f'{sub}_{d}.nii'))
+        with open(os.path.join(out_dir, f'{sub}_{d}.json'), 'w') as f:
+            json.dump(side, f)
+        nib.save(nib.Nifti1Image(gib, affine), os.path.join(out_dir, f'{sub}_{d}_gib.nii.gz'))
+        nib.save(nib.Nifti1Image(mppca, affine), os.path.join(out_dir, f'{sub}_{d}_gib_mppca.nii.gz'))
+        for k in ['', '_gib', '_gib_mppca']:
+            paths[f'{d}{k}'] = os.path.join(out_dir, f'{sub}_{d}{k}' + ('.nii' if k == '' else '.nii.gz'))
+
+    if dataout is None:
+        return paths
+    np.savetxt(os.path.join(out_dir, f'{sub}_AP.bval'), bvals[None], fmt='%d')
+    np.savetxt(os.path.join(out_dir, f'{sub}_AP.bvec'), bvecs, fmt='%.6f')
+    paths['bval'] = os.path.join(out_dir, f'{sub}_AP.bval')
+    paths['bvec'] = os.path.join(out_dir, f'{sub}_AP.bvec')
+    return paths
+
+
+def mk_cohort(datain, dataout, n, shape=SHAPE, n_b0=N_B0, shells=SHELLS, sigma=20., first=10000):
+
+    # n subjects sharing the data of the first one. The raw data of the others are
+    # hard links (copies if links are not possible), the pipeline never writes to
+    # datain, so 1000 subjects take the space of one. dataout is copied, the
+    # stages write their outputs over the files in it; None for gibbs and pipeline
+    # that start from the raw data.
+    # Returns list of subject ids
+
+    import errno
+    import shutil
+
+    subs = [f'sub-{first+i}' for i in range(n)]
+    mk_subject(datain, dataout, subs[0], shape, n_b0, shells, sigma)
+    for sub in subs[1:]:
+        dirs = [(os.path.join(datain, subs[0], 'dwi'), os.path.join(datain, sub, 'dwi'), True)]
+        if dataout is not None:
+            dirs.append((os.path.join(dataout, subs[0]), os.path.join(dataout, sub), False))
+        for src, dst, link in dirs:
+            os.makedirs(dst, exist_ok=True)
+            for f in os.listdir(src):
+                if not os.path.isfile(os.path.join(src, f)):
+                    continue # outputs of an earlier run, e.g. imgs/
+                new = os.path.join(dst, f.replace(subs[0], sub))
+                # a cohort written again in the same place (loadtest --workdir)
+                if os.path.exists(new):
+                    if os.path.samefile(os.path.join(src, f), new):
+                        continue
+                    os.remove(new)
+                if link:
+                    try:
+                        os.link(os.path.join(src, f), new)
+                        continue
+                    except OSError as e:
+                        # another filesystem or no hard links there, copy
+                        if e.errno not in [errno.EXDEV, errno.EPERM]:
+                            raise
+                shutil.copyfile(os.path.join(src, f), new)
+    return subs
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    args = argparse.ArgumentParser(description='Write synthetic DWI subjects')
+    args.add_argument('outdir', type=str, help='Directory for datain/ and dataout/')
+    args.add_argument('-n', '--subjects', type=int, default=1, help='Number of subjects')
+    args.add_argument('-s', '--shape', type=int, nargs=3, default=list(SHAPE), help='Volume size')
+    args.add_argument('--sigma', type=float, default=20., help='Noise level')
+    args.add_argument('--link', action='store_true', help='Subjects share the raw data of the first one, hard links')
+    args = args.parse_args()
+
+    datain, dataout = os.path.join(args.outdir, 'datain'), os.path.join(args.outdir, 'dataout')
+    if args.link:
+        subs = mk_cohort(datain, dataout, args.subjects, tuple(args.shape), sigma=args.sigma)
+        print(f'{len(subs)} subjects written')
+    else:
+        for i in range(args.subjects):
+            sub = f'sub-{10000+i}'
+            mk_subject(datain, dataout, sub, tuple(args.shape), sigma=args.sigma, seed=i)
+            print(f'{sub} written')
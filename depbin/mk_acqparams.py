@@ -7,7 +7,7 @@ def mk_acqparams(sid):
     
     import os
     import json
-    from dipy.io.image import load_nifti
+    import nibabel as nib
 
     """
     create acqparams.txt for topup
@@ -20,9 +20,12 @@ def mk_acqparams(sid):
     Created on Wed Apr 13 17:46:00 2022
     """
     
-    # Load AP and PA b0s to establish number of volumes
-    ap, __ = load_nifti(f'tmp/{sid}_AP_b0s.nii.gz')
-    pa, __ = load_nifti(f'tmp/{sid}_PA_b0s.nii.gz')
+    # Number of volumes of AP and PA b0s, from the headers
+    # (nib.load reads the header only, the data is not loaded)
+    ap_shape = nib.load(f'tmp/{sid}_AP_b0s.nii.gz').shape
+    pa_shape = nib.load(f'tmp/{sid}_PA_b0s.nii.gz').shape
+    n_ap = ap_shape[3] if len(ap_shape) > 3 else 1
+    n_pa = pa_shape[3] if len(pa_shape) > 3 else 1
     
     # Load JSONs
     apj = [f for f in os.listdir("tmp") if "_AP" in f and f.endswith("json")][0]
@@ -50,10 +53,10 @@ def mk_acqparams(sid):
     
     # Write acqparams file
     with open(os.path.join("tmp", "acqparams.txt"), "w") as f:
-        for i in range(0, ap.shape[3]):
+        for i in range(0, n_ap):
             #f.write(f"0 1 0 {trt_ap}\n0 -1 0 {trt_pa}")
             f.write(f"0 1 0 {trt_ap}\n")
-        for j in range(0, pa.shape[3]):
+        for j in range(0, n_pa):
             f.write(f"0 -1 0 {trt_pa}\n")
         
         f.close()
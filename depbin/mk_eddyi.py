@@ -10,14 +10,15 @@ Creates index for Eddy.
 """
 import argparse
 from os.path import join
-from dipy.io.image import load_nifti
+import nibabel as nib
 
-args = argparse.ArgumentParser(description='Function to create index for Eddy, relies on DIPY 1.5.0', epilog="by Aleksander Nitka")
+args = argparse.ArgumentParser(description='Function to create index for Eddy, reads the header with nibabel', epilog="by Aleksander Nitka")
 args.add_argument('ap', help='Path to AP volume to create index from')
 args = args.parse_args()
 
-dwi, __ = load_nifti(args.ap)
-vols = dwi.shape[3]
+# only the number of volumes is needed, read from the header
+shape = nib.load(args.ap).shape
+vols = shape[3] if len(shape) > 3 else 1
 
 sid = args.ap.split('/')[-1].split('_')[0]
 
@@ -10,10 +10,11 @@ def mk_indexeddy(sid):
     """
     
     import os
-    from dipy.io.image import load_nifti
+    import nibabel as nib
     
-    dwi, __ = load_nifti(os.path.join('tmp', f'{sid}_AP_denoised.nii.gz'))
-    vols = dwi.shape[3]
+    # number of volumes from the header, the image is not loaded
+    shape = nib.load(os.path.join('tmp', f'{sid}_AP_denoised.nii.gz')).shape
+    vols = shape[3] if len(shape) > 3 else 1
     
     #print(f'{sid} {vols} detected')
     
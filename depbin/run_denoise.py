@@ -33,6 +33,7 @@ args.add_argument('-l', '--log', help='Save a simple log of what has been proces
 args.add_argument('--nocopy', help='Do not copy data from rawdir, if set, the data will not be copied - all data required is in tmp already', default=False, action='store_true')
 args.add_argument('--noclean', help='Do not clean the tmp folder after denoising has been completed', default=False, action='store_true')
 args.add_argument('--nomove', help='Do not clean the tmp folder and do not move to out dir after denoising', default=False, action='store_true')
+args.add_argument('--stat-cache', help='Directory of the noise sigmas by image content, shared with the python pipeline (keep it out of tmp/<sub>), the sigmas of images seen before are not estimated again.', default=None)
 args = args.parse_args()
 
 # Check and set telegram informations
@@ -43,7 +44,7 @@ else:
     telegram = False
 
 # Define main function for single subject process
-def denoise_me(s, log = args.log, rawdir = args.rawdir, outdir = args.out, no_clean = args.noclean, no_move = args.nomove, no_copy = args.nocopy):
+def denoise_me(s, log = args.log, rawdir = args.rawdir, outdir = args.out, no_clean = args.noclean, no_move = args.nomove, no_copy = args.nocopy, stat_cache = args.stat_cache):
     """
     Perform copying (if needed), gradients estimation and denoising with p2s
     Set for a single ss but when list given just embed this fn in a loop.
@@ -80,7 +81,7 @@ def denoise_me(s, log = args.log, rawdir = args.rawdir, outdir = args.out, no_cl
 
         try:
             # Denoise p2s
-            rm_noise_p2s(s)
+            rm_noise_p2s(s, stat_cache)
         except:
             print(f'{dt.now()} {s} error while denoising files.')
             if log:
@@ -11,6 +11,7 @@ from datetime import datetime as dt
 from datetime import timedelta as td
 import shutil
 from time import sleep
+from fun.spans import Spans
 
 args = argparse.ArgumentParser(description="Function to run steps after denoising up until and including topup adn apply topup.")
 args.add_argument('-l', '--list', help = 'CSV file containing subject ids.', required = True)
@@ -49,6 +50,9 @@ ln = args.list.split('/')[-1].split('.')[0]
 if telegram:
     sendtel(f'Denoising started: list {args.list}')
     
+# Timing of the subjects and of topup, summary with run_timing_summary.py topup_spans.jsonl
+spans = Spans('topup_spans.jsonl')
+
 # Add to log - mark list start
 with open('topup_done.log', 'a') as l:
     l.write(f'{dt.now()}\tSTART\t{ln}\n')    
@@ -60,6 +64,7 @@ for idx, s in enumerate(subs):
 
     try:
 
+        spans.start('subject', 'topup', s, list=ln)
         mkdir(join('tmp', s))
         
         # Copy all required files:
@@ -82,21 +87,16 @@ for idx, s in enumerate(subs):
         mk_acq_params(s)
         
         # Run topup
-        t = dt.now()
         tp_cmd = f'topup --config=b02b0.cnf --datain=tmp/{s}/acqparams.txt \
         --imain=tmp/{s}/{s}_AP-PA_b0s.nii.gz --out=tmp/{s}/{s}_AP-PA_topup \
         --iout=tmp/{s}/{s}_iout --fout=tmp/{s}/{s}_fout -v \
         --jacout=tmp/{s}/{s}_jac --logout=tmp/{s}/{s}_topup.log \
         --rbmout=tmp/{s}/{s}_xfm --dfout=tmp/{s}/{s}_warpfield'
     
-        sb.run(tp_cmd, shell=True)
-
-        dtopup = dt.now() - t
-        print(f'Topup duration: {dtopup}')
-
-        with open('topup_times.log', 'a') as l:
-            l.write(f'{dt.now()}\t{s}\t{ln}\t{dtopup}\n')
-            l.close()
+        t = dt.now()
+        with spans.span('cmd', 'topup', s):
+            sb.run(tp_cmd, shell=True)
+        print(f'Topup duration: {dt.now() - t}')
         
         # NB it is NO LONGER SUGGESTED TO  RUN APPLY TOPUP, Jesper is not longer recomending this step as the same can be achieved by running eddy with params feed into it https://www.jiscmail.ac.uk/cgi-bin/webadmin?A2=FSL;3206abfa.1608
         
@@ -131,9 +131,10 @@ for idx, s in enumerate(subs):
         # Clean tmp dir
         print(f'{dt.now()} {s} from {ln} cleaning tmp dir')
         sb.run(f'rm -rf tmp/{s}', shell = True)
-        
+        spans.end('subject')
         
     except:
+        spans.end('subject', 'error')
         if telegram:
             sendtel(f'{s} from {ln} cannot be processed {ln}')
         with open('topup_errors.log', 'a') as e:
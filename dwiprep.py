@@ -136,7 +136,8 @@ def mk_otsu_brain_mask(sid):
     
     import os
     from dipy.segment.mask import median_otsu
-    from dipy.io.image import load_nifti, save_nifti
+    from dipy.io.image import load_nifti
+    from fun.pgzip import save_nifti
 
     import numpy as np
     
@@ -164,7 +165,8 @@ def mk_b0s(sid):
     @author: aleksander nitka
     """
     
-    from dipy.io.image import load_nifti, save_nifti
+    from dipy.io.image import load_nifti
+    from fun.pgzip import save_nifti
     from dipy.core.gradients import gradient_table
     import matplotlib.pyplot as plt
     import os
@@ -219,11 +221,12 @@ def mk_acq_params(sid):
     
     import os
     import json
-    from dipy.io.image import load_nifti
+    from fun.niimeta import NiiMeta
     
-    # Load AP and PA b0s to establish number of volumes
-    ap, __ = load_nifti(f'tmp/{sid}/{sid}_AP_b0s.nii.gz')
-    pa, __ = load_nifti(f'tmp/{sid}/{sid}_PA_b0s.nii.gz')
+    # Number of volumes of AP and PA b0s, from the headers
+    meta = NiiMeta()
+    n_ap = meta.vols(f'tmp/{sid}/{sid}_AP_b0s.nii.gz')
+    n_pa = meta.vols(f'tmp/{sid}/{sid}_PA_b0s.nii.gz')
     
     # Load JSONs
     apj = [f for f in os.listdir(f"tmp/{sid}/") if "_AP" in f and f.endswith("json")][0]
@@ -251,15 +254,15 @@ def mk_acq_params(sid):
     
     # Write acqparams file
     with open(os.path.join("tmp", sid, "acqparams.txt"), "w") as f:
-        for i in range(0, ap.shape[3]):
+        for i in range(0, n_ap):
             #f.write(f"0 1 0 {trt_ap}\n0 -1 0 {trt_pa}")
             f.write(f"0 1 0 {trt_ap}\n")
-        for j in range(0, pa.shape[3]):
+        for j in range(0, n_pa):
             f.write(f"0 -1 0 {trt_pa}\n")
         
         f.close()
         
-def rm_noise_p2s(sid):
+def rm_noise_p2s(sid, stat_cache=None):
     
     """
     Uses dipy's patch2self to denoise the dwi image, relies on scikit-klearn so install that first.
@@ -267,19 +270,25 @@ def rm_noise_p2s(sid):
     with bvals set as [5,5,5,5,5].Then it procuces a control plots for all volumes in both sets.
     Saves both as sub-xxxx_AP_denoised in tmp. Creates html page for all pngs created (QA)
 
+    stat_cache : STR or None
+        Directory of the noise sigmas by image content (fun/statcache.py), shared
+        with the python pipeline, the sigma of an image seen before is not estimated
+        again. None estimates all of them.
+
 
     Created on Fri Apr 15 15:20:23 2022
     @author: aleksander nitka
     """
     
-    from dipy.io.image import load_nifti, save_nifti
+    from dipy.io.image import load_nifti
+    from fun.pgzip import save_nifti
     import matplotlib.pyplot as plt
     import numpy as np
     import os
     from shutil import rmtree as rmt
     from dipy.denoise.patch2self import patch2self
     from datetime import datetime as dt
-    from dipy.denoise.noise_estimate import estimate_sigma
+    from fun.statcache import StatCache, cached_sigmas
     
     xcmp = 'gray'
     
@@ -303,22 +312,23 @@ def rm_noise_p2s(sid):
     bvals_pa = np.array([5.,5.,5.,5.,5.])
     
     # Calculate noise standaard deviation for raw data
-    sigma_ap_raw = estimate_sigma(dwi_ap, N = nC)
-    sigma_pa_raw = estimate_sigma(dwi_pa, N = nC)
+    stats = StatCache(stat_cache) if stat_cache is not None else None
+    sigma_ap_raw, sigma_pa_raw = cached_sigmas(stats, [os.path.join('tmp', sid, f'{sid}_{d}.nii') for d in ['AP', 'PA']], \
+        [dwi_ap, dwi_pa], N = nC)
     
     # Process AP
     dwi_ap_den = patch2self(dwi_ap, bvals_ap, model='ols', shift_intensity=True, clip_negative_vals=False, b0_threshold=50, verbose=True)
-    # calculate sigma of noise
-    sigma_ap_den = estimate_sigma(dwi_ap_den, N = nC)
     # Save NII
     save_nifti(os.path.join('tmp', sid, f'{sid}_AP_denoised.nii.gz'), dwi_ap_den, dwi_ap_affine)
+    # calculate sigma of noise
+    sigma_ap_den = cached_sigmas(stats, [os.path.join('tmp', sid, f'{sid}_AP_denoised.nii.gz')], [dwi_ap_den], N = nC)[0]
     
     # Process PA
     dwi_pa_den = patch2self(dwi_pa, bvals_pa, model='ols', shift_intensity=True, clip_negative_vals=False, b0_threshold=50, verbose=True)
-    # calculate sigma of noise
-    sigma_pa_den = estimate_sigma(dwi_pa_den, N = nC)
     # Save NII
     save_nifti(os.path.join('tmp', sid, f'{sid}_PA_denoised.nii.gz'), dwi_pa_den, dwi_pa_affine)
+    # calculate sigma of noise
+    sigma_pa_den = cached_sigmas(stats, [os.path.join('tmp', sid, f'{sid}_PA_denoised.nii.gz')], [dwi_pa_den], N = nC)[0]
     
     # Save noise estimates
     np.save(f'tmp/{sid}/{sid}_AP_sigma_noise_raw.npy', sigma_ap_raw)
@@ -445,7 +455,8 @@ def rm_gibbs(sid, fap, fpa):
     """
 
     from dipy.denoise.gibbs import gibbs_removal
-    from dipy.io.image import load_nifti, save_nifti
+    from dipy.io.image import load_nifti
+    from fun.pgzip import save_nifti
     import matplotlib.pyplot as plt
     from shutil import rmtree as rmt
     from datetime import datetime as dt
@@ -868,7 +879,8 @@ def mk_b0s_topup_applied(sid):
     @author: aleksander nitka
     """
 
-    from dipy.io.image import load_nifti, save_nifti
+    from dipy.io.image import load_nifti
+    from fun.pgzip import save_nifti
     from dipy.core.gradients import gradient_table
     import matplotlib.pyplot as plt
     import os
@@ -9,7 +9,12 @@ from skimage.metrics import structural_similarity as ssim
 from skimage.metrics import mean_squared_error as mse
 from skimage.measure import euler_number as euler
 from skimage.measure import shannon_entropy as shannon
-from dipy.denoise.noise_estimate import estimate_sigma
+
+import sys
+from os.path import dirname, abspath
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__))))) # fun/ of the repository
+from fun.sigma import estimate_sigmas, mask_box
+from fun.masks import brain_mask, select
 
 """from matplotlib import pyplot as plt
 from dipy.core.histeq import histeq
@@ -41,10 +46,15 @@ def snr(a, axis=None, ddof=0):
     sd = a.std(axis=axis, ddof=ddof)
     return np.where(sd == 0, 0, m/sd)
 
-def calc_metrics(img):
+def calc_metrics(img, mask=None):
     
     # Calculate single img metrics
-    m_sig = []
+    # mask: voxels the metrics are taken over (None all), ssim and euler need the
+    # neighbours so they take the box around the mask, see fun/masks.py
+    # sigma of all volumes in one pass, see fun/sigma.py
+    m_sig = list(estimate_sigmas([img], N = 32, mask = mask)[0])
+    box = (slice(None),) * 3 if mask is None else mask_box(mask)
+    m = np.ones(img[box + (0,)].shape, dtype=bool) if mask is None else mask[box]
     m_snr = []
     m_eul = []
     m_sha = []
@@ -54,20 +64,27 @@ def calc_metrics(img):
     m_mser = []
     
     for v in range(0, img.shape[3]):
-        m_sig.append(estimate_sigma(img[:,:,:,v], N = 32)[0])
-        m_snr.append(snr(img[:,:,:,v]))
-        m_eul.append(euler(img[:,:,:,v]))
-        m_sha.append(shannon(img[:,:,:,v]))
+        vol = img[box + (v,)]
+        ref = ibase[box + (v,)]
+        m_snr.append(snr(vol[m]))
+        m_eul.append(euler(vol))
+        m_sha.append(shannon(vol[m]))
         
-        m_psnr.append(psnr(ibase[:,:,:,v], img[:,:,:,v]))
-        m_ssim.append(ssim(ibase[:,:,:,v], img[:,:,:,v]))
-        m_mser.append(mse(ibase[:,:,:,v], img[:,:,:,v]))
+        m_psnr.append(psnr(ref[m], vol[m]))
+        m_ssim.append(ssim(ref, vol))
+        m_mser.append(mse(ref[m], vol[m]))
         
     return m_sig, m_snr, m_eul, m_sha, m_psnr, m_ssim, m_mser
 
 edir ='/mnt/nasips/aleksander/experiments/data/denoise_compare/'
 edir = '/Users/admin/x2goSwap/'
 
+# None for the metrics over the whole image, 'brain' or 'background' for the bet
+# mask of the subject ({s}_b0_bet_f-02_mask.nii.gz, else median_otsu of the b0s),
+# saved next to the others with the mask in the name, e.g. {s}_p2s_sigma_brain.npy
+mask_name = None
+sfx = '' if mask_name is None else f'_{mask_name}'
+
 if exists(edir):
     subs = [f for f in listdir(edir) if f.startswith('sub')]
     subs = ['sub-17188']
@@ -79,23 +96,35 @@ if exists(edir):
         
         # Load base image and calculate 
         ibase, __ = load(join(edir, s, f'{s}_AP.nii'))
+
+        # Mask of the metrics
+        mask = None
+        if mask_name is not None:
+            fm = join(edir, s, f'{s}_b0_bet_f-02_mask.nii.gz')
+            if exists(fm):
+                brain = load(fm)[0] > 0
+            else:
+                brain = brain_mask(ibase, np.load(join(edir, s, f'{s}_bvals.npy')) <= 50)
+            mask = select(brain, mask_name)
+        box = (slice(None),) * 3 if mask is None else mask_box(mask)
+        m = np.ones(ibase[box + (0,)].shape, dtype=bool) if mask is None else mask[box]
         
         # calculate image metrics for base image
-        base_sig = []
+        base_sig = list(estimate_sigmas([ibase], N = 32, mask = mask)[0])
         base_snr = []
         base_eul = []
         base_sha = []
         
         for v in range(0, ibase.shape[3]):
-            base_sig.append(estimate_sigma(ibase[:,:,:,v], N=32)[0])
-            base_snr.append(snr(ibase[:,:,:,v]))
-            base_eul.append(euler(ibase[:,:,:,v]))
-            base_sha.append(shannon(ibase[:,:,:,v]))
+            vol = ibase[box + (v,)]
+            base_snr.append(snr(vol[m]))
+            base_eul.append(euler(vol))
+            base_sha.append(shannon(vol[m]))
             
-        np.save(join(edir, s, f'{s}_base_sigma.npy'), base_sig)
-        np.save(join(edir, s, f'{s}_base_snr.npy'), base_snr)
-        np.save(join(edir, s, f'{s}_base_euler.npy'), base_eul)
-        np.save(join(edir, s, f'{s}_base_shannon.npy'), base_sha)
+        np.save(join(edir, s, f'{s}_base_sigma{sfx}.npy'), base_sig)
+        np.save(join(edir, s, f'{s}_base_snr{sfx}.npy'), base_snr)
+        np.save(join(edir, s, f'{s}_base_euler{sfx}.npy'), base_eul)
+        np.save(join(edir, s, f'{s}_base_shannon{sfx}.npy'), base_sha)
             
         # for the rest of images
         # set filename suffixes and data name prefixes
@@ -111,16 +140,16 @@ if exists(edir):
             img, __ = load(join(edir, s, f'{s}{f}'))
             
             # Calculate metrics
-            xsig, xsnr, xeuler, xshan, xpsnr, xssim, xmse = calc_metrics(img)
+            xsig, xsnr, xeuler, xshan, xpsnr, xssim, xmse = calc_metrics(img, mask)
             
             # Save metrics to file
-            np.save(join(edir, s ,f'{s}_{dnames[j]}_sigma.npy'), xsig)
-            np.save(join(edir, s, f'{s}_{dnames[j]}_snr.npy'), xsnr)
-            np.save(join(edir, s, f'{s}_{dnames[j]}_euler.npy'), xeuler)
-            np.save(join(edir, s, f'{s}_{dnames[j]}_shannon.npy'), xshan)
-            np.save(join(edir, s, f'{s}_{dnames[j]}_psnr.npy'), xpsnr)
-            np.save(join(edir, s, f'{s}_{dnames[j]}_ssim.npy'), xssim)
-            np.save(join(edir, s, f'{s}_{dnames[j]}_mse.npy'), xmse)
+            np.save(join(edir, s ,f'{s}_{dnames[j]}_sigma{sfx}.npy'), xsig)
+            np.save(join(edir, s, f'{s}_{dnames[j]}_snr{sfx}.npy'), xsnr)
+            np.save(join(edir, s, f'{s}_{dnames[j]}_euler{sfx}.npy'), xeuler)
+            np.save(join(edir, s, f'{s}_{dnames[j]}_shannon{sfx}.npy'), xshan)
+            np.save(join(edir, s, f'{s}_{dnames[j]}_psnr{sfx}.npy'), xpsnr)
+            np.save(join(edir, s, f'{s}_{dnames[j]}_ssim{sfx}.npy'), xssim)
+            np.save(join(edir, s, f'{s}_{dnames[j]}_mse{sfx}.npy'), xmse)
                         
             # Save as local variables
             globals()[f'{dnames[j]}_sigma'] = xsig
@@ -208,7 +237,7 @@ if exists(edir):
                                 'p2s_ssim': p2s_ssim,
                                 'p2s_mse': p2s_mse})
         
-        df.to_csv(join(edir, s, f'{s}_metrics.csv'), index=False)
+        df.to_csv(join(edir, s, f'{s}_metrics{sfx}.csv'), index=False)
 
 else:
     print('Unable to find subjects directory')
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import sys
 import argparse
-from os.path import join
+from os.path import join, dirname, abspath
 import matplotlib.pyplot as plt
 from dipy.io.image import load_nifti
-from dipy.denoise.noise_estimate import estimate_sigma
 import numpy as np
 
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__))))) # fun/ of the repository
+from fun.sigma import estimate_sigmas
+
 args = argparse.ArgumentParser('Compares images from both denoising methods.')
 args.add_argument('sub', help='subject ID')
 args.add_argument('-i', '--data', help='Data folder', default='data')
@@ -23,14 +26,10 @@ img0, aff0 = load_nifti(join(args.data, args.sub, f'{args.sub}_AP.nii'))
 img1, aff1 = load_nifti(join(args.data, args.sub, f'{args.sub}_order-1_gib_p2s.nii'))
 img2, aff2 = load_nifti(join(args.data, args.sub, f'{args.sub}_order-2_p2s_gib.nii'))
 
-# Estimate noise for all volumes
-sigma0 = [] # RAW image
-sigma1 = [] # order 1
-sigma2 = [] # order 2
-for i in range(img1.shape[-1]):
-    sigma0.append(estimate_sigma(img0[:,:,:,i])[0])
-    sigma1.append(estimate_sigma(img1[:,:,:,i])[0])
-    sigma2.append(estimate_sigma(img2[:,:,:,i])[0])
+# Estimate noise for all volumes, of the three images at once
+# RAW image, order 1, order 2
+n = img1.shape[-1]
+sigma0, sigma1, sigma2 = estimate_sigmas([img0[..., :n], img1, img2[..., :n]])
 
 means = [np.mean(sigma0), np.mean(sigma1), np.mean(sigma2)]
 stds = [np.std(sigma0), np.std(sigma1), np.std(sigma2)]
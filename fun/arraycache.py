@@ -0,0 +1,105 @@
+class ArrayCache():
+
+    # Images of the subject being processed, kept in memory so each one is decoded
+    # once per subject; the steps that read an image again (sigma estimation,
+    # QA plots, b0s, eddy index) get the array instead of loading the file.
+    # - entries are keyed by the path and checked against its mtime and size, an
+    #   image rewritten by a tool is loaded again
+    # - images saved by python are put in as they are written
+    # - at most `budget` bytes are held, the least recently used image goes first;
+    #   memory mapped images (uncompressed .nii) do not count, they are in the page cache
+    # - the cache holds one subject, open() for another subject and clear() empty it
+    # The arrays are shared by every step that reads them, they must not be changed in place
+    #
+    # cache = ArrayCache(budget=8*1024**3)
+    # cache.open(sub)
+    # hit = cache.get(path)            # (data, affine) or None
+    # cache.put(path, data, affine)
+    # cache.clear()
+
+    def __init__(self, budget=8*1024**3):
+
+        import os
+        import numpy as np
+        from collections import OrderedDict
+
+        self.os = os
+        self.np = np
+
+        self.budget = budget
+        self.entries = OrderedDict() # path: (mtime and size, data, affine, bytes)
+        self.sub = None
+        self.held = 0 # bytes
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Sent to worker processes with DwiPreprocessingClab, empty and without the modules
+        state = self.__dict__.copy()
+        for k in ['os', 'np']:
+            state.pop(k, None)
+        state['entries'] = type(self.entries)()
+        state['held'] = 0
+        return state
+
+    def __setstate__(self, state):
+        import os
+        import numpy as np
+        self.__dict__.update(state)
+        self.os = os
+        self.np = np
+
+    def key(self, path):
+        st = self.os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def open(self, sub):
+        # Subject whose images are cached, the images of any other one are dropped
+        if sub != self.sub:
+            self.clear()
+        self.sub = sub
+
+    def get(self, path):
+        path = self.os.path.abspath(path)
+        e = self.entries.get(path)
+        try:
+            if e is not None and e[0] == self.key(path):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return e[1], e[2]
+        except OSError:
+            pass
+        if e is not None:
+            self.drop(path)
+        self.misses += 1
+        return None
+
+    def put(self, path, data, affine):
+        path = self.os.path.abspath(path)
+        size = 0 if isinstance(data, self.np.memmap) else data.nbytes
+        if path in self.entries:
+            self.drop(path)
+        if size > self.budget:
+            return
+        while self.held + size > self.budget and len(self.entries) > 0:
+            self.drop(next(iter(self.entries)))
+        try:
+            self.entries[path] = (self.key(path), data, affine, size)
+            self.held += size
+        except OSError:
+            pass
+
+    def drop(self, path):
+        e = self.entries.pop(path, None)
+        if e is not None:
+            self.held -= e[3]
+
+    def clear(self):
+        # Empties the cache, returns message with the hits of the subject
+        m = f'array cache: {self.hits} hits, {self.misses} loads, {self.held/1024**2:0.0f} MB released'
+        self.entries.clear()
+        self.held = 0
+        self.hits = 0
+        self.misses = 0
+        self.sub = None
+        return m
@@ -0,0 +1,249 @@
+class Catalog():
+
+    # Local SQLite index of the subject directories of datain, dataout and the
+    # other derivatives, so that the subjects, their files and what is known about
+    # the images are looked up instead of listing the NAS on every launch.
+    # - refresh() walks a root to `depth` levels below the subject directories and
+    #   lists again only the directories whose mtime has changed, the others are
+    #   stat'ed only. New files of a listed directory are read, meta() reads a file
+    #   again if its size or mtime has changed (a file rewritten in place does not
+    #   change the mtime of its directory).
+    # - for each file it keeps the size and mtime and, by type:
+    #   .nii/.nii.gz  shape, affine, data type, voxel size and volumes (header only)
+    #   .bval         the b values
+    #   .json         TotalReadoutTime and PhaseEncodingDirection of the sidecar
+    # - artifacts() tells which declared outputs of each stage a subject has, see
+    #   fun/stages.py
+    # The connection is opened in each process and thread that uses it (the prefetch
+    # thread reads it too), several processes can read it at once; refresh it from
+    # one process at a time.
+    #
+    # cat = Catalog('catalog.sqlite')
+    # cat.refresh('/mnt/nas/rawdata')                  # message with what changed
+    # cat.subjects('/mnt/nas/rawdata')                 # ['sub-10000', ...]
+    # cat.files('/mnt/nas/rawdata', 'sub-10000', 'dwi') # names in sub-10000/dwi
+    # cat.meta('/mnt/nas/rawdata/sub-10000/dwi/x.nii')  # {'vols': 106, 'shape': ...}
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)',
+        'CREATE TABLE IF NOT EXISTS subjects (root TEXT, sub TEXT, PRIMARY KEY (root, sub))',
+        'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, root TEXT, sub TEXT, dir TEXT, name TEXT, \
+            size INTEGER, mtime_ns INTEGER, shape TEXT, affine TEXT, dtype TEXT, zooms TEXT, vols INTEGER, \
+            bvals TEXT, trt REAL, ped TEXT)',
+        'CREATE INDEX IF NOT EXISTS files_sub ON files (root, sub, dir)',
+    ]
+
+    def __init__(self, path):
+
+        import os
+        import json
+        import sqlite3
+        import threading
+
+        self.os = os
+        self.json = json
+        self.sqlite3 = sqlite3
+
+        self.path = os.path.abspath(path)
+        self.local = threading.local() # connection of each thread
+
+    def __getstate__(self):
+        # Sent to worker processes with DwiPreprocessingClab, they open their own connection
+        state = self.__dict__.copy()
+        for k in ['os', 'json', 'sqlite3', 'local']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for s in self.SCHEMA:
+                conn.execute(s)
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        # Closes the connection of the calling thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    ########################################
+    # Refresh ##############################
+    ########################################
+
+    def refresh(self, root, subs=None, depth=2):
+        # Brings the catalog of root up to date, subs: only these subjects (their
+        # directories must exist), None for all; depth 0 lists the subjects only
+        # Returns message with the directories listed and the files read
+        root = self.os.path.abspath(root)
+        db = self.db()
+        n = {'listed': 0, 'read': 0, 'removed': 0}
+
+        if subs is None:
+            entries = self.listdir(db, root, n)
+            if entries is not None:
+                found = [e for e in entries if e.startswith('sub-') and self.os.path.isdir(self.os.path.join(root, e))]
+                known = set(self.subjects(root))
+                for s in known - set(found):
+                    self.forget(db, root, s, n)
+                db.executemany('INSERT OR IGNORE INTO subjects VALUES (?, ?)', [(root, s) for s in found])
+            subs = self.subjects(root)
+        else:
+            db.executemany('INSERT OR IGNORE INTO subjects VALUES (?, ?)', [(root, s) for s in subs])
+
+        if depth > 0:
+            for s in subs:
+                self.walk(db, root, s, self.os.path.join(root, s), '', depth, n)
+        db.commit()
+        return f'catalog {root}: {len(subs)} subjects, {n["listed"]} dirs listed, {n["read"]} files read, {n["removed"]} removed'
+
+    def listdir(self, db, path, n):
+        # Entries of path if its mtime changed since the last refresh, None if not
+        st = self.os.stat(path)
+        row = db.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == st.st_mtime_ns:
+            return None
+        db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (path, st.st_mtime_ns))
+        n['listed'] += 1
+        return self.os.listdir(path)
+
+    def walk(self, db, root, sub, path, rel, depth, n):
+        # Files of path (rel to the subject dir), listed again only if path changed
+        try:
+            entries = self.listdir(db, path, n)
+        except FileNotFoundError:
+            self.forget(db, root, sub, n)
+            return
+        subdirs = []
+        if entries is None:
+            # unchanged, the files it holds are the ones known, the subdirectories are checked
+            rows = db.execute('SELECT path FROM dirs WHERE path LIKE ? ESCAPE ?', (self.like(path) + '/%', '\\')).fetchall()
+            subdirs = [self.os.path.basename(r[0]) for r in rows if self.os.path.dirname(r[0]) == path]
+        else:
+            known = {r[0]: (r[1], r[2]) for r in db.execute('SELECT name, size, mtime_ns FROM files WHERE root = ? AND sub = ? AND dir = ?', (root, sub, rel))}
+            for e in entries:
+                p = self.os.path.join(path, e)
+                try:
+                    st = self.os.stat(p)
+                except FileNotFoundError:
+                    continue
+                if self.os.path.isdir(p):
+                    subdirs.append(e)
+                    continue
+                k = known.pop(e, None)
+                if k is None or k != (st.st_size, st.st_mtime_ns):
+                    self.add(db, root, sub, rel, e, p, st)
+                    n['read'] += 1
+            for e in known:
+                db.execute('DELETE FROM files WHERE path = ?', (self.os.path.join(path, e),))
+                n['removed'] += 1
+            # subdirectories that are gone
+            rows = db.execute('SELECT path FROM dirs WHERE path LIKE ? ESCAPE ?', (self.like(path) + '/%', '\\')).fetchall()
+            for r in rows:
+                if self.os.path.dirname(r[0]) == path and self.os.path.basename(r[0]) not in subdirs:
+                    self.forget_dir(db, r[0], n)
+        if depth > 1:
+            for d in subdirs:
+                self.walk(db, root, sub, self.os.path.join(path, d), self.os.path.join(rel, d), depth - 1, n)
+
+    def add(self, db, root, sub, rel, name, path, st):
+        # Row of a new or changed file, with what can be read of it
+        m = {'shape': None, 'affine': None, 'dtype': None, 'zooms': None, 'vols': None, 'bvals': None, 'trt': None, 'ped': None}
+        try:
+            if name.endswith('.nii') or name.endswith('.nii.gz'):
+                from fun.niimeta import NiiMeta
+                h = NiiMeta(size=0).read(path)
+                m.update({'shape': self.json.dumps(h['shape']), 'affine': self.json.dumps(h['affine'].tolist()), \
+                    'dtype': h['dtype'], 'zooms': self.json.dumps(h['zooms']), 'vols': h['vols']})
+            elif name.endswith('.bval'):
+                with open(path) as f:
+                    m['bvals'] = self.json.dumps([float(b) for b in f.read().split()])
+            elif name.endswith('.json'):
+                with open(path) as f:
+                    side = self.json.load(f)
+                m['trt'] = side.get('TotalReadoutTime')
+                m['ped'] = side.get('PhaseEncodingDirection')
+        except Exception:
+            pass # not readable yet, e.g. being written, kept with its size and mtime only
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', \
+            (path, root, sub, rel, name, st.st_size, st.st_mtime_ns, m['shape'], m['affine'], m['dtype'], \
+            m['zooms'], m['vols'], m['bvals'], m['trt'], m['ped']))
+
+    def forget(self, db, root, sub, n):
+        # Subject directory that is gone
+        db.execute('DELETE FROM subjects WHERE root = ? AND sub = ?', (root, sub))
+        self.forget_dir(db, self.os.path.join(root, sub), n)
+
+    def forget_dir(self, db, path, n):
+        like = self.like(path) + '/%'
+        n['removed'] += db.execute('DELETE FROM files WHERE path LIKE ? ESCAPE ?', (like, '\\')).rowcount
+        db.execute('DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE ?', (path, like, '\\'))
+
+    def like(self, path):
+        return path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    ########################################
+    # Queries ##############################
+    ########################################
+
+    def subjects(self, root):
+        # Subject directories of root, sorted
+        root = self.os.path.abspath(root)
+        return [r[0] for r in self.db().execute('SELECT sub FROM subjects WHERE root = ? ORDER BY sub', (root,))]
+
+    def files(self, root, sub, rel=''):
+        # Names of the files in root/sub/rel, sorted
+        root = self.os.path.abspath(root)
+        return [r[0] for r in self.db().execute('SELECT name FROM files WHERE root = ? AND sub = ? AND dir = ? ORDER BY name', \
+            (root, sub, rel))]
+
+    def meta(self, path):
+        # What is known of a file, None if it is not in the catalog
+        # a file rewritten in place does not change the mtime of its directory,
+        # refresh() does not see it, so its size and mtime are checked here
+        path = self.os.path.abspath(path)
+        db = self.db()
+        cur = db.execute('SELECT * FROM files WHERE path = ?', (path,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        m = dict(zip([c[0] for c in cur.description], row))
+        try:
+            st = self.os.stat(path)
+        except FileNotFoundError:
+            return None
+        if (st.st_size, st.st_mtime_ns) != (m['size'], m['mtime_ns']):
+            self.add(db, m['root'], m['sub'], m['dir'], m['name'], path, st)
+            db.commit()
+            return self.meta(path)
+        for k in ['shape', 'affine', 'zooms', 'bvals']:
+            if m[k] is not None:
+                m[k] = self.json.loads(m[k])
+        return m
+
+    def artifacts(self, root, sub):
+        # Declared outputs of each stage that root/sub has, {stage: [names]}
+        from fnmatch import fnmatch
+        from fun.stages import STAGES
+
+        root = self.os.path.abspath(root)
+        names = set(self.files(root, sub))
+        dirs = set([r[0] for r in self.db().execute('SELECT dir FROM files WHERE root = ? AND sub = ?', (root, sub))])
+        out = {}
+        for stage, s in STAGES.items():
+            out[stage] = []
+            for o in s['outputs']:
+                if o.startswith('_'):
+                    if any([fnmatch(f, sub + o) for f in names]) or any([fnmatch(d, sub + o) for d in dirs]):
+                        out[stage].append(o)
+                elif any([d == o or d.startswith(o + self.os.sep) for d in dirs]):
+                    out[stage].append(o)
+        return out
@@ -6,10 +6,22 @@ args = argparse.ArgumentParser()
 args.add_argument("-o", "--output", help="output file", default=False, required=False, action="store_true")
 args.add_argument("-rd", "--rawdir", help="raw data directory", default='/mnt/nasips/COST_mri/rawdata/', type=str, required=False)
 args.add_argument("-dp", "--preprcdir", help="preprocessed data directory", default='/mnt/nasips/COST_mri/derivatives/dwi/preproc/', type=str, required=False)
+args.add_argument("-c", "--catalog", help="sqlite catalog of the subjects (fun/catalog.py), refreshed and used instead of listing the directories", default=None, type=str, required=False)
 arguments = args.parse_args()
 
-raw = set([f for f in ls(arguments.rawdir) if f.startswith('sub-')])
-prp = set([f for f in ls(arguments.preprcdir) if f.startswith('sub-')])
+if arguments.catalog is None:
+    raw = set([f for f in ls(arguments.rawdir) if f.startswith('sub-')])
+    prp = set([f for f in ls(arguments.preprcdir) if f.startswith('sub-')])
+else:
+    import sys
+    from os.path import dirname, abspath
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    from fun.catalog import Catalog
+    cat = Catalog(arguments.catalog)
+    for d in [arguments.rawdir, arguments.preprcdir]:
+        print(cat.refresh(d, depth=0))
+    raw = set(cat.subjects(arguments.rawdir))
+    prp = set(cat.subjects(arguments.preprcdir))
 
 mis = list(raw - prp)
 
@@ -0,0 +1,142 @@
+class CmdRunner():
+
+    # Runs external commands (mrtrix3, fsl, dipy workflows) with asyncio
+    # - commands of a group run at the same time, at most `limit` at once,
+    #   e.g. the AP and PA runs of the same tool
+    # - groups of a chain run one after another, a failed command stops the chain,
+    #   so the steps that depend on it are not run on missing inputs
+    # - return codes are checked, a command that runs longer than `timeout`
+    #   seconds is stopped and counts as failed
+    # - stdout and stderr are streamed line by line to `logfile` (printed if None)
+    # log_ok, log_error: functions(id, message) used to report the outcome of the
+    # commands, e.g. DwiPreprocessingClab.log_ok and log_error, print if None
+    # spans: fun.spans.Spans, each command is written as a span of the step that runs it
+
+    def __init__(self, limit=2, timeout=None, logfile=None, log_ok=None, log_error=None, spans=None):
+
+        import os
+        import signal
+        import asyncio
+        from datetime import datetime as dt
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.os = os
+        self.signal = signal
+        self.asyncio = asyncio
+        self.dt = dt
+        self.ThreadPoolExecutor = ThreadPoolExecutor
+
+        self.limit = max(1, int(limit))
+        self.timeout = timeout
+        self.logfile = logfile
+        self.log_ok = log_ok
+        self.log_error = log_error
+        self.spans = spans
+        self.parent = None # span open when the chain was started, id and path
+
+    def report(self, id, ok, message):
+        log = self.log_ok if ok else self.log_error
+        if log is None:
+            print(f'{id} {message}')
+        else:
+            log(id, message)
+
+    def output(self, id, tool, stream, line):
+        if self.logfile is None:
+            print(f'{id} {tool}: {line}')
+        else:
+            with open(self.logfile, 'a') as f:
+                f.write(f'{self.dt.now()}\t{id}\t{tool}\t{stream}\t{line}\n')
+
+    async def pipe(self, id, tool, stream, reader, tail):
+        # stream the output of a command, keep the last lines of stderr for the message
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # very long line, e.g. progress bar with carriage returns only
+                line = await reader.read(1024*1024)
+            if not line:
+                break
+            line = line.decode(errors='replace').rstrip()
+            self.output(id, tool, stream, line)
+            if stream == 'stderr':
+                tail.append(line)
+                del tail[:-5]
+
+    async def one(self, id, cmd, sem, timeout):
+        # Returns True or False and message
+        tool = cmd.split()[0]
+        async with sem:
+            start = self.dt.now()
+            t0 = self.asyncio.get_running_loop().time()
+            # own session, so a timeout stops the whole pipe, not just the shell
+            proc = await self.asyncio.create_subprocess_shell(cmd, stdout=self.asyncio.subprocess.PIPE, \
+                stderr=self.asyncio.subprocess.PIPE, start_new_session=True, limit=1024*1024)
+            tail = []
+            readers = self.asyncio.gather(self.pipe(id, tool, 'stdout', proc.stdout, tail), \
+                self.pipe(id, tool, 'stderr', proc.stderr, tail))
+            try:
+                await self.asyncio.wait_for(proc.wait(), timeout)
+            except self.asyncio.TimeoutError:
+                try:
+                    self.os.killpg(proc.pid, self.signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+                await readers
+                self.span(id, tool, cmd, start, timeout, 'timeout')
+                return [False, f'{tool} stopped after {timeout} s']
+            await readers
+            dur = self.asyncio.get_running_loop().time() - t0
+        self.span(id, tool, cmd, start, dur, 'ok' if proc.returncode == 0 else 'error', returncode=proc.returncode)
+
+        if proc.returncode != 0:
+            m = f'{tool} failed with code {proc.returncode}'
+            if len(tail) > 0:
+                m += f': {" | ".join(tail)}'
+            return [False, m]
+        return [True, f'{tool} completed in {dur/60:0.2f} min']
+
+    def span(self, id, tool, cmd, start, dur, status, **attrs):
+        if self.spans is not None:
+            self.spans.record('cmd', tool, id, start, dur, self.parent[0], self.parent[1] + tool, status, cmd=cmd, **attrs)
+
+    async def group(self, id, cmds, timeout):
+        sem = self.asyncio.Semaphore(self.limit)
+        return await self.asyncio.gather(*[self.one(id, c, sem, timeout) for c in cmds])
+
+    async def chain_async(self, id, groups, timeout):
+        for cmds in groups:
+            out = await self.group(id, cmds, timeout)
+            for s, m in out:
+                self.report(id, s, m)
+            failed = [m for s, m in out if not s]
+            if len(failed) > 0:
+                return [False, failed[0]]
+        return [True, f'{sum([len(g) for g in groups])} commands completed']
+
+    def sync(self, coro):
+        # run the coroutine to the end from normal code; inside a running event
+        # loop (e.g. jupyter) it is run in a separate thread with its own loop
+        try:
+            self.asyncio.get_running_loop()
+        except RuntimeError:
+            return self.asyncio.run(coro)
+        with self.ThreadPoolExecutor(1) as ex:
+            return ex.submit(self.asyncio.run, coro).result()
+
+    def run(self, id, cmds, timeout=None):
+        # Run independent commands at the same time
+        # Returns True if all succeeded, False and message of the first failure if not
+        return self.chain(id, [cmds], timeout)
+
+    def chain(self, id, groups, timeout=None):
+        # Run groups of commands one after another, stops at the first failed group
+        # Returns True if all succeeded, False and message of the first failure if not
+        if timeout is None:
+            timeout = self.timeout
+        if self.spans is not None:
+            # the commands run in the event loop, outside of the stack of the calling thread
+            self.parent = (self.spans.current(), self.spans.where(''))
+        return self.sync(self.chain_async(id, groups, timeout))
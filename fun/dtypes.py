@@ -0,0 +1,55 @@
+# Data types of the images python loads, computes on and saves, see the
+# compute_dtype and storage_dtype of DwiPreprocessingClab
+#
+# compute: type of the float images once loaded, and of what patch2self returns
+#   None       as load_nifti gives them, the type on disk
+#   'float32'  half the memory of float64; estimate_sigma convolves in float64,
+#              the sigmas are the same, patch2self fits in the type of the data,
+#              the denoised image differs from float64 by 0.08 sigma on average and
+#              0.7 sigma at most on the 24x24x20 phantom of benchmarks/dtypes.py -s 24 24 20
+#   'float64'  as dipy did with get_fdata, the reference
+#   Integer images (the raw data from the scanner) are exact, they are left as
+#   they are, they are smaller than any float
+# storage: type of the images saved by python
+#   None       as the array is
+#   'float32'  float arrays are saved as float32
+#   'int16'    float arrays are saved as int16 with scl_slope and scl_inter,
+#              chosen by nibabel over the range of the image; a quarter of float64
+#              on disk, the rounding error is at most half of range/65535, well
+#              below the noise, but the file is no longer the array that was computed
+#
+# data = compute(data, 'float32')
+# data, dtype = storage(data, None, 'int16')
+
+COMPUTE = [None, 'float32', 'float64']
+STORAGE = [None, 'float32', 'int16']
+
+
+def check(compute_dtype, storage_dtype):
+    # Returns True if the policy is known, False with a message if not
+    if compute_dtype not in COMPUTE:
+        return [False, f'Invalid compute_dtype {compute_dtype}, allowed are {COMPUTE}']
+    if storage_dtype not in STORAGE:
+        return [False, f'Invalid storage_dtype {storage_dtype}, allowed are {STORAGE}']
+    return [True, f'Images computed as {compute_dtype or "loaded"}, saved as {storage_dtype or "computed"}']
+
+
+def compute(data, dtype):
+    # Float image in the compute type; memory mapped float32 stays mapped when it
+    # is already of that type, integer images and None are returned as they are
+    import numpy as np
+
+    if dtype is None or not np.issubdtype(data.dtype, np.floating) or data.dtype == dtype:
+        return data
+    return data.astype(dtype)
+
+
+def storage(data, dtype, policy):
+    # Array and on-disk type to give to save_nifti; an explicit dtype of the caller wins
+    import numpy as np
+
+    if dtype is not None or policy is None or not np.issubdtype(data.dtype, np.floating):
+        return data, dtype
+    if policy == 'int16':
+        return data, np.int16
+    return compute(data, policy), None
@@ -0,0 +1,311 @@
+class FakeTools():
+
+    # Stand-ins for the external tools run by DwiPreprocessingClab, so the stages
+    # run end to end without FSL or MRtrix3, e.g. on a laptop or a build box, to
+    # time and load test the scheduling, copying and QA around the tools.
+    # Each stand-in reads the arguments the pipeline gives the real tool, writes
+    # outputs of the right name, shape and type (mostly copies of its input) and
+    # takes the time set in the profile:
+    #   sleep: seconds of waiting, e.g. on a licence or a slow disk
+    #   cpu: seconds of busy work on each of the threads given to the tool
+    #        (-nthreads, --num_processes or OMP_NUM_THREADS), 1 if not given
+    #   fail: fraction of the runs that fail with code 1, to test error handling
+    # The times are multiplied by scale, so the same profile fits a big or a small run.
+    #
+    # install() writes a small script for each tool to bindir, each one runs this
+    # file with the name of the tool; put bindir first in PATH:
+    #   tools = FakeTools('tmp/fakebin', {'eddy_openmp': {'sleep': 10}})
+    #   os.environ['PATH'] = tools.install() + os.pathsep + os.environ['PATH']
+
+    def __init__(self, bindir, profile=None, scale=1.0):
+
+        import os
+        import sys
+        import json
+
+        self.os = os
+        self.sys = sys
+        self.json = json
+
+        self.bindir = os.path.abspath(bindir)
+        self.scale = scale
+        self.profile = {k: dict(v) for k, v in PROFILE.items()}
+        if isinstance(profile, str):
+            # json file with the same layout as PROFILE
+            with open(profile) as f:
+                profile = json.load(f)
+        if profile is not None:
+            for k, v in profile.items():
+                self.profile.setdefault(k, {}).update(v)
+
+    def install(self):
+        # Writes the profile and a script for each tool to bindir, returns bindir
+        self.os.makedirs(self.bindir, exist_ok=True)
+        conf = self.os.path.join(self.bindir, 'profile.json')
+        with open(conf, 'w') as f:
+            self.json.dump({'scale': self.scale, 'tools': self.profile}, f, indent=2)
+
+        me = self.os.path.abspath(__file__)
+        for tool in TOOLS:
+            path = self.os.path.join(self.bindir, tool)
+            with open(path, 'w') as f:
+                f.write(f'#!/bin/sh\nexec "{self.sys.executable}" "{me}" {tool} "{conf}" "$@"\n')
+            self.os.chmod(path, 0o755)
+        return self.bindir
+
+
+# Default profile, seconds; roughly the relative cost of the tools on a subject,
+# scaled down about 100 times so a run of many subjects takes minutes
+PROFILE = {
+    'mrdegibbs': {'sleep': 0.2, 'cpu': 0.1, 'fail': 0},
+    'dipy_gibbs_ringing': {'sleep': 0.2, 'cpu': 0.1, 'fail': 0},
+    'dwidenoise': {'sleep': 0.5, 'cpu': 0.2, 'fail': 0},
+    'mrcalc': {'sleep': 0.05, 'cpu': 0, 'fail': 0},
+    'fslmerge': {'sleep': 0.05, 'cpu': 0, 'fail': 0},
+    'fslmaths': {'sleep': 0.05, 'cpu': 0, 'fail': 0},
+    'topup': {'sleep': 2.0, 'cpu': 1.0, 'fail': 0},
+    'bet': {'sleep': 0.1, 'cpu': 0.05, 'fail': 0},
+    'dipy_median_otsu': {'sleep': 0.1, 'cpu': 0.05, 'fail': 0},
+    'eddy_openmp': {'sleep': 3.0, 'cpu': 1.0, 'fail': 0},
+    'eddy_quad': {'sleep': 0.3, 'cpu': 0, 'fail': 0},
+}
+TOOLS = list(PROFILE.keys())
+
+
+########################################
+# Stand-ins ############################
+########################################
+
+def load(path):
+    import nibabel as nib
+    img = nib.load(path)
+    return img.get_fdata(dtype='float32'), img.affine
+
+def save(path, data, affine):
+    import numpy as np
+    import nibabel as nib
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype='float32'), affine), nii(path))
+
+def nii(path):
+    # FSL tools add the extension of FSLOUTPUTTYPE to the names given without one
+    import os
+    ext = '.nii' if os.environ.get('FSLOUTPUTTYPE') == 'NIFTI' else '.nii.gz'
+    return path if path.endswith('.nii') or path.endswith('.nii.gz') else path + ext
+
+def opts(args):
+    # --key=value and -key value options, the rest are positional
+    # flags without a value (-force, -m, --repol) are followed by another option or nothing
+    pos, kw = [], {}
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if isopt(a):
+            if '=' in a:
+                k, v = a.lstrip('-').split('=', 1)
+                kw[k] = v
+            elif i + 1 < len(args) and not isopt(args[i+1]) and a.lstrip('-') in VALUED:
+                kw[a.lstrip('-')] = args[i+1]
+                i += 1
+            else:
+                kw[a.lstrip('-')] = True
+        else:
+            pos.append(a)
+        i += 1
+    return pos, kw
+
+def isopt(a):
+    # -nthreads -1 is an option and its value
+    return a.startswith('-') and len(a) > 1 and not a[1].isdigit()
+
+# options that take a value when written as -key value
+VALUED = ['nthreads', 'noise', 'out_unring', 'num_processes', 'f', 'vol_idx', 'numpass', \
+    'out_mask', 'out_masked', 'idx', 'par', 'm', 'b', 'o']
+
+def threads(kw):
+    import os
+    for k in ['nthreads', 'num_processes']:
+        if k in kw and str(kw[k]).lstrip('-').isdigit():
+            return max(1, int(kw[k]))
+    return max(1, int(os.environ.get('OMP_NUM_THREADS', 1)))
+
+def unring(args):
+    # mrdegibbs in out [-nthreads n] [-force]
+    # dipy_gibbs_ringing in --out_unring out [--num_processes n]
+    pos, kw = opts(args)
+    data, affine = load(pos[0])
+    save(kw.get('out_unring', pos[-1]), data, affine)
+
+def dwidenoise(args):
+    # dwidenoise [-force] [-nthreads n] in out -noise noise
+    import numpy as np
+    pos, kw = opts(args)
+    data, affine = load(pos[0])
+    save(pos[1], data, affine)
+    if 'noise' in kw:
+        save(kw['noise'], np.std(data, axis=-1), affine)
+
+def mrcalc(args):
+    # mrcalc [-force] a b -subtract out
+    pos, kw = opts(args)
+    a, affine = load(pos[0])
+    b, __ = load(pos[1])
+    save(pos[-1], a - b, affine)
+
+def fslmerge(args):
+    # fslmerge -t out in1 in2 ...
+    import numpy as np
+    pos = [a for a in args if not isopt(a)]
+    vols = []
+    for p in pos[1:]:
+        d, affine = load(nii(p))
+        vols.append(d if d.ndim == 4 else d[..., None])
+    save(pos[0], np.concatenate(vols, axis=3), affine)
+
+def fslmaths(args):
+    # fslmaths in -Tmean out, other operations return the input
+    pos = [a for a in args if not isopt(a)]
+    data, affine = load(nii(pos[0]))
+    if '-Tmean' in args and data.ndim == 4:
+        data = data.mean(axis=3)
+    save(pos[-1], data, affine)
+
+def topup(args):
+    # topup --imain= --datain= --config= --out=base --iout=file
+    # fieldcoef is a coarse 3D grid of spline coefficients, movpar 6 columns per b0
+    import numpy as np
+    pos, kw = opts(args)
+    data, affine = load(nii(kw['imain']))
+    save(kw['out'] + '_fieldcoef', np.zeros([max(1, s // 4) for s in data.shape[:3]]), affine)
+    np.savetxt(kw['out'] + '_movpar.txt', np.zeros((data.shape[3], 6)), fmt='%.6f')
+    if 'iout' in kw:
+        save(kw['iout'], data, affine)
+    if 'fout' in kw:
+        save(kw['fout'], np.zeros(data.shape[:3]), affine)
+
+def mask(data):
+    # voxels brighter than a fifth of the mean of the nonzero ones
+    import numpy as np
+    d = data if data.ndim == 3 else data[..., 0]
+    return (d > d[d > 0].mean() / 5).astype('float32') if (d > 0).any() else np.zeros_like(d)
+
+def bet(args):
+    # bet in out [-m] [-o] [-e] [-R] [-f f]
+    pos, kw = opts(args)
+    data, affine = load(nii(pos[0]))
+    m = mask(data)
+    out = pos[1].replace('.nii.gz', '')
+    save(out, (data if data.ndim == 3 else data[..., 0]) * m, affine)
+    if 'm' in kw:
+        save(out + '_mask', m, affine)
+    if 'o' in kw:
+        save(out + '_overlay', m, affine)
+    if 'e' in kw:
+        with open(out + '_mesh.vtk', 'w') as f:
+            f.write('# vtk DataFile Version 3.0\nfake mesh\nASCII\nDATASET POLYDATA\nPOINTS 0 float\n')
+
+def median_otsu(args):
+    # dipy_median_otsu in --vol_idx 0 --numpass 2 --save_masked --out_mask m --out_masked mm
+    pos, kw = opts(args)
+    data, affine = load(pos[0])
+    m = mask(data)
+    save(kw['out_mask'], m, affine)
+    if 'out_masked' in kw:
+        save(kw['out_masked'], (data if data.ndim == 3 else data[..., 0]) * m, affine)
+
+def eddy(args):
+    # eddy_openmp --imain= --mask= --acqp= --index= --bvecs= --bvals= --topup= --out=base [--cnr_maps]
+    import shutil
+    import numpy as np
+    pos, kw = opts(args)
+    data, affine = load(nii(kw['imain']))
+    out = kw['out']
+    save(out + '.nii.gz', data, affine)
+    shutil.copyfile(kw['bvecs'], out + '.eddy_rotated_bvecs')
+    n = data.shape[3]
+    np.savetxt(out + '.eddy_parameters', np.zeros((n, 16)), fmt='%.6f')
+    np.savetxt(out + '.eddy_movement_rms', np.zeros((n, 2)), fmt='%.6f')
+    np.savetxt(out + '.eddy_restricted_movement_rms', np.zeros((n, 2)), fmt='%.6f')
+    np.savetxt(out + '.eddy_outlier_map', np.zeros((n, data.shape[2]), dtype=int), fmt='%d', header='One row per scan', comments='')
+    if 'cnr_maps' in kw:
+        save(out + '.eddy_cnr_maps.nii.gz', np.ones(data.shape[:3] + (2,)), affine)
+
+def eddy_quad(args):
+    # eddy_quad base -idx -par -m -b -o qcdir, stops if qcdir exists like the real one
+    import os
+    import json
+    pos, kw = opts(args)
+    qc = kw.get('o', pos[0] + '.qc')
+    if os.path.exists(qc):
+        raise SystemExit(f'eddy_quad: output directory {qc} already exists')
+    os.makedirs(qc)
+    with open(os.path.join(qc, 'qc.json'), 'w') as f:
+        json.dump({'qc_mot_abs': 0., 'qc_mot_rel': 0., 'fake': True}, f)
+    with open(os.path.join(qc, 'qc.pdf'), 'w') as f:
+        f.write('')
+
+RUN = {'mrdegibbs': unring, 'dipy_gibbs_ringing': unring, 'dwidenoise': dwidenoise, 'mrcalc': mrcalc, \
+    'fslmerge': fslmerge, 'fslmaths': fslmaths, 'topup': topup, 'bet': bet, 'dipy_median_otsu': median_otsu, \
+    'eddy_openmp': eddy, 'eddy_quad': eddy_quad}
+
+
+def burn(seconds):
+    # busy loop on one core
+    from time import process_time
+    t = process_time() + seconds
+    x = 0
+    while process_time() < t:
+        x += 1
+
+def main(argv):
+
+    # faketools.py <tool> <profile.json> <args of the tool>
+    # Waits, works and fails as set in the profile, then writes the outputs
+
+    import sys
+    import json
+    import random
+    from time import sleep
+    from multiprocessing import Process
+
+    tool, conf, args = argv[0], argv[1], argv[2:]
+    with open(conf) as f:
+        conf = json.load(f)
+    p = conf['tools'].get(tool, {})
+    scale = conf.get('scale', 1.0)
+
+    if args in [['-version'], ['--version']]:
+        # recorded in the manifest, outputs of the stand-ins are never taken for real ones
+        print(f'{tool} fake')
+        return 0
+
+    print(f'{tool} (fake) {" ".join(args)}')
+    sleep(p.get('sleep', 0) * scale)
+    cpu = p.get('cpu', 0) * scale
+    if cpu > 0:
+        # one busy process for each thread the tool was given
+        n = threads(opts(args)[1])
+        procs = [Process(target=burn, args=(cpu,)) for i in range(n - 1)]
+        for pr in procs:
+            pr.start()
+        burn(cpu)
+        for pr in procs:
+            pr.join()
+
+    if random.random() < p.get('fail', 0):
+        print(f'{tool} (fake): failed as set in the profile', file=sys.stderr)
+        return 1
+
+    try:
+        RUN[tool](args)
+    except SystemExit as e:
+        print(e, file=sys.stderr)
+        return 1
+    except Exception as e:
+        print(f'{tool} (fake): {type(e).__name__}: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,62 @@
+class Journal():
+
+    # Steps of a stage completed for a subject, kept in the tmp workspace
+    # (tmp/sub-xxxxx/.journal/<stage>.json) next to the files the steps made.
+    # A step is written down only once its outputs are on disk, so after a crash
+    # the stage can pick up after the last completed step instead of starting over.
+    # key holds whatever the results depend on (parameters, input files); if it
+    # differs from the one in the journal, the journal is started again.
+
+    def __init__(self, path, key):
+
+        import os
+        import json
+
+        self.os = os
+        self.json = json
+
+        self.path = path
+        self.key = key
+        self.steps = {} # step: list of files made by the step
+
+        if self.os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = self.json.load(f)
+                if data['key'] == self.key:
+                    self.steps = data['steps']
+            except:
+                # broken journal, start again
+                self.steps = {}
+
+    def done(self, step):
+        # True if the step was completed and all of its files are still there
+        if step not in self.steps:
+            return False
+        return all([self.os.path.exists(f) for f in self.steps[step]])
+
+    def complete(self, step, files):
+        # Mark the step as completed, only if all of its files exist
+        # Returns True if the step was written down
+        if not all([self.os.path.exists(f) for f in files]):
+            return False
+        self.steps[step] = list(files)
+        self.save()
+        return True
+
+    def last(self):
+        # Name of the last completed step, None if nothing was done
+        if len(self.steps) == 0:
+            return None
+        return list(self.steps.keys())[-1]
+
+    def save(self):
+        # write to a tmp file, flush to disk and rename, so a crash leaves either
+        # the old or the new journal
+        self.os.makedirs(self.os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            self.json.dump({'key': self.key, 'steps': self.steps}, f, indent=2)
+            f.flush()
+            self.os.fsync(f.fileno())
+        self.os.replace(tmp, self.path)
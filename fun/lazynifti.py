@@ -0,0 +1,59 @@
+class LazyNifti():
+
+    # A 3D or 4D NIfTI that reads only what is indexed, for the QA plots that show a
+    # few slices of each volume, in place of load_nifti of the whole image
+    # - .nii: the file is memory mapped, indexing reads the pages of the slice only
+    # - .nii.gz: the file cannot be read at random, the volume holding the slice is
+    #   decompressed (a few MB), the stream is kept open so going through the
+    #   volumes in order decompresses the file once; the last `cache` volumes are
+    #   kept, so the planes of one volume are read from the same copy
+    # Indexing gives numpy arrays scaled as load_nifti gives them
+    #
+    # img = LazyNifti('sub_AP_gib.nii.gz')
+    # for v in range(img.shape[3]):
+    #     plt.imshow(img[:, :, 55, v].T)
+
+    def __init__(self, path, cache=4):
+
+        import numpy as np
+        import nibabel as nib
+        from collections import OrderedDict
+
+        self.np = np
+
+        self.path = str(path)
+        self.gz = self.path.endswith('.gz')
+        if self.gz:
+            self.img = nib.load(self.path, keep_file_open=True)
+            self.data = None
+        else:
+            self.img = nib.load(self.path, mmap='r')
+            self.data = np.asanyarray(self.img.dataobj)
+        self.shape = self.img.shape
+        self.ndim = len(self.shape)
+        self.affine = self.img.affine
+        self.cache = max(1, int(cache))
+        self.held = OrderedDict() # volume: array
+
+    def __getitem__(self, key):
+        if self.data is not None:
+            return self.np.asarray(self.data[key])
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self.ndim == 3:
+            return self.volume(None)[key]
+        if len(key) == 4 and isinstance(key[3], (int, self.np.integer)):
+            return self.volume(int(key[3]))[key[:3]]
+        # across volumes, read by nibabel in one pass
+        return self.np.asanyarray(self.img.dataobj[key])
+
+    def volume(self, v):
+        # Volume v of a 4D image, the whole image if it is 3D
+        if v in self.held:
+            self.held.move_to_end(v)
+            return self.held[v]
+        a = self.np.asanyarray(self.img.dataobj[..., v] if v is not None else self.img.dataobj[...])
+        self.held[v] = a
+        while len(self.held) > self.cache:
+            self.held.popitem(last=False)
+        return a
@@ -0,0 +1,160 @@
+_versions = {} # tool versions, looked up once per process
+
+
+def tool_version(tool, backend='real'):
+
+    # Version of the software used by a stage, 'unknown' if it cannot be found
+    # dipy - python package, fsl - $FSLDIR/etc/fslversion, anything else is
+    # expected to be a MRtrix3 command that prints its version with -version
+    # With the fake backend (fun/faketools.py) every tool is 'fake', so the outputs
+    # of a fake run are never up to date for a real one
+
+    import os
+    import subprocess as sp
+
+    if backend == 'fake':
+        return 'fake'
+    if tool in _versions:
+        return _versions[tool]
+
+    v = 'unknown'
+    try:
+        if tool == 'dipy':
+            import dipy
+            v = dipy.__version__
+        elif tool == 'fsl':
+            with open(os.path.join(os.environ['FSLDIR'], 'etc', 'fslversion')) as f:
+                v = f.read().strip()
+        else:
+            r = sp.run(f'{tool} -version', shell=True, capture_output=True, text=True)
+            if r.returncode == 0 and r.stdout.strip() != '':
+                v = r.stdout.strip().splitlines()[0]
+    except:
+        pass
+
+    _versions[tool] = v
+    return v
+
+
+class Manifest():
+
+    # Record of the stages run for a subject, so that only the stages whose
+    # inputs or settings have changed are run again.
+    # For each stage it keeps the input files (size, mtime and sha1), the
+    # outputs (size and mtime), the tool versions and the parameters.
+    # Inputs are compared by size and mtime first, files are hashed only when
+    # these differ, so checking a stage that is up to date does not read any data.
+    # Stored as json next to the outputs: dataout/sub-xxxxx/sub-xxxxx_manifest.json
+
+    def __init__(self, path):
+
+        import os
+        import json
+        import hashlib
+        from datetime import datetime as dt
+
+        self.os = os
+        self.json = json
+        self.hashlib = hashlib
+        self.dt = dt
+
+        self.path = path
+        self.stages = {}
+
+        if self.os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.stages = self.json.load(f)['stages']
+            except:
+                # broken manifest, everything will be run again
+                self.stages = {}
+
+    def stat(self, path):
+        st = self.os.stat(path)
+        return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    def sha1(self, path):
+        h = self.hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def fingerprint(self, path, old=None):
+        # size, mtime and sha1 of a file, the hash of the old record is
+        # reused when size and mtime have not changed
+        fp = self.stat(path)
+        if old is not None and old['size'] == fp['size'] and old['mtime'] == fp['mtime']:
+            fp['sha1'] = old['sha1']
+        else:
+            fp['sha1'] = self.sha1(path)
+        return fp
+
+    def check(self, stage, inputs, params, tools):
+        # Returns True if the stage is up to date, False if it has to be run, and a message with the reason
+        # inputs: paths of the files the stage reads
+        # params: dict of the parameters of the stage, tools: dict of tool versions
+
+        rec = self.stages.get(stage)
+        if rec is None:
+            return [False, f'{stage} not in manifest']
+        if rec['params'] != params:
+            return [False, f'{stage} parameters changed: {rec["params"]} -> {params}']
+        if rec['tools'] != tools:
+            return [False, f'{stage} tool versions changed: {rec["tools"]} -> {tools}']
+
+        names = [self.os.path.basename(i) for i in inputs]
+        if sorted(names) != sorted(rec['inputs'].keys()):
+            return [False, f'{stage} input files changed']
+
+        rehashed = False
+        for i, n in zip(inputs, names):
+            if not self.os.path.exists(i):
+                return [False, f'{stage} input {n} not found']
+            old = rec['inputs'][n]
+            if self.stat(i) == {'size': old['size'], 'mtime': old['mtime']}:
+                continue
+            # touched or copied again, only a different content counts
+            fp = self.fingerprint(i)
+            if fp['sha1'] != old['sha1']:
+                return [False, f'{stage} input {n} changed']
+            rec['inputs'][n] = fp
+            rehashed = True
+
+        for o, old in rec['outputs'].items():
+            p = self.os.path.join(self.os.path.dirname(self.path), o)
+            if not self.os.path.exists(p):
+                return [False, f'{stage} output {o} missing']
+            if self.stat(p) != old:
+                return [False, f'{stage} output {o} modified']
+
+        # keep the new mtimes, so next check is fast again
+        if rehashed:
+            self.save()
+
+        return [True, f'{stage} up to date']
+
+    def record(self, stage, inputs, outputs, params, tools):
+        # Store the stage after it has completed, outputs are paths inside the manifest dir
+
+        old = self.stages.get(stage, {}).get('inputs', {})
+        ins = {}
+        for i in inputs:
+            n = self.os.path.basename(i)
+            ins[n] = self.fingerprint(i, old.get(n))
+
+        outs = {}
+        base = self.os.path.dirname(self.path)
+        for o in outputs:
+            outs[self.os.path.relpath(o, base)] = self.stat(o)
+
+        self.stages[stage] = {'date': self.dt.now().strftime('%Y-%m-%d %H:%M:%S'), \
+            'params': params, 'tools': tools, 'inputs': ins, 'outputs': outs}
+        self.save()
+
+    def save(self):
+        # write to a tmp file and rename, an interrupted write leaves the old manifest
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            self.json.dump({'stages': self.stages}, f, indent=2)
+        self.os.replace(tmp, self.path)
@@ -0,0 +1,49 @@
+# Brain and background masks the noise and QA statistics can be restricted to
+# - 'brain' is the bet mask of make_brain_masks() if the subject has one, or the
+#   median_otsu mask of the mean b0 of the raw AP (brain_mask()), as the
+#   make_brain_masks() of the pipeline does it
+# - 'background' is what is left outside the brain grown by `margin` voxels, so
+#   that the skull and the scalp are not in it
+# The estimates restricted to a mask are saved with its name, e.g.
+# sigma_noise/sub-10000_AP_raw_sigma_brain.npy
+#
+# brain = brain_mask(ap_raw, b0s_mask)
+# bg = select(brain, 'background')
+
+MASKS = [None, 'brain', 'background']
+
+
+def check(which):
+    # Returns [True/False, msg] for the mask of the statistics
+    if which not in MASKS:
+        return [False, f'Statistics mask must be one of {MASKS}, not {which}']
+    if which is None:
+        return [True, 'noise statistics over the whole field of view']
+    return [True, f'noise statistics over the {which} mask']
+
+
+def brain_mask(dwi, b0s_mask):
+    # median_otsu mask of the mean of the b0s of a 4D image (bool, 3D)
+    import numpy as np
+    from dipy.segment.mask import median_otsu
+    b0 = np.mean(dwi[..., np.asarray(b0s_mask, dtype=bool)], axis=3)
+    __, mask = median_otsu(b0, median_radius=2, numpass=2)
+    return mask.astype(bool)
+
+
+def background(mask, margin=3):
+    # Voxels outside the mask grown by margin voxels
+    from scipy.ndimage import binary_dilation
+    return ~binary_dilation(mask, iterations=margin)
+
+
+def select(mask, which):
+    # The brain mask, or the background around it
+    return mask if which == 'brain' else background(mask)
+
+
+def box_fraction(mask):
+    # Fraction of the field of view read by the estimates over the mask
+    from fun.sigma import mask_box
+    box = mask_box(mask)
+    return mask[box].size / mask.size
@@ -0,0 +1,69 @@
+class NiiMeta():
+
+    # Shape, affine, data type, voxel size and number of volumes of NIfTI images,
+    # read from the header only, for the steps that need the size of an image and
+    # not its data (eddy index, acqparams). nibabel reads the 348 bytes of the
+    # header, a .nii.gz is decompressed only that far.
+    # - entries are keyed by the path and checked against its mtime and size, an
+    #   image rewritten by a tool is read again
+    # - at most `size` images are kept, the least recently used goes first
+    #
+    # meta = NiiMeta()
+    # meta.vols('tmp/sub-10000/sub-10000_AP_gib_mppca.nii.gz')   # 106
+    # meta.get(path)   # {'shape', 'affine', 'dtype', 'zooms', 'vols'}
+
+    def __init__(self, size=4096):
+
+        import os
+        import nibabel as nib
+        from collections import OrderedDict
+
+        self.os = os
+        self.nib = nib
+
+        self.size = size
+        self.entries = OrderedDict() # path: (mtime and size, meta)
+
+    def __getstate__(self):
+        # Sent to worker processes with DwiPreprocessingClab, without the modules
+        state = self.__dict__.copy()
+        for k in ['os', 'nib']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        import os
+        import nibabel as nib
+        self.__dict__.update(state)
+        self.os = os
+        self.nib = nib
+
+    def get(self, path):
+        # Metadata of the image, raises OSError if it cannot be read
+        path = self.os.path.abspath(path)
+        st = self.os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        e = self.entries.get(path)
+        if e is not None and e[0] == key:
+            self.entries.move_to_end(path)
+            return e[1]
+        meta = self.read(path)
+        self.entries[path] = (key, meta)
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return meta
+
+    def read(self, path):
+        try:
+            img = self.nib.load(path)
+        except Exception as e:
+            raise OSError(f'Could not read the header of {path}: {e}')
+        shape = tuple(int(s) for s in img.shape)
+        return {'shape': shape, 'affine': img.affine, 'dtype': str(img.header.get_data_dtype()), \
+            'zooms': tuple(float(z) for z in img.header.get_zooms()[:3]), \
+            'vols': shape[3] if len(shape) > 3 else 1}
+
+    def vols(self, path):
+        # Volumes of a 4D image, 1 for a 3D one
+        return self.get(path)['vols']
@@ -0,0 +1,249 @@
+# Patch2Self (dipy.denoise.patch2self, version 3, model 'ols') over slabs of the
+# volume, with a bounded memory footprint and a set number of threads, so that
+# several subjects can be denoised on one node.
+# - a first pass over the slabs sums the Gram matrix of the volumes, the
+#   regression of each held-out volume on the other volumes of its group (b0s or
+#   dwis) is solved from it: ordinary least squares with an intercept over all
+#   the voxels (the Ridge with alpha=1e-10 of dipy), where dipy fits each volume
+#   on a count sketch of 30% of the voxels
+# - a second pass applies the weights of all the volumes to each slab at once
+# - a slab is a run of planes of the last spatial axis of at most slab_mb MB in
+#   float64, BLAS runs on `threads` threads (threadpoolctl, None: as it is)
+# Memory: the input, the output and two slabs; dipy copies the image to two
+# memory mapped temporary files and holds a fifth of it in float64 on top.
+# With a single b0 (or b0_denoising=False) the b0s are returned as they are, as
+# dipy does; shift_intensity of dipy >= 1.8 leaves the values as they are and is
+# not offered.
+# With `sample` the regressions are trained on a subsample of the voxels of
+# `mask` (the brain) instead of all of them, and applied to all of them:
+# - 'random': uniform over the mask
+# - 'stratified': from each of 10 bins of the mean b0 over the mask in proportion
+#   to its size, at least one voxel of each, so the dark and bright tissue are
+#   always in the sample
+# A sample of fewer voxels than volumes cannot fit the regressions and is refused.
+# check_sample() compares the result with the fits on all the voxels of the mask
+# (the loss of the sampling, a mean above TOLERANCE is reported by patch2self())
+# and on all the voxels of the image (also the change of training on the brain
+# only), in units of the noise, see accuracy().
+#
+# den = patch2self_slabs(gib, bvals, slab_mb=256, threads=4, out_dtype='float32')
+# den = patch2self_slabs(gib, bvals, mask=brain, sample=0.1, sample_mode='stratified')
+
+SAMPLE_MODES = ['random', 'stratified']
+TOLERANCE = 0.05 # mean difference to the fit on all the voxels, in noise sigmas
+
+
+def check(sample, mode, nvol=None):
+    # Returns [True/False, msg] for the subsample the regressions are trained on
+    # nvol: volumes of the image, a sample of fewer voxels is underdetermined
+    if sample is None:
+        return [True, 'patch2self regressions trained on all the voxels']
+    if mode not in SAMPLE_MODES:
+        return [False, f'Patch2Self sample mode must be one of {SAMPLE_MODES}, not {mode}']
+    if not sample > 0:
+        return [False, f'Patch2Self sample must be a fraction of the brain voxels or a number of voxels, not {sample}']
+    if sample > 1 and int(sample) < max(2, nvol or 0):
+        return [False, f'Patch2Self sample of {int(sample)} voxels is smaller than the {max(2, nvol or 0)} volumes, the regressions are underdetermined']
+    what = f'{sample*100:g}% of the brain voxels' if sample <= 1 else f'{int(sample)} brain voxels'
+    return [True, f'patch2self regressions trained on {what}, {mode}']
+
+
+def slab_planes(shape, slab_mb):
+    # Planes of the last spatial axis in a slab of at most slab_mb MB of float64
+    plane = shape[0] * shape[1] * shape[3] * 8
+    return max(1, min(shape[2], int(slab_mb * 1024**2 // plane)))
+
+
+def read_slab(data, z0, z1, out):
+    # Voxels of planes z0:z1 as rows of out (voxels x volumes), without a copy of
+    # the whole slab: a volume of the slab is contiguous in F order (load_nifti)
+    for v in range(data.shape[3]):
+        out[:, v] = data[:, :, z0:z1, v].ravel(order='F')
+    return out
+
+
+def gram(data, planes, shift):
+    # Number of voxels, sum of each volume and Gram matrix of the volumes, in
+    # float64, of the data minus shift (a value near the mean of each volume, the
+    # sums are then small and the centred Gram matrix is accurate)
+    import numpy as np
+    nvol = data.shape[3]
+    n = 0
+    s = np.zeros(nvol)
+    g = np.zeros((nvol, nvol))
+    buf = np.empty((data.shape[0] * data.shape[1] * planes, nvol), order='F')
+    for z0 in range(0, data.shape[2], planes):
+        z1 = min(z0 + planes, data.shape[2])
+        x = read_slab(data, z0, z1, buf[:data.shape[0] * data.shape[1] * (z1 - z0)])
+        x -= shift
+        n += x.shape[0]
+        s += x.sum(axis=0)
+        g += x.T @ x
+    return n, s, g
+
+
+def sample_voxels(mask, sample, mode='random', strata=None, bins=10, seed=0):
+    # Flat indices (F order) of the voxels the regressions are trained on
+    # sample: fraction (<= 1) of the voxels of the mask, or a number of voxels
+    # strata: 3D image the 'stratified' bins are taken from, e.g. the mean b0
+    import numpy as np
+    if mode not in SAMPLE_MODES:
+        raise ValueError(f'Sample mode must be one of {SAMPLE_MODES}, not {mode}')
+    rng = np.random.default_rng(seed)
+    idx = np.flatnonzero(mask.ravel(order='F'))
+    k = int(round(sample * len(idx))) if sample <= 1 else int(sample)
+    k = max(1, min(k, len(idx)))
+    if mode == 'random' or strata is None:
+        return np.sort(rng.choice(idx, k, replace=False))
+    vals = strata.ravel(order='F')[idx]
+    edges = np.quantile(vals, np.linspace(0, 1, bins + 1)[1:-1])
+    which = np.searchsorted(edges, vals, side='right')
+    sizes = np.bincount(which, minlength=bins)
+    full = np.flatnonzero(sizes > 0)
+    n = np.zeros(bins, dtype=int)
+    if k < len(full):
+        # fewer voxels than bins, one from each of k bins spread over the intensities
+        n[full[np.round(np.linspace(0, len(full) - 1, k)).astype(int)]] = 1
+    else:
+        # one voxel of each bin, the rest in proportion to what is left of each,
+        # the remainder of the rounding to the largest fractions
+        n[full] = 1
+        room = sizes - n
+        share = (k - len(full)) * room / room.sum() if room.sum() > 0 else np.zeros(bins)
+        n += np.floor(share).astype(int)
+        frac = share - np.floor(share)
+        n[np.argsort(-frac, kind='stable')[:k - n.sum()]] += 1
+    out = [rng.choice(idx[which == b], n[b], replace=False) for b in full if n[b] > 0]
+    return np.sort(np.concatenate(out))
+
+
+def gram_sample(data, idx, shift):
+    # gram() over the voxels of idx only (flat, F order)
+    import numpy as np
+    x = np.empty((len(idx), data.shape[3]), order='F')
+    for v in range(data.shape[3]):
+        x[:, v] = data[..., v].ravel(order='F')[idx]
+    x -= shift
+    return x.shape[0], x.sum(axis=0), x.T @ x
+
+
+def accuracy(full, sampled, noise, mask=None):
+    # Difference of the image of a subsampled fit to the fit on all the voxels,
+    # in units of noise: mean, 99th percentile and max over the mask (None: all)
+    import numpy as np
+    d = np.abs(sampled.astype('float64') - full)
+    if mask is not None:
+        d = d[mask]
+    d /= noise
+    return {'mean': float(d.mean()), 'p99': float(np.percentile(d, 99)), 'max': float(d.max())}
+
+
+def check_sample(data, bvals, den, mask, noise, sample, sample_mode='random', **kwargs):
+    # den, the sampled fit of data, against the fit on all the voxels of mask
+    # ('sampling') and on all the voxels of the image ('all'), over mask, with the
+    # time of each fit; kwargs go to patch2self_slabs()
+    from time import perf_counter
+    out = {}
+    for k, m, s in [('all', None, None), ('mask', mask, 1.0), ('sample', mask, sample)]:
+        t0 = perf_counter()
+        ref = patch2self_slabs(data, bvals, mask=m, sample=s, sample_mode=sample_mode, **kwargs)
+        out[f's {k}'] = perf_counter() - t0
+        if k == 'all':
+            out['all'] = accuracy(ref, den, noise, mask)
+        elif k == 'mask':
+            out['sampling'] = accuracy(ref, den, noise, mask)
+    return out
+
+
+def weights(n, s, g, shift, groups, alpha=1e-10):
+    # Weights (volumes x volumes) and intercepts of the denoised volumes, column j
+    # predicts volume j from the other volumes of its group; a group of one
+    # volume is left as it is
+    import numpy as np
+    nvol = len(shift)
+    mu = s / n
+    c = g - n * np.outer(mu, mu) # centred Gram matrix
+    mean = mu + shift
+    w = np.zeros((nvol, nvol))
+    b = np.zeros(nvol)
+    for idx in groups:
+        if len(idx) < 2:
+            w[idx, idx] = 1
+            continue
+        for j in idx:
+            others = idx[idx != j]
+            a = c[np.ix_(others, others)] + alpha * np.eye(len(others))
+            try:
+                coef = np.linalg.solve(a, c[others, j])
+            except np.linalg.LinAlgError:
+                coef = np.linalg.lstsq(a, c[others, j], rcond=None)[0]
+            w[others, j] = coef
+            b[j] = mean[j] - mean[others] @ coef
+    return w, b
+
+
+def patch2self_slabs(data, bvals, b0_threshold=50, slab_mb=256, threads=None, out_dtype=None, \
+    b0_denoising=True, clip_negative_vals=False, mask=None, sample=None, sample_mode='random', seed=0):
+
+    # Denoised 4D image, of out_dtype (None: the type of data), see above
+    # data: 4D array, also memory mapped; bvals: b value of each volume
+    # mask: 3D bool, voxels the sample is drawn from (None: all); sample: None to
+    # train on all the voxels, fraction of the mask or number of voxels
+
+    import numpy as np
+    from threadpoolctl import threadpool_limits
+
+    if data.ndim != 4:
+        raise ValueError('Patch2Self can only denoise on 4D arrays.', data.shape)
+    bvals = np.asarray(bvals)
+    if len(bvals) != data.shape[3]:
+        raise ValueError(f'{len(bvals)} b values for {data.shape[3]} volumes')
+    out_dtype = data.dtype if out_dtype is None else np.dtype(out_dtype)
+    calc = np.float64 if data.dtype == np.float64 else np.float32
+
+    b0s = np.flatnonzero(bvals <= b0_threshold)
+    dwis = np.flatnonzero(bvals > b0_threshold)
+    groups = [dwis]
+    if b0_denoising:
+        groups.append(b0s)
+    else:
+        groups += [np.array([i]) for i in b0s]
+
+    planes = slab_planes(data.shape, slab_mb)
+    nxy = data.shape[0] * data.shape[1]
+    with threadpool_limits(limits=threads, user_api='blas'):
+        # shift: mean of each volume in the middle plane
+        mid = data.shape[2] // 2
+        shift = read_slab(data, mid, mid + 1, np.empty((nxy, data.shape[3]), order='F')).mean(axis=0)
+        if sample is None:
+            stats = gram(data, planes, shift)
+        else:
+            s, m = check(sample, sample_mode, data.shape[3])
+            if not s:
+                raise ValueError(m)
+            if mask is None:
+                mask = np.ones(data.shape[:3], dtype=bool)
+            strata = None
+            if sample_mode == 'stratified':
+                strata = np.mean(data[..., b0s if len(b0s) > 0 else [0]], axis=3)
+            idx = sample_voxels(mask, sample, sample_mode, strata, seed=seed)
+            if len(idx) < data.shape[3]:
+                raise ValueError(f'{len(idx)} voxels sampled for {data.shape[3]} volumes, the regressions are underdetermined')
+            stats = gram_sample(data, idx, shift)
+        w, b = weights(*stats, shift, [g for g in groups if len(g) > 0])
+        w = w.astype(calc)
+        b = b.astype(calc)
+
+        out = np.empty(data.shape, dtype=out_dtype, order='F')
+        buf = np.empty((nxy * planes, data.shape[3]), dtype=calc, order='F')
+        res = np.empty((data.shape[3], nxy * planes), dtype=calc) # transposed, the result is in F order
+        for z0 in range(0, data.shape[2], planes):
+            z1 = min(z0 + planes, data.shape[2])
+            m = nxy * (z1 - z0)
+            x = read_slab(data, z0, z1, buf[:m])
+            y = np.matmul(w.T, x.T, out=res[:, :m]).T
+            y += b
+            if clip_negative_vals:
+                y.clip(min=0, out=y)
+            out[:, :, z0:z1, :] = y.reshape((data.shape[0], data.shape[1], z1 - z0, data.shape[3]), order='F')
+    return out
@@ -0,0 +1,120 @@
+class GzipWriter():
+
+    # File object that gzip compresses what is written to it on several threads
+    # The data is cut in blocks, each block is compressed on its own as a complete
+    # gzip member and the members are written in order. A file of several members
+    # is standard gzip (RFC 1952), it is read by gunzip, python's gzip, nibabel,
+    # MRtrix3 and FSL as one stream. zlib lets go of the GIL while it compresses,
+    # so the threads run at the same time. A few blocks more than threads are held
+    # in memory at once.
+    #
+    # with GzipWriter('x.nii.gz', level=1, threads=8) as f:
+    #     f.write(data)
+    # fileobj: write to this open binary file instead of path, it is not closed
+
+    def __init__(self, path, level=1, threads=None, block=4*1024**2, fileobj=None):
+
+        import os
+        import zlib
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.zlib = zlib
+
+        self.path = path
+        self.level = level # 1, as nibabel, is about as small as 6 for the noisy dwi data and much faster
+        self.threads = max(1, int(threads if threads is not None else os.cpu_count() or 1))
+        self.block = block # bytes compressed as one member
+        self.buf = bytearray()
+        self.pos = 0 # uncompressed bytes written
+        self.pending = deque() # compressing blocks, in order
+        self.pool = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.mine = fileobj is None
+        self.file = open(path, 'wb') if fileobj is None else fileobj
+        self.closed = False
+
+    def member(self, data):
+        # One complete gzip member, header, deflate stream and crc (wbits 31)
+        c = self.zlib.compressobj(self.level, self.zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+
+    def write(self, data):
+        # whole blocks are taken from data as they are, only the rest is buffered
+        data = memoryview(data).cast('B')
+        self.pos += len(data)
+        i = 0
+        if len(self.buf) > 0:
+            i = min(len(data), self.block - len(self.buf))
+            self.buf += data[:i]
+            if len(self.buf) < self.block:
+                return len(data)
+            self.submit(bytes(self.buf))
+            self.buf = bytearray()
+        while len(data) - i >= self.block:
+            self.submit(bytes(data[i:i+self.block]))
+            i += self.block
+        self.buf += data[i:]
+        return len(data)
+
+    def submit(self, data):
+        if self.pool is None:
+            self.file.write(self.member(data))
+            return
+        self.pending.append(self.pool.submit(self.member, data))
+        # write the finished blocks from the front, keeps the memory bounded
+        while len(self.pending) > 2 * self.threads or (len(self.pending) > 0 and self.pending[0].done()):
+            self.file.write(self.pending.popleft().result())
+
+    def read(self, size=-1):
+        # Write only; with read and write nibabel takes it as an open file
+        raise OSError('GzipWriter is write only')
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        # Only where the writer already is, nibabel checks the data offset this way
+        if whence != 0 or offset != self.pos:
+            raise OSError('GzipWriter cannot seek')
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self.buf) > 0 or self.pos == 0:
+                self.submit(bytes(self.buf))
+                self.buf = bytearray()
+            while len(self.pending) > 0:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            if self.mine:
+                self.file.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def save_nifti(fname, data, affine, hdr=None, dtype=None, level=1, threads=None):
+
+    # dipy.io.image.save_nifti, with .nii.gz written by GzipWriter rather than by
+    # single threaded zlib; other names are saved by nibabel as before
+
+    import nibabel as nib
+
+    img = nib.Nifti1Image(data, affine, header=hdr, dtype=dtype)
+    if not str(fname).endswith('.gz'):
+        img.to_filename(fname)
+        return
+    with GzipWriter(str(fname), level, threads) as f:
+        img.to_file_map({'image': nib.FileHolder(fileobj=f)})
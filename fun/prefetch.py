@@ -0,0 +1,135 @@
+class Prefetcher():
+
+    # Copies the inputs of the next subjects to local scratch in a background
+    # thread, while the current subject is processed, so reading from the NAS
+    # overlaps with the computing instead of every subject waiting for its copy
+    # - at most `ahead` subjects after the current one are fetched
+    # - fetched files not yet used take at most `budget` bytes of scratch, a subject
+    #   that alone is larger than the budget is fetched when nothing else is held
+    # - a file is copied to a .part name and renamed, so only complete files are used
+    #
+    # pf = Prefetcher('tmp/.prefetch', lambda sub: [paths], ahead=2, budget=50*1024**3)
+    # pf.start(subs)
+    # for sub in subs:
+    #     pf.wait(sub)        # current subject, its files are used if fetched
+    #     pf.local(path)      # local copy of path, None if not fetched
+    #     pf.release(sub)     # done with the subject, frees its scratch
+    # pf.stop()
+    # the thread does not write the log, its messages are collected and taken
+    # with pf.drain() by the loop, with their level ('info' or 'warning')
+
+    def __init__(self, scratch, files, ahead=2, budget=50*1024**3):
+
+        import os
+        import shutil
+        import threading
+
+        self.os = os
+        self.shutil = shutil
+        self.threading = threading
+
+        self.scratch = scratch
+        self.files = files # function, sub -> list of source paths
+        self.ahead = max(1, int(ahead))
+        self.budget = budget
+
+        self.subs = []
+        self.current = -1 # index of the subject being processed
+        self.fetching = None # subject being fetched
+        self.held = {} # sub: bytes in scratch
+        self.fetched = {} # source path: local path
+        self.messages = [] # (sub, message, level)
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def report(self, id, message, level='info'):
+        with self.cond:
+            self.messages.append((id, message, level))
+
+    def drain(self):
+        # Messages of the thread since the last call
+        with self.cond:
+            out, self.messages = self.messages, []
+        return out
+
+    def start(self, subs):
+        self.subs = list(subs)
+        self.os.makedirs(self.scratch, exist_ok=True)
+        self.thread = self.threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        for i, sub in enumerate(self.subs):
+            try:
+                paths = [p for p in self.files(sub) if self.os.path.isfile(p)]
+                size = sum([self.os.path.getsize(p) for p in paths])
+            except Exception as e:
+                self.report(sub, f'prefetch: cannot list inputs: {e}', 'warning')
+                continue
+
+            with self.cond:
+                # wait until the subject is close enough and fits in the budget
+                while not self.stopped and (i > self.current + self.ahead or \
+                    (len(self.held) > 0 and sum(self.held.values()) + size > self.budget)):
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                if i <= self.current:
+                    continue # the loop got there first, it reads from the source
+                self.fetching = sub
+                self.held[sub] = size
+
+            d = self.os.path.join(self.scratch, sub)
+            self.os.makedirs(d, exist_ok=True)
+            done = {}
+            for p in paths:
+                dst = self.os.path.join(d, self.os.path.basename(p))
+                try:
+                    self.shutil.copyfile(p, dst + '.part')
+                    self.os.replace(dst + '.part', dst)
+                    done[p] = dst
+                except Exception as e:
+                    self.report(sub, f'prefetch: could not fetch {p}: {e}', 'warning')
+                if self.stopped:
+                    break
+
+            with self.cond:
+                self.fetched.update(done)
+                self.fetching = None
+                self.cond.notify_all()
+            self.report(sub, f'prefetch: {len(done)} files, {size/1024**2:0.0f} MB fetched to {d}')
+
+    def wait(self, sub):
+        # Marks sub as the current subject; if it is being fetched, waits for it,
+        # reading the same files from the NAS at the same time would be slower
+        with self.cond:
+            if sub in self.subs:
+                self.current = self.subs.index(sub)
+            self.cond.notify_all()
+            while self.fetching == sub and not self.stopped:
+                self.cond.wait()
+
+    def local(self, path):
+        # Local copy of a source path, None if it was not fetched
+        with self.cond:
+            p = self.fetched.get(path)
+        if p is not None and self.os.path.exists(p):
+            return p
+        return None
+
+    def release(self, sub):
+        # Removes the files of sub from scratch
+        with self.cond:
+            self.fetched = {k: v for k, v in self.fetched.items() if self.os.path.dirname(v) != self.os.path.join(self.scratch, sub)}
+            self.held.pop(sub, None)
+            self.cond.notify_all()
+        self.shutil.rmtree(self.os.path.join(self.scratch, sub), ignore_errors=True)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.shutil.rmtree(self.scratch, ignore_errors=True)
@@ -0,0 +1,156 @@
+class Publisher():
+
+    # Copies the outputs of a subject from tmp to dataout, in place of one cp
+    # subprocess per file whose failures went unnoticed
+    # - files are copied by a pool of threads with large buffers, so several
+    #   transfers to the NAS are in flight at once
+    # - each file is written to a temporary name next to its destination, checked
+    #   against the checksum of the source and only then renamed into place, so
+    #   dataout never holds half written files
+    # - small files (QA pngs, txt, npy) are copied in batches, one task per batch,
+    #   and all directories are made once up front, so the NAS round trips for
+    #   metadata are fewer than one per file
+    # - a file that is the destination itself (hard linked input) is skipped
+    # - files added with pack=True (uncompressed images of the 'nii' working format,
+    #   see fun/stages.py) are gzip compressed on the way, the checksum is then
+    #   compared on the decompressed copy; gzip_threads is the budget of all the
+    #   files compressed at once, split between them, see fun/pgzip.py
+    #
+    # pub = Publisher(threads=8)
+    # pub.add('tmp/sub/sub_AP_gib_mppca.nii.gz', 'dataout/sub/sub_AP_gib_mppca.nii.gz')
+    # pub.add('tmp/sub/imgs/mrtrix3_mppca', 'dataout/sub/imgs/mrtrix3_mppca') # content of the dir
+    # s, m = pub.run()
+
+    def __init__(self, threads=8, bufsize=16*1024**2, verify=True, small=1024**2, batch=64, level=1, gzip_threads=None):
+
+        import os
+        import gzip
+        import uuid
+        import shutil
+        import hashlib
+        from time import perf_counter
+        from concurrent.futures import ThreadPoolExecutor
+        from fun.pgzip import GzipWriter
+
+        self.os = os
+        self.gzip = gzip
+        self.uuid = uuid
+        self.shutil = shutil
+        self.hashlib = hashlib
+        self.perf_counter = perf_counter
+        self.ThreadPoolExecutor = ThreadPoolExecutor
+        self.GzipWriter = GzipWriter
+
+        self.threads = max(1, int(threads))
+        self.bufsize = bufsize # bytes read and written at once
+        self.verify = verify # read the copy back and compare checksums
+        self.small = small # files smaller than this (bytes) are batched
+        self.batch = batch # small files in one batch
+        self.level = level # gzip level of the packed files, 1 as nibabel writes .nii.gz
+        self.gzip_threads = gzip_threads # threads compressing the packed files in all, None for all cores
+        self.pack_threads = None # threads of each packed file, set by run()
+        self.files = [] # (src, dst, size, pack)
+        self.missing = [] # sources that do not exist
+
+    def add(self, src, dst, pack=False):
+        # A file, or a directory whose content is merged into dst (as cp -r src/. dst)
+        # symlinks are followed, staged inputs are published as files
+        # pack: gzip compress the file on the way, dst is then the .gz name
+        if self.os.path.isdir(src):
+            for root, dirs, files in self.os.walk(src, followlinks=True):
+                for f in files:
+                    s = self.os.path.join(root, f)
+                    self.files.append((s, self.os.path.join(dst, self.os.path.relpath(s, src)), self.os.path.getsize(s), False))
+        elif self.os.path.exists(src):
+            self.files.append((src, dst, self.os.path.getsize(src), pack))
+        else:
+            self.missing.append(src)
+
+    def batches(self):
+        # large files one by one, largest first so they do not end up last; small ones in batches
+        large = sorted([f for f in self.files if f[2] >= self.small], key=lambda f: -f[2])
+        small = [f for f in self.files if f[2] < self.small]
+        out = [[f] for f in large]
+        for i in range(0, len(small), self.batch):
+            out.append(small[i:i+self.batch])
+        return out
+
+    def run(self):
+        # Returns True or False and message with the files, bytes/s and failures
+        if len(self.missing) > 0:
+            return [False, f'publish: missing {", ".join(self.missing)}']
+
+        t0 = self.perf_counter()
+        for d in sorted(set([self.os.path.dirname(f[1]) for f in self.files])):
+            self.os.makedirs(d, exist_ok=True)
+
+        # the packed files copied at once share the gzip threads
+        packed = len([f for f in self.files if f[3]])
+        total = self.gzip_threads if self.gzip_threads is not None else self.os.cpu_count() or 1
+        self.pack_threads = max(1, int(total) // max(1, min(self.threads, packed)))
+
+        failed = []
+        with self.ThreadPoolExecutor(self.threads) as ex:
+            for out in ex.map(self.copy_batch, self.batches()):
+                failed += out
+        dur = self.perf_counter() - t0
+
+        size = sum([f[2] for f in self.files])
+        rate = size / dur / 1024**2 if dur > 0 else 0
+        self.stats = {'files': len(self.files), 'bytes': size, 'seconds': dur, 'MB/s': rate}
+        if len(failed) > 0:
+            return [False, f'publish: {len(failed)} of {len(self.files)} files failed: {"; ".join(failed[:3])}']
+        return [True, f'published {len(self.files)} files, {size/1024**2:0.1f} MB in {dur:0.1f} s, {rate:0.1f} MB/s']
+
+    def copy_batch(self, batch):
+        # Returns the failures of the batch as messages
+        failed = []
+        for src, dst, size, pack in batch:
+            try:
+                self.copy(src, dst, pack)
+            except Exception as e:
+                failed.append(f'{self.os.path.basename(src)}: {e}')
+        return failed
+
+    def copy(self, src, dst, pack=False):
+        if self.os.path.exists(dst) and self.os.path.samefile(src, dst):
+            return
+        tmp = self.os.path.join(self.os.path.dirname(dst), f'.{self.os.path.basename(dst)}.{self.uuid.uuid4().hex[:8]}.part')
+        try:
+            h = self.hashlib.blake2b()
+            with open(src, 'rb') as fi, open(tmp, 'wb') as fo:
+                out = self.GzipWriter(None, self.level, self.pack_threads, fileobj=fo) if pack else fo
+                while True:
+                    buf = fi.read(self.bufsize)
+                    if not buf:
+                        break
+                    h.update(buf)
+                    out.write(buf)
+                if pack:
+                    out.close()
+                fo.flush()
+                self.os.fsync(fo.fileno())
+            if self.verify and self.checksum(tmp, pack) != h.hexdigest():
+                raise IOError('checksum of the copy does not match')
+            self.shutil.copymode(src, tmp)
+            self.os.replace(tmp, dst)
+        finally:
+            if self.os.path.exists(tmp):
+                self.os.remove(tmp)
+
+    def checksum(self, path, packed=False):
+        # packed: checksum of the decompressed content
+        h = self.hashlib.blake2b()
+        with open(path, 'rb') as f:
+            # drop the cached pages, so the copy is read back from the disk, not from memory
+            try:
+                self.os.posix_fadvise(f.fileno(), 0, 0, self.os.POSIX_FADV_DONTNEED)
+            except (AttributeError, OSError):
+                pass
+            r = self.gzip.GzipFile(fileobj=f, mode='rb') if packed else f
+            while True:
+                buf = r.read(self.bufsize)
+                if not buf:
+                    break
+                h.update(buf)
+        return h.hexdigest()
@@ -23,6 +23,7 @@ class QaHtml:
         self.os = os
         self.dt = dt
         self.sh = shutil
+        self.shutil = shutil # used by initialise and add_dwi_gibbs
 
         # The QA directory where all QAs
         self.QaDataDir = QaDataDir
@@ -70,32 +71,32 @@ class QaHtml:
             p.write(self.MainHeader)
             p.write(f'<center><h1>QA {self.SessionName}</h1></center><br><br>\n')
 
-        subs = self.Subs
-        subs.sort()
-        print('subs:' + str(subs))
-        print('self.Subs:' + str(self.Subs))
-        # creates main html page
-        # List of subs is to be divided into sets of IDs of the same leading digits
-        # that is sub-1xxxx and sub-2xxxx will be in different sets
-        l = subs[0][4] # counter from the first digit of the subject number
-        for i, s in enumerate(subs):
-            if i == 0:
-                # first subject, set title
-                p.write(f'\n\n<br><br><center><h3><a id="sub-{l}x">sub-{l}x</a></center></h3><br>\n')
-                p.write(f'  <a href="subs/{s}.html">{s}</a>  \n')
-            else:
-                if not s.startswith(f'sub-{l}'):
-                    # new digit, set title
-                    l = s[4]
+            subs = self.Subs
+            subs.sort()
+            print('subs:' + str(subs))
+            print('self.Subs:' + str(self.Subs))
+            # creates main html page
+            # List of subs is to be divided into sets of IDs of the same leading digits
+            # that is sub-1xxxx and sub-2xxxx will be in different sets
+            l = subs[0][4] # counter from the first digit of the subject number
+            for i, s in enumerate(subs):
+                if i == 0:
+                    # first subject, set title
                     p.write(f'\n\n<br><br><center><h3><a id="sub-{l}x">sub-{l}x</a></center></h3><br>\n')
                     p.write(f'  <a href="subs/{s}.html">{s}</a>  \n')
-                
                 else:
-                    # same digit, continue
-                    p.write(f'  <a href="subs/{s}.html">{s}</a>  \n')
+                    if not s.startswith(f'sub-{l}'):
+                        # new digit, set title
+                        l = s[4]
+                        p.write(f'\n\n<br><br><center><h3><a id="sub-{l}x">sub-{l}x</a></center></h3><br>\n')
+                        p.write(f'  <a href="subs/{s}.html">{s}</a>  \n')
+                
+                    else:
+                        # same digit, continue
+                        p.write(f'  <a href="subs/{s}.html">{s}</a>  \n')
             
-        p.write(self.MainFooter)
-        p.close()
+            p.write(self.MainFooter)
+            p.close()
 
     def create_sub_page(self, Sub):
         # TODO - this must be less specific to dwi - make it more general to other potential sessions
@@ -0,0 +1,173 @@
+class Scheduler():
+
+    # Runs one preprocessing stage for many subjects at the same time
+    # Every subject is processed in a separate worker process with its own
+    # copy of the DwiPreprocessingClab object, the threads set for the
+    # preprocessing (self.threads) are split between the workers.
+    # Outcome of each subject is sent back to the main process and logged there.
+
+    def __init__(self, pp, jobs):
+
+        import os
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        self.pp = pp # DwiPreprocessingClab object
+        self.jobs = max(1, int(jobs)) # number of subjects processed at once
+
+        # threads budget for each subject, -1 means all threads available
+        if pp.threads is None or pp.threads < 1:
+            total = os.cpu_count()
+        else:
+            total = pp.threads
+        self.threads = max(1, total // self.jobs)
+
+        self.executor = ProcessPoolExecutor
+        self.as_completed = as_completed
+
+    def run(self, stage, subs, **kwargs):
+
+        # Submit all subjects, collect the outcomes as they come
+        # Returns list of dicts with sub, status, message and duration (min)
+
+        self.pp.log_info('ALL', f'scheduler: {stage} for {len(subs)} subjects, {self.jobs} jobs with {self.threads} threads each')
+
+        results = []
+        with self.executor(max_workers=self.jobs) as ex:
+            futures = {ex.submit(run_subject, self.pp, stage, sub, self.threads, kwargs): sub for sub in subs}
+            for i, f in enumerate(self.as_completed(futures)):
+                sub = futures[f]
+                try:
+                    s, m, dur = f.result()
+                except Exception as e:
+                    s, m, dur = False, f'{stage}: worker crashed: {e}', 0
+
+                results.append({'sub': sub, 'status': s, 'message': m, 'duration': dur/60})
+
+                if s:
+                    self.pp.log_ok(sub, f'scheduler: {m}, duration {dur/60:0.2f} min')
+                else:
+                    self.pp.log_error(sub, f'scheduler: {m}, duration {dur/60:0.2f} min')
+                print(f'{sub} {i+1} out of {len(subs)} done - {m}')
+
+        return results
+
+
+def run_subject(pp, stage, sub, threads, kwargs):
+
+    # Runs in the worker process
+    # Sets the threads budget for the subject, then runs the single subject
+    # method of the stage, e.g. topup_sub()
+
+    import os
+    from time import perf_counter
+
+    # Libraries that do not take nthreads argument (numpy, sklearn, eddy_openmp)
+    for v in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[v] = str(threads)
+
+    pp.threads = threads
+    pp.telegram = False
+
+    t0 = perf_counter()
+    s, m = getattr(pp, f'{stage}_sub')(sub, **kwargs)
+    return s, m, perf_counter() - t0
+
+
+# Declared resources of the stages, cores used by one subject and peak memory in GB
+# topup is single threaded, the other stages use as many threads as they are given
+# (-nthreads, num_processes, OMP_NUM_THREADS), so cores is the share they get
+PROFILES = {
+    'gibbs': {'cores': 4, 'mem': 4},
+    'mppca': {'cores': 8, 'mem': 8},
+    'patch2self': {'cores': 8, 'mem': 24},
+    'topup': {'cores': 1, 'mem': 2},
+    'eddy': {'cores': 8, 'mem': 8},
+    'pipeline': {'cores': 8, 'mem': 24},
+}
+
+
+class ResourceScheduler():
+
+    # Runs several stages for many subjects, packing jobs from different stages
+    # and subjects onto the machine by their declared cores and memory, so that
+    # e.g. single threaded topup jobs fill the cores left over by eddy.
+    # A job starts only when its cores and memory fit in what is left of the budget.
+    # The stages of a subject run in the order given, a failed stage stops the
+    # remaining stages of that subject. Later stages go first, so subjects are
+    # finished instead of all of them being started.
+
+    def __init__(self, pp, cores, mem, profiles=None):
+
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+        self.pp = pp # DwiPreprocessingClab object
+        self.cores = max(1, int(cores)) # cores budget
+        self.mem = mem # memory budget in GB
+
+        self.profiles = dict(PROFILES)
+        if profiles is not None:
+            self.profiles.update(profiles)
+
+        self.executor = ProcessPoolExecutor
+        self.wait = wait
+        self.first_completed = FIRST_COMPLETED
+
+    def need(self, stage):
+        # cores and memory of a job, capped at the budget so every job can run
+        p = self.profiles[stage]
+        return min(p['cores'], self.cores), min(p['mem'], self.mem)
+
+    def run(self, stages, subs, **kwargs):
+
+        # Returns list of dicts with sub, stage, status, message and duration (min)
+
+        self.pp.log_info('ALL', f'scheduler: {" -> ".join(stages)} for {len(subs)} subjects, budget {self.cores} cores and {self.mem:0.1f} GB')
+        for s in stages:
+            self.pp.log_info('ALL', f'scheduler: {s} profile {self.profiles[s]}')
+
+        pending = {sub: list(stages) for sub in subs} # stages left for each subject
+        running = {} # future: (sub, stage, cores, mem)
+        free_cores, free_mem = self.cores, self.mem
+        results = []
+
+        with self.executor(max_workers=self.cores) as ex:
+            while len(pending) > 0 or len(running) > 0:
+
+                # start whatever fits, later stages first, then in the order of the list
+                busy = [v[0] for v in running.values()]
+                ready = [sub for sub in pending if sub not in busy]
+                ready.sort(key=lambda sub: -stages.index(pending[sub][0]))
+                for sub in ready:
+                    stage = pending[sub][0]
+                    c, m = self.need(stage)
+                    if c <= free_cores and m <= free_mem:
+                        f = ex.submit(run_subject, self.pp, stage, sub, c, kwargs)
+                        running[f] = (sub, stage, c, m)
+                        free_cores -= c
+                        free_mem -= m
+
+                done, __ = self.wait(list(running.keys()), return_when=self.first_completed)
+                for f in done:
+                    sub, stage, c, m = running.pop(f)
+                    free_cores += c
+                    free_mem += m
+                    try:
+                        s, msg, dur = f.result()
+                    except Exception as e:
+                        s, msg, dur = False, f'{stage}: worker crashed: {e}', 0
+
+                    results.append({'sub': sub, 'stage': stage, 'status': s, 'message': msg, 'duration': dur/60})
+
+                    if s:
+                        self.pp.log_ok(sub, f'scheduler: {msg}, duration {dur/60:0.2f} min')
+                        pending[sub].pop(0)
+                    else:
+                        self.pp.log_error(sub, f'scheduler: {msg}, duration {dur/60:0.2f} min')
+                        if len(pending[sub]) > 1:
+                            self.pp.log_warning(sub, f'scheduler: {stage} failed, skipping {pending[sub][1:]}')
+                        pending[sub] = []
+                    if len(pending[sub]) == 0:
+                        del pending[sub]
+                    print(f'{sub} {stage} done - {msg}, {len(pending)} subjects left')
+
+        return results
@@ -0,0 +1,124 @@
+# Noise sigma of each volume of several images at once, the estimate of dipy's
+# estimate_sigma (Coupe 2008, with the coil correction of Koay 2006) without its
+# per call overhead:
+# - the 6 neighbour sum is taken by adding shifted views of the volume, edges
+#   reflected as scipy.ndimage.convolve does, instead of a generic 3x3x3 convolution
+# - the volumes of all the images given go to one thread pool, numpy lets go of
+#   the GIL, each thread works in its own buffers of one volume
+# - a volume is read as it is stored (int16, float32, memory mapped), only the
+#   buffers are in the type of the computation
+# With dtype='float64' the sigmas are those of estimate_sigma, the arrays saved
+# under sigma_noise/ do not change; 'float32' halves the buffers and is faster,
+# the sigmas differ by ~1e-6 relative.
+# With a mask (3D bool, e.g. the brain of fun/masks.py) the mean is taken over
+# the voxels of the mask only, and only the box around the mask is read, about
+# half of the field of view for a brain mask.
+#
+# s_ap_raw, s_pa_raw = estimate_sigmas([ap_raw, pa_raw], N=32, threads=8)
+# s_ap_brain, = estimate_sigmas([ap_raw], N=32, mask=brain)
+
+# Koay 2006, bias of the magnitude image for N coils, as in dipy
+CORRECTION = {0: 1, 1: 0.42920367320510366, 4: 0.4834941393603609, 6: 0.4891759468548269, \
+    8: 0.49195420135894175, 12: 0.4946862482541263, 16: 0.4960339908122364, 20: 0.4968365823718557, \
+    24: 0.49736907650825657, 32: 0.49803177052530145, 64: 0.49901964176235936}
+
+
+def neighbour_sum(vol, out):
+    # Sum of the 6 face neighbours of each voxel of a 3D volume, written to out
+    # outside the volume the edge voxel is repeated (mode 'reflect' of scipy)
+    out[...] = 0
+    for ax in range(3):
+        n = vol.shape[ax]
+        def sl(a, b):
+            s = [slice(None)] * 3
+            s[ax] = slice(a, b)
+            return tuple(s)
+        if n == 1:
+            out += 2 * vol
+            continue
+        out[sl(1, None)] += vol[sl(None, -1)] # neighbour before
+        out[sl(None, -1)] += vol[sl(1, None)] # neighbour after
+        out[sl(0, 1)] += vol[sl(0, 1)] # reflected at the edges
+        out[sl(-1, None)] += vol[sl(-1, None)]
+    return out
+
+
+def mask_box(mask):
+    # Slices of the box around the voxels of the mask, one voxel wider so that
+    # their neighbours are in it; a mask without voxels gives an empty box
+    import numpy as np
+    ijk = np.nonzero(mask)
+    if len(ijk[0]) == 0:
+        return tuple(slice(0, 0) for n in mask.shape)
+    return tuple(slice(max(0, int(i.min()) - 1), min(n, int(i.max()) + 2)) for i, n in zip(ijk, mask.shape))
+
+
+def estimate_sigmas(stacks, N=0, threads=None, dtype='float64', mask=None):
+
+    # Sigma of each volume of each 3D or 4D image in stacks, a list of float32
+    # arrays as estimate_sigma gives them, in the order of stacks
+    # N: coils of the receiver (0 no correction); threads: None for all cores
+    # mask: 3D bool of the shape of the volumes, the voxels the sigma is taken
+    # over, None for all of them
+
+    import os
+    import threading
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+
+    if N not in CORRECTION:
+        raise ValueError(f'N = {N} is not supported! Please choose amongst {sorted(CORRECTION.keys())}')
+    factor = CORRECTION[N]
+
+    stacks = [s if s.ndim == 4 else s[..., None] for s in stacks]
+    for s in stacks:
+        if s.ndim != 4:
+            raise ValueError('Array shape is not supported!', s.shape)
+    out = [np.zeros(s.shape[-1], dtype=np.float32) for s in stacks]
+    jobs = [(i, v) for i, s in enumerate(stacks) for v in range(s.shape[-1])]
+
+    box = (slice(None),) * 3
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        for s in stacks:
+            if s.shape[:3] != mask.shape:
+                raise ValueError('Mask shape does not match the volumes!', mask.shape, s.shape)
+        if not mask.any():
+            raise ValueError('Mask has no voxels!')
+        # inside the box the voxels of the mask are at least one voxel from its
+        # sides, or at the sides of the volume, the neighbour sums are those of the
+        # whole volume; the mean over the mask is a dot product with its weights
+        box = mask_box(mask)
+        weights = mask[box].ravel().astype(dtype)
+        n = weights.sum()
+
+    local = threading.local()
+    def one(job):
+        i, v = job
+        vol = stacks[i][box + (v,)]
+        # buffers of the thread, made again only for a volume of another shape
+        if getattr(local, 'shape', None) != vol.shape:
+            local.shape = vol.shape
+            local.x = np.empty(vol.shape, dtype=dtype)
+            local.c = np.empty(vol.shape, dtype=dtype)
+        x, c = local.x, local.c
+        x[...] = vol
+        neighbour_sum(x, c)
+        # sqrt(6/7) * (x - sum/6), the mean of its square over the volume
+        c *= -1 / 6
+        c += x
+        c *= np.sqrt(6 / 7)
+        np.square(c, out=c)
+        if mask is None:
+            out[i][v] = np.sqrt(np.mean(c) / factor)
+        else:
+            out[i][v] = np.sqrt(np.dot(c.ravel(), weights) / n / factor)
+
+    threads = max(1, int(threads if threads is not None else os.cpu_count() or 1))
+    if threads == 1 or len(jobs) == 1:
+        for j in jobs:
+            one(j)
+    else:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(one, jobs))
+    return out
@@ -0,0 +1,185 @@
+class Spans():
+
+    # Nested timing spans written as json lines, one line per finished span
+    # stage -> subject -> step -> command (or file read/write)
+    #
+    # {"id": ..., "parent": ..., "kind": "step", "name": "estimate sigma", "path": "mrtrix3_mppca/estimate sigma",
+    #  "sub": "sub-xxxxx", "start": "2022-05-01 10:00:00.000000", "dur": 12.3, "status": "ok", "host": ..., "pid": ...}
+    # path joins the names of the enclosing spans (without the stage), so the same
+    # step of different stages, e.g. qa, is kept apart in the summary
+    #
+    # Spans are opened with start() and closed with end(), or with the span() context
+    # manager, the open spans of each thread are kept on a stack so every span knows
+    # its parent. Spans of commands run concurrently are written with record().
+    # Lines are appended to the file by many processes at once (run_parallel,
+    # run_queue), each line is written in one call so they do not mix.
+    # path None disables the spans.
+
+    def __init__(self, path):
+
+        import os
+        import json
+        import uuid
+        import socket
+        import threading
+        from time import perf_counter
+        from datetime import datetime as dt
+
+        self.os = os
+        self.json = json
+        self.uuid = uuid
+        self.perf_counter = perf_counter
+        self.dt = dt
+        self.threading = threading
+
+        self.path = path
+        self.host = socket.gethostname()
+        self.local = threading.local() # stack of open spans, per thread
+
+    def __getstate__(self):
+        # modules and the thread local stack cannot be pickled, open spans stay in the parent process
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        # id of the innermost open span, None if there is none
+        s = self.stack()
+        return s[-1]['id'] if len(s) > 0 else None
+
+    def where(self, name):
+        # path of a span opened inside the innermost span
+        s = self.stack()
+        if len(s) == 0 or s[-1]['kind'] == 'stage':
+            return name
+        return f'{s[-1]["path"]}/{name}'
+
+    def start(self, kind, name, sub=None, **attrs):
+        # Opens a span inside the current one, returns its id
+        # sub is taken from the enclosing span if not given
+        if sub is None and len(self.stack()) > 0:
+            sub = self.stack()[-1]['sub']
+        span = {'id': self.uuid.uuid4().hex[:16], 'parent': self.current(), 'kind': kind, 'name': name, \
+            'path': self.where(name), 'sub': sub, 'start': self.dt.now(), 't0': self.perf_counter(), 'attrs': attrs}
+        self.stack().append(span)
+        return span['id']
+
+    def end(self, kind=None, status='ok', **attrs):
+        # Closes the innermost span, or the innermost span of the given kind
+        # together with the spans left open inside it, e.g. the last step of a subject
+        s = self.stack()
+        if kind is not None and kind not in [span['kind'] for span in s]:
+            return
+        while len(s) > 0:
+            span = s.pop()
+            last = kind is None or span['kind'] == kind
+            if last:
+                span['attrs'].update(attrs)
+            self.write(span, self.perf_counter() - span['t0'], status)
+            if last:
+                break
+
+    def next(self, kind, name, sub=None, **attrs):
+        # Closes the innermost span if it is of the same kind and opens the next one,
+        # for steps marked one after another without a with block
+        s = self.stack()
+        if len(s) > 0 and s[-1]['kind'] == kind:
+            self.end()
+        return self.start(kind, name, sub, **attrs)
+
+    def span(self, kind, name, sub=None, **attrs):
+        # with spans.span('step', 'load', sub): ...
+        return _Span(self, kind, name, sub, attrs)
+
+    def record(self, kind, name, sub, start, dur, parent=None, path=None, status='ok', **attrs):
+        # Writes a span timed elsewhere, e.g. a command run by CmdRunner
+        # parent and path of the span it belongs to, as returned by current() and where()
+        self.write({'id': self.uuid.uuid4().hex[:16], 'parent': parent, 'kind': kind, 'name': name, \
+            'path': name if path is None else path, 'sub': sub, 'start': start, 'attrs': attrs}, dur, status)
+
+    def write(self, span, dur, status):
+        if self.path is None:
+            return
+        rec = {'id': span['id'], 'parent': span['parent'], 'kind': span['kind'], 'name': span['name'], \
+            'path': span['path'], 'sub': span['sub'], 'start': span['start'].strftime('%Y-%m-%d %H:%M:%S.%f'), 'dur': round(dur, 4), \
+            'status': status, 'host': self.host, 'pid': self.os.getpid()}
+        rec.update(span['attrs'])
+        try:
+            with open(self.path, 'a') as f:
+                f.write(self.json.dumps(rec, default=str) + '\n')
+        except:
+            # timing must never stop the processing
+            pass
+
+
+class _Span():
+
+    # Context manager returned by Spans.span()
+
+    def __init__(self, spans, kind, name, sub, attrs):
+        self.spans = spans
+        self.args = (kind, name, sub)
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.spans.start(*self.args, **self.attrs)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.spans.end(self.args[0], 'ok' if exc_type is None else 'error')
+        return False
+
+
+class Timed():
+
+    # Wraps a function so every call is a span, e.g. load_nifti and save_nifti
+    # Picklable, so it can be mounted on DwiPreprocessingClab
+
+    def __init__(self, spans, kind, name, func):
+        self.spans = spans
+        self.kind = kind
+        self.name = name
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        with self.spans.span(self.kind, self.name, file=str(args[0]) if len(args) > 0 else None):
+            return self.func(*args, **kwargs)
+
+
+def summarise(paths, kinds=None):
+
+    # Per step statistics across the cohort from one or more span files
+    # Returns list of dicts with kind, path, n, failed, median, p95, max and total (s),
+    # sorted by total time, the steps that cost the most come first
+
+    import json
+    import numpy as np
+
+    durs = {}
+    failed = {}
+    for p in paths:
+        with open(p) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue # line cut by a killed process
+                if kinds is not None and rec['kind'] not in kinds:
+                    continue
+                k = (rec['kind'], rec.get('path', rec['name']))
+                durs.setdefault(k, []).append(rec['dur'])
+                failed[k] = failed.get(k, 0) + (rec['status'] != 'ok')
+
+    out = []
+    for (kind, path), d in durs.items():
+        d = np.array(d)
+        out.append({'kind': kind, 'path': path, 'n': len(d), 'failed': failed[(kind, path)], \
+            'median': float(np.median(d)), 'p95': float(np.percentile(d, 95)), \
+            'max': float(d.max()), 'total': float(d.sum())})
+    return sorted(out, key=lambda r: r['total'], reverse=True)
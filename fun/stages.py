@@ -0,0 +1,115 @@
+# Declared inputs and outputs of the preprocessing stages in main.py
+# File names are suffixes of the subject id, e.g. '_AP_gib.nii.gz' is
+# sub-xxxxx_AP_gib.nii.gz in tmp/sub-xxxxx. Glob patterns are allowed.
+# Names without a leading underscore are directories inside tmp/sub-xxxxx.
+#
+# inputs:  files the stage reads
+# outputs: files the stage creates
+# qa:      control plots and noise estimates, always published
+# keep:    small outputs that are worth keeping even if a later stage consumes them
+
+STAGES = {
+    'gibbs': {
+        'inputs': [], # raw data comes from datain, see cp_rawdata()
+        'outputs': ['_AP.nii', '_PA.nii', '_AP.json', '_PA.json', '_AP.bval', '_AP.bvec', \
+            '_AP_gib.nii.gz', '_PA_gib.nii.gz'],
+        'qa': ['imgs/gibbs'],
+        'keep': ['_AP.json', '_PA.json', '_AP.bval', '_AP.bvec'],
+    },
+    'mppca': {
+        'inputs': ['_AP_gib.nii.gz', '_PA_gib.nii.gz', '_AP.nii', '_PA.nii', '_AP.bval', '_AP.bvec'],
+        'outputs': ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz'],
+        'qa': ['imgs/mrtrix3_mppca', 'sigma_noise'],
+        'keep': [],
+    },
+    'patch2self': {
+        'inputs': ['_AP.bval', '_AP.bvec', '_AP_gib.nii.gz', '_PA_gib.nii.gz', '_AP.json', '_AP.nii', '_PA.nii'],
+        'outputs': ['_AP_p2s.nii.gz', '_PA_p2s.nii.gz', '_AP_b0mask.npy'],
+        'qa': ['imgs/patch2self', 'sigma_noise'],
+        'keep': [],
+    },
+    'topup': {
+        'inputs': ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz', '_AP.json', '_PA.json', '_AP.bval', '_AP.bvec'],
+        'outputs': ['_AP_gib_mppca_b0s.nii.gz', '_PA_gib_mppca_b0s.nii.gz', '_gib_mppca_b0s.nii.gz', \
+            '_acqparams.txt', '_topup_results_fieldcoef.nii.gz', '_topup_results_movpar.txt', '_b0_corrected.nii.gz'],
+        'qa': ['imgs/topup'],
+        'keep': ['_acqparams.txt', '_topup_results_fieldcoef.nii.gz', '_topup_results_movpar.txt'],
+    },
+    'eddy': {
+        'inputs': ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz', '_gib_mppca_b0s.nii.gz', '_AP.json', '_PA.json', \
+            '_AP.bval', '_AP.bvec', '_topup_results_movpar.txt', '_topup_results_fieldcoef.nii.gz', \
+            '_acqparams.txt', '_b0_corrected.nii.gz'],
+        'outputs': ['_b0_.nii.gz', '_index.txt', '_dwi.*', '_eddy_qc', 'bmasks'],
+        'qa': ['imgs/bmask'],
+        'keep': [],
+    },
+}
+
+
+class StageGraph():
+
+    # Chain of stages run for one subject in a single tmp workspace
+    # Works out which files have to be fetched from the derivatives, which
+    # are passed between the stages in tmp and which are published at the end
+
+    def __init__(self, steps):
+
+        self.steps = list(steps)
+
+    def check(self):
+        # Returns True if the chain can be run, False with a message if not
+
+        for s in self.steps:
+            if s not in STAGES:
+                return [False, f'Unknown stage {s}, allowed stages are {list(STAGES.keys())}']
+        if len(set(self.steps)) != len(self.steps):
+            return [False, f'Stages can be run only once in the pipeline: {self.steps}']
+        if 'gibbs' in self.steps and self.steps[0] != 'gibbs':
+            return [False, 'gibbs copies the raw data, it has to be the first stage in the pipeline']
+        return [True, f'Pipeline: {" -> ".join(self.steps)}']
+
+    def produced_before(self, step):
+        # Outputs of all stages that run before the given one
+        out = []
+        for s in self.steps[:self.steps.index(step)]:
+            out += STAGES[s]['outputs']
+        return out
+
+    def fetch(self, step):
+        # Inputs of the stage that are not made by an earlier stage of the chain
+        # these have to be copied in from the derivatives
+        made = self.produced_before(step)
+        return [f for f in STAGES[step]['inputs'] if f not in made]
+
+    def publish(self, intermediates=False):
+        # Everything that should go to dataout after the chain has finished:
+        # qa of each stage, small files worth keeping and all outputs of the last stage
+        # intermediates=True also publishes the outputs passed between the stages
+        items = []
+        for s in self.steps:
+            items += STAGES[s]['qa'] + STAGES[s]['keep']
+            if intermediates or s == self.steps[-1]:
+                items += STAGES[s]['outputs']
+        # keep order, drop duplicates (sigma_noise is shared by both denoisers)
+        return list(dict.fromkeys(items))
+
+
+# Working format of the images in tmp, see DwiPreprocessingClab.work()
+# 'nii.gz': as they are published
+# 'nii': uncompressed, so loading them maps the file into memory instead of
+#        decompressing it, they are compressed only when published to dataout
+
+def work_name(name, fmt):
+    # Name of an image in tmp in the working format
+    if fmt == 'nii' and name.endswith('.nii.gz'):
+        return name[:-len('.gz')]
+    return name
+
+
+def published_name(name):
+    # Name in dataout of a file written in tmp in the 'nii' working format
+    # the uncompressed images declared by the stages (the raw data) stay as they are
+    declared = [f for s in STAGES.values() for f in s['inputs'] + s['outputs'] if f.endswith('.nii')]
+    if name.endswith('.nii') and not any([name.endswith(f) for f in declared]):
+        return name + '.gz'
+    return name
@@ -0,0 +1,87 @@
+def stage_file(src, dst, readonly=True, methods=None):
+
+    # Puts src at dst in the cheapest way that is safe, instead of always copying
+    # the multi-hundred MB inputs of a stage into tmp
+    #   link: hard link, when src and tmp are on the same filesystem, takes no space
+    #   reflink: copy on write clone (btrfs, xfs, ...), shares the blocks until written
+    #   symlink: absolute link to src, the stage reads the file where it is
+    #   copy: plain copy, when nothing else works
+    # readonly: the stage only reads the file; a hard link or a symlink shares the
+    # file itself, so writing to it would change src, files that are written get
+    # a reflink or a copy only
+    # methods: order to try, defaults to METHODS or WRITABLE
+    # dst is replaced if it exists
+    # Returns the method used, raises OSError if even the copy fails
+
+    import os
+    import shutil
+
+    if methods is None:
+        methods = METHODS if readonly else WRITABLE
+    if not readonly:
+        methods = [m for m in methods if m in WRITABLE]
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    for m in methods:
+        try:
+            if m == 'link':
+                os.link(src, dst)
+            elif m == 'reflink':
+                reflink(src, dst)
+            elif m == 'symlink':
+                os.symlink(os.path.realpath(src), dst)
+            else:
+                shutil.copyfile(src, dst)
+            return m
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+    raise OSError(f'could not stage {src} to {dst}')
+
+
+# cheapest first; files that may be written are never linked
+METHODS = ['link', 'reflink', 'symlink', 'copy']
+WRITABLE = ['reflink', 'copy']
+
+
+def reflink(src, dst):
+
+    # Clone src to dst with the FICLONE ioctl (linux btrfs, xfs with reflink=1,
+    # ...), raises OSError where cloning is not supported, e.g. across filesystems
+
+    import os
+    import fcntl
+
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, FICLONE, s.fileno())
+        except OSError:
+            os.close(fd)
+            os.remove(dst)
+            raise
+        os.close(fd)
+
+
+def unpack(src, dst, bufsize=16*1024**2):
+
+    # Decompresses a .nii.gz input to an uncompressed .nii in tmp, once, for the
+    # 'nii' working format, see fun/stages.py; written to a temporary name and
+    # renamed, so dst is never half written
+
+    import os
+    import gzip
+    import shutil
+
+    tmp = dst + '.part'
+    try:
+        with gzip.open(src, 'rb') as fi, open(tmp, 'wb') as fo:
+            shutil.copyfileobj(fi, fo, bufsize)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return 'unpacked'
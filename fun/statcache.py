@@ -0,0 +1,138 @@
+class StatCache():
+
+    # Statistics derived from an image or a text file (noise sigma of each volume,
+    # b0 mask of the bvals), stored under the sha1 of the content of the file, so a
+    # stage reading the same file again, or the same file staged by another stage,
+    # gets them without going over the data.
+    # - <dir>/<sha1>_<kind>.npy holds the statistic, kind names it and its
+    #   parameters, e.g. 'sigma_N32_float64_float64', see sigma_kind()
+    # - the sha1 of a file is kept under its path, size and mtime, a file is hashed
+    #   again only when one of these changes (as in fun/manifest.py)
+    # - every entry is a file of its own, written to a tmp name and renamed, so the
+    #   workers of run_parallel can share the directory
+    #
+    # stats = StatCache('tmp/.stats')
+    # sigma = stats.get(path, 'sigma_N32_float64_float64')   # None if not known
+    # stats.put(path, 'sigma_N32_float64_float64', sigma)
+
+    def __init__(self, path):
+
+        import os
+        import hashlib
+        import numpy as np
+
+        self.os = os
+        self.hashlib = hashlib
+        self.np = np
+
+        self.path = os.path.abspath(path)
+        self.hashes = {} # (path, size, mtime): sha1, of this process
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def __getstate__(self):
+        # Sent to worker processes with DwiPreprocessingClab, without the modules
+        state = self.__dict__.copy()
+        for k in ['os', 'hashlib', 'np']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        import os
+        import hashlib
+        import numpy as np
+        self.__dict__.update(state)
+        self.os = os
+        self.hashlib = hashlib
+        self.np = np
+
+    def sha1(self, path):
+        # sha1 of the content of the file, from the memo if its size and mtime are the same
+        path = self.os.path.abspath(path)
+        st = self.os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        if key in self.hashes:
+            return self.hashes[key]
+        memo = self.os.path.join(self.path, 'paths', self.hashlib.sha1(repr(key).encode()).hexdigest())
+        try:
+            with open(memo) as f:
+                h = f.read().strip()
+        except OSError:
+            d = self.hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    d.update(chunk)
+            h = d.hexdigest()
+            self.os.makedirs(self.os.path.dirname(memo), exist_ok=True)
+            self.write(memo, lambda f: f.write(h.encode()))
+        self.hashes[key] = h
+        return h
+
+    def file(self, path, kind):
+        return self.os.path.join(self.path, f'{self.sha1(path)}_{kind}.npy')
+
+    def get(self, path, kind):
+        # The statistic of the content of path, None if it has not been stored
+        try:
+            v = self.np.load(self.file(path, kind))
+            self.hits += 1
+            return v
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+    def put(self, path, kind, value):
+        try:
+            self.write(self.file(path, kind), lambda f: self.np.save(f, value))
+        except OSError:
+            pass # not stored, it is computed again next time
+
+    def write(self, path, func):
+        tmp = f'{path}.{self.os.getpid()}.part'
+        with open(tmp, 'wb') as f:
+            func(f)
+        self.os.replace(tmp, path)
+
+    def report(self):
+        # Message with the statistics reused and computed since the last report
+        m = f'stat cache: {self.hits} reused, {self.misses} computed'
+        self.hits = 0
+        self.misses = 0
+        return m
+
+
+def sigma_kind(n_coils, data_dtype, dtype):
+    # Name of the noise sigma in the cache, the estimate depends on the coils, on the
+    # type the image was loaded as (None: float64 of load_nifti) and computed in
+    return f'sigma_N{n_coils}_{data_dtype or "float64"}_{dtype}'
+
+
+def cached_sigmas(stats, paths, stacks, N, threads=None, dtype='float64', data_dtype=None, mask=None):
+
+    # estimate_sigmas of fun/sigma.py for stacks, the images of paths (None for an
+    # array that is not the content of a file), taking the sigmas of the files seen
+    # before from stats (None: no cache) and storing the new ones
+    # data_dtype: type the images were loaded as, see compute_dtype
+    # mask: voxels the sigmas are taken over, None for all, see fun/masks.py
+
+    import hashlib
+    import numpy as np
+    from fun.sigma import estimate_sigmas
+
+    if stats is None:
+        return estimate_sigmas(stacks, N, threads, dtype, mask)
+    kind = sigma_kind(N, data_dtype, dtype)
+    if mask is not None:
+        # the sigmas over a mask are kept under the content of the mask as well
+        mask = np.asarray(mask, dtype=bool)
+        kind += '_mask' + hashlib.sha1(repr(mask.shape).encode() + np.packbits(mask).tobytes()).hexdigest()[:12]
+    out = [stats.get(p, kind) if p is not None else None for p in paths]
+    todo = [i for i, o in enumerate(out) if o is None]
+    if len(todo) > 0:
+        new = estimate_sigmas([stacks[i] for i in todo], N, threads, dtype, mask)
+        for i, s in zip(todo, new):
+            out[i] = s
+            if paths[i] is not None:
+                stats.put(paths[i], kind, s)
+    return out
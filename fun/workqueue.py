@@ -0,0 +1,265 @@
+class LeaseLost(Exception):
+
+    # Raised in a worker whose lease was taken over, see DwiPreprocessingClab.log_step()
+
+    pass
+
+
+class WorkQueue():
+
+    # Queue of subjects kept on a shared filesystem, so that workers on any number
+    # of machines can take the next subject without a server or a split of the list.
+    #
+    # queue_dir/<stage>/leases/<sub>  - subject taken by a worker, the file is made
+    #                                   with O_EXCL so only one worker gets it
+    # queue_dir/<stage>/done/<sub>    - subject completed
+    # queue_dir/<stage>/failed/<sub>  - subject failed, not taken again unless retry_failed
+    #
+    # While a subject is processed its lease is renewed (mtime touched) every `renew`
+    # seconds by a background thread. A lease not renewed for `ttl` seconds belongs
+    # to a dead worker; it is moved aside with an atomic rename (only one worker
+    # can win that) and the subject is taken again. A lease that turns out to be
+    # fresh once moved (taken again in the meantime) is put back.
+    # Each lease holds the owner and a token of its own; a worker renews, releases
+    # and removes only the leases whose token is its own, and a subject whose lease
+    # was taken over is lost: lost(sub) is True and it is not marked done or failed.
+
+    def __init__(self, queue_dir, stage, subs, ttl=900, renew=60, retry_failed=False):
+
+        import os
+        import json
+        import time
+        import uuid
+        import socket
+        import threading
+        from datetime import datetime as dt
+
+        self.os = os
+        self.json = json
+        self.time = time
+        self.uuid = uuid
+        self.dt = dt
+        self.threading = threading
+
+        self.dir = os.path.join(queue_dir, stage)
+        self.subs = list(subs)
+        self.ttl = ttl # seconds after which a lease that was not renewed is stale
+        self.renew = renew # seconds between renewals of the leases held
+        self.retry_failed = retry_failed
+
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.held = [] # subjects leased by this worker
+        self.tokens = {} # token of the lease of each subject held
+        self.lost_subs = set() # subjects whose lease was taken over
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.heart = None
+
+        for d in ['leases', 'done', 'failed']:
+            os.makedirs(os.path.join(self.dir, d), exist_ok=True)
+
+    def path(self, kind, sub):
+        return self.os.path.join(self.dir, kind, sub)
+
+    def finished(self, sub):
+        if self.os.path.exists(self.path('done', sub)):
+            return True
+        return (not self.retry_failed) and self.os.path.exists(self.path('failed', sub))
+
+    def try_lease(self, sub):
+        # Returns True if the lease was created by this worker
+        try:
+            fd = self.os.open(self.path('leases', sub), self.os.O_CREAT | self.os.O_EXCL | self.os.O_WRONLY)
+        except FileExistsError:
+            return False
+        token = self.uuid.uuid4().hex
+        with self.os.fdopen(fd, 'w') as f:
+            self.json.dump({'owner': self.owner, 'token': token, 'since': self.dt.now().strftime('%Y-%m-%d %H:%M:%S')}, f)
+        with self.lock:
+            self.tokens[sub] = token
+            self.lost_subs.discard(sub)
+        return True
+
+    def token(self, path):
+        # Token of a lease file, None if it is gone or cannot be read (being written)
+        try:
+            with open(path) as f:
+                return self.json.load(f).get('token')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def owns(self, sub):
+        # True if the lease of the subject is the one this worker made
+        with self.lock:
+            token = self.tokens.get(sub)
+        return token is not None and self.token(self.path('leases', sub)) == token
+
+    def lost(self, sub):
+        with self.lock:
+            return sub in self.lost_subs
+
+    def reclaim(self, sub):
+        # Move a stale lease aside, returns True if this worker did it
+        lease = self.path('leases', sub)
+        try:
+            age = self.time.time() - self.os.stat(lease).st_mtime
+        except FileNotFoundError:
+            return True # released in the meantime
+        if age < self.ttl:
+            return False
+        stale = f'{lease}.stale.{self.owner.replace(":", "-")}'
+        try:
+            self.os.rename(lease, stale)
+        except FileNotFoundError:
+            return False # another worker got there first
+        # between the stat and the rename another worker may have reclaimed the
+        # stale lease and taken a fresh one, which was moved here instead; the
+        # rename keeps the mtime, put a fresh lease back (link: only if the place is
+        # still free) and leave the subject to its owner
+        try:
+            fresh = self.time.time() - self.os.stat(stale).st_mtime < self.ttl
+        except FileNotFoundError:
+            return False
+        if fresh:
+            try:
+                self.os.link(stale, lease)
+            except FileExistsError:
+                pass
+            self.os.remove(stale)
+            return False
+        self.os.remove(stale)
+        return True
+
+    def claim(self):
+        # Next subject for this worker, None when there is nothing left to take
+        for sub in self.subs:
+            if self.finished(sub):
+                continue
+            if self.try_lease(sub) or (self.reclaim(sub) and self.try_lease(sub)):
+                # it may have been completed between the check and the lease
+                if self.finished(sub):
+                    self.drop(sub)
+                    continue
+                with self.lock:
+                    self.held.append(sub)
+                self.start_heartbeat()
+                return sub
+        return None
+
+    def drop(self, sub):
+        # Forget the subject and remove its lease if it is still the one of this worker
+        owned = self.owns(sub)
+        with self.lock:
+            if sub in self.held:
+                self.held.remove(sub)
+            self.tokens.pop(sub, None)
+        if owned:
+            try:
+                self.os.remove(self.path('leases', sub))
+            except FileNotFoundError:
+                pass
+        return owned
+
+    def release(self, sub, status, message=''):
+        # Mark the subject as done or failed and drop the lease
+        # Returns False, and marks nothing, if the lease was taken over by another worker
+        if self.lost(sub) or not self.owns(sub):
+            with self.lock:
+                self.lost_subs.add(sub)
+            self.drop(sub)
+            return False
+        kind = 'done' if status else 'failed'
+        with open(self.path(kind, sub), 'w') as f:
+            self.json.dump({'owner': self.owner, 'date': self.dt.now().strftime('%Y-%m-%d %H:%M:%S'), 'message': message}, f)
+        if status and self.os.path.exists(self.path('failed', sub)):
+            self.os.remove(self.path('failed', sub))
+        self.drop(sub)
+        return True
+
+    def start_heartbeat(self):
+        if self.heart is None or not self.heart.is_alive():
+            self.stop.clear()
+            self.heart = self.threading.Thread(target=self.heartbeat, daemon=True)
+            self.heart.start()
+
+    def heartbeat(self):
+        # Renew the leases held until stop is set
+        while not self.stop.wait(self.renew):
+            with self.lock:
+                held = list(self.held)
+            for sub in held:
+                if self.owns(sub):
+                    try:
+                        self.os.utime(self.path('leases', sub))
+                        continue
+                    except FileNotFoundError:
+                        pass
+                # taken over as stale, e.g. the machine was suspended for longer than ttl
+                with self.lock:
+                    self.lost_subs.add(sub)
+                    if sub in self.held:
+                        self.held.remove(sub)
+                print(f'Lease for {sub} lost')
+
+    def close(self):
+        self.stop.set()
+        if self.heart is not None:
+            self.heart.join()
+
+    def status(self):
+        # Number of subjects done, failed, leased and waiting
+        done = len([s for s in self.subs if self.os.path.exists(self.path('done', s))])
+        failed = len([s for s in self.subs if self.os.path.exists(self.path('failed', s)) and not self.os.path.exists(self.path('done', s))])
+        leased = len([s for s in self.subs if self.os.path.exists(self.path('leases', s))])
+        return {'done': done, 'failed': failed, 'leased': leased, 'waiting': len(self.subs) - done - failed - leased}
+
+
+def drain(pp, queue_dir, stage, ttl, threads, kwargs):
+
+    # Worker loop, takes subjects from the queue until it is empty
+    # Runs in the calling process or in a worker process of run_queue()
+    # Returns list of dicts with sub, status, message and duration (min)
+
+    import os
+    from time import perf_counter
+
+    if threads is not None:
+        for v in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ[v] = str(threads)
+        pp.threads = threads
+
+    q = WorkQueue(queue_dir, stage, pp.subs, ttl=ttl, renew=max(1, ttl // 15))
+    # a subject whose lease is lost stops at its next step, see log_step()
+    pp.lease_lost = q.lost
+    results = []
+    try:
+        while True:
+            sub = q.claim()
+            if sub is None:
+                break
+            pp.log_info(sub, f'queue: {stage} taken by {q.owner}')
+            t0 = perf_counter()
+            try:
+                s, m = getattr(pp, f'{stage}_sub')(sub, **kwargs)
+            except Exception as e:
+                # a stage that raised (or lost its lease, LeaseLost) did not end its
+                # subject: close the span left open and free the images it held
+                pp.spans.end('subject', 'error')
+                pp.release_arrays(sub)
+                s, m = False, f'{stage}: {e}'
+            dur = perf_counter() - t0
+            if not q.release(sub, s, m):
+                # taken over by another worker, which marks it done or failed
+                pp.log_warning(sub, f'queue: lease lost, {sub} left to the worker that took it over, duration {dur/60:0.2f} min')
+                results.append({'sub': sub, 'status': False, 'message': f'{stage}: lease lost', 'duration': dur/60})
+                continue
+            results.append({'sub': sub, 'status': s, 'message': m, 'duration': dur/60})
+            if s:
+                pp.log_ok(sub, f'queue: {m}, duration {dur/60:0.2f} min')
+            else:
+                pp.log_error(sub, f'queue: {m}, duration {dur/60:0.2f} min')
+            print(f'{sub} done - {m}, queue {q.status()}')
+    finally:
+        pp.lease_lost = None
+        q.close()
+    return results
@@ -17,7 +17,11 @@ class DwiPreprocessingClab():
 
     def __init__(self, task, mode, gibbs_method='mrtrix3', input=None, datain=None, dataout=None, \
         threads=-1, telegram=True, verbose=False, clean=True, \
-        copy=True, log=True, check_container=True, n_coils=32):
+        copy=True, log=True, check_container=True, n_coils=32, cmd_timeout=None, \
+        backend='real', fake_profile=None, fake_scale=1.0, staging='auto', prefetch=0, prefetch_budget=50, \
+        working_format='nii.gz', gzip_level=1, gzip_threads=None, array_cache=0, \
+        compute_dtype=None, storage_dtype=None, catalog=None, stat_cache=None, stat_mask=None, \
+        p2s_slab_mb=None, p2s_threads=None, p2s_sample=None, p2s_sample_mode='random', p2s_check=None):
         
         # Imports
         from os.path import join, exists, dirname, split, basename, isfile, isdir
@@ -27,6 +31,11 @@ class DwiPreprocessingClab():
         import subprocess as sp
         from datetime import datetime as dt
         from shutil import copyfile, copytree, rmtree
+        from fun.spans import Spans, Timed
+        from fun.arraycache import ArrayCache
+        from fun.niimeta import NiiMeta
+        from fun.catalog import Catalog
+        from fun.statcache import StatCache
 
 
         self.task = task # name of the task performed, used for logging. Can be anything but keep it brief
@@ -42,6 +51,29 @@ class DwiPreprocessingClab():
         self.log = log # whether to log the processing
         self.n_coils = n_coils # number of coils used for the acquisition
         self.gibbs_method = gibbs_method # method to be used for gibbs ringing correction, either mrtrix or dipy
+        self.staged = False # True while stages are chained in one tmp workspace, see pipeline()
+        self.cmd_timeout = cmd_timeout # seconds after which an external tool is stopped, None to wait for ever
+        self.backend = backend # external tools to run, 'real' (container) or 'fake' stand-ins, see fun/faketools.py
+        self.staging = staging # how inputs get to tmp, 'auto' links them where it is safe, 'copy' always copies, see fun/staging.py
+        self.prefetch = prefetch # subjects ahead whose inputs are copied to tmp/.prefetch in the background, 0 for none, see fun/prefetch.py
+        self.prefetch_budget = prefetch_budget # GB of tmp the prefetched inputs may take
+        self.prefetcher = None
+        self.working_format = working_format # images in tmp, 'nii.gz' or 'nii' uncompressed and memory mapped, see work()
+        self.gzip_level = gzip_level # compression of the .nii.gz written by python, see fun/pgzip.py
+        self.gzip_threads = gzip_threads # threads compressing a .nii.gz, or the ones published at once, None for the threads of the run
+        self.arrays = ArrayCache(array_cache*1024**3) if array_cache > 0 else None # GB of images of a subject kept in memory, 0 for none, see fun/arraycache.py
+        self.compute_dtype = compute_dtype # float images loaded and denoised as None (as on disk), 'float32' or 'float64', see fun/dtypes.py
+        self.storage_dtype = storage_dtype # float images saved as None (as computed), 'float32' or 'int16' with scl_slope
+        self.meta = NiiMeta() # shape, affine and volumes of the images read from their headers, see fun/niimeta.py
+        self.catalog = Catalog(catalog) if catalog is not None else None # sqlite file indexing the subjects and files of datain, None to list the directories, see fun/catalog.py
+        self.stats = StatCache(stat_cache) if stat_cache is not None else None # directory of the sigmas and b0 masks of the images by their content, kept across stages and runs, None to compute them each time, see fun/statcache.py
+        self.stat_mask = stat_mask # noise sigmas of mppca and patch2self over None (whole field of view), 'brain' or 'background', see fun/masks.py
+        self.p2s_slab_mb = p2s_slab_mb # patch2self over slabs of this many MB, None for dipy's patch2self on the whole image, see fun/p2s.py
+        self.p2s_threads = p2s_threads # BLAS threads of patch2self, None for all of them
+        self.p2s_sample = p2s_sample # patch2self regressions trained on this fraction (<= 1) or number of brain voxels and applied to all, over slabs of p2s_slab_mb (256 if None), None for all the voxels
+        self.p2s_sample_mode = p2s_sample_mode # 'random' or 'stratified' by the intensity of the mean b0
+        self.p2s_check = p2s_check # subjects held out to compare the sampled fit with the fits on all the brain voxels and all the voxels, see p2s_sample_report()
+        self.p2s_checks = [] # results of the comparisons made by this process
 
         # Also mount some key dependencies for easy access
         self.ls = ls
@@ -66,9 +98,47 @@ class DwiPreprocessingClab():
         # Start logging
         self.log_start(self.task)
 
+        # Timing spans of stages, subjects, steps and commands, see fun/spans.py
+        # load_nifti and save_nifti are timed with each call, and go through the array cache
+        spans = None
+        if self.log:
+            spans = join('logs', f'{self.logtimestamp}_{self.task.replace(" ","").lower()[:10]}_spans.jsonl')
+        self.spans = Spans(spans)
+        self.load_nifti = Timed(self.spans, 'io', 'load_nifti', self.load_nifti_cached)
+        self.save_nifti = Timed(self.spans, 'io', 'save_nifti', self.save_nifti_gz)
+
         # Performs all neccessary checks before starting the processing
         # This should be step 1 in the main script, ALWAYS
 
+        # Stand-ins for FSL and MRtrix3, the stages run without the container
+        s, m = self.check_backend(fake_profile, fake_scale)
+        if not s:
+            self.log_error('INIT', m)
+            exit(m)
+        if self.backend == 'fake':
+            check_container = False
+
+        # Data types of the images loaded and saved by python
+        s, m = self.check_dtypes()
+        if not s:
+            self.log_error('INIT', m)
+            exit(m)
+        self.log_info('INIT', m)
+
+        # Voxels the noise estimates are taken over
+        s, m = self.check_stat_mask()
+        if not s:
+            self.log_error('INIT', m)
+            exit(m)
+        self.log_info('INIT', m)
+
+        # Voxels the patch2self regressions are trained on
+        s, m = self.check_p2s_sample()
+        if not s:
+            self.log_error('INIT', m)
+            exit(m)
+        self.log_info('INIT', m)
+
         # Check if we are using the correct singularity image
         if check_container:
             s, m = self.check_container()
@@ -88,6 +158,11 @@ class DwiPreprocessingClab():
             exit(m)
         else:
             pass
+
+        # Catalog of the subjects brought up to date once, here, the stages, workers and
+        # the prefetch thread only read it
+        if self.catalog is not None and self.mode not in ['a', 'all']:
+            self.refresh_catalog()
         
         # Check the tmp dir
         s, m = self.check_tmp_dir()
@@ -108,7 +183,22 @@ class DwiPreprocessingClab():
         
         self.log_ok('INIT', 'All checks passed')
         print('All initial checks passed. Starting processing')
-        
+
+    def __getstate__(self):
+        # Needed to send the object to worker processes (see run_parallel)
+        # modules and file handles cannot be pickled, drop them here
+        state = self.__dict__.copy()
+        for k in ['sp', 'file', 'subdumpfile', 'prefetcher', 'lease_lost']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        # Mount subprocess again in the worker process, it does not prefetch
+        import subprocess as sp
+        self.__dict__.update(state)
+        self.sp = sp
+        self.prefetcher = None
+
     ########################################
     # Logging and notifications ############
     ########################################
@@ -171,6 +261,11 @@ class DwiPreprocessingClab():
             self.file.close()
 
     def log_subjectStart(self, id, task):
+        # subject span, the steps marked with log_step() are nested in it
+        # and the array cache holds the images of this subject
+        self.spans.start('subject', task, id)
+        if self.arrays is not None:
+            self.arrays.open(id)
         if self.log:
             # Logs the start of a subject processing
             self.file = open(self.logfilename, 'a')
@@ -178,7 +273,12 @@ class DwiPreprocessingClab():
             self.file.write(f'\n{self.subStart}\t{id}\tSUBSTART\t{task}: Subject started')
             self.file.close()
         
-    def log_subjectEnd(self, id, task):
+    def log_subjectEnd(self, id, task, status='ok'):
+        # status of the subject span, 'error' on the failure returns of the stages
+        self.spans.end('subject', status)
+        # when stages are chained the images are kept for the next one, see pipeline_sub()
+        if not self.staged:
+            self.release_arrays(id)
         if self.log:
             # Logs the end of a subject processing
             self.file = open(self.logfilename, 'a')
@@ -186,6 +286,15 @@ class DwiPreprocessingClab():
             self.file.write(f'\n{self.dt.now()}\t{id}\tSUBEND\t{task}: Subject ended, duration: {self.subEnd - self.subStart}')
             self.file.close()
         
+    def log_step(self, id, step):
+        # Marks the start of a step of the subject, ends the previous step
+        # Steps are timed in logs/<timestamp>_<task>_spans.jsonl, see fun/spans.py
+        # under run_queue() a subject whose lease was taken over stops here
+        if getattr(self, 'lease_lost', None) is not None and self.lease_lost(id):
+            from fun.workqueue import LeaseLost
+            raise LeaseLost(f'lease of {id} taken over by another worker at step {step}')
+        self.spans.next('step', step, id)
+
     def log_close(self):
         if self.log:
             self.file = open(self.logfilename, 'a')
@@ -283,7 +392,7 @@ class DwiPreprocessingClab():
                 else:
                     self.log_ok('INIT', 'Input directory found.')
                     # Now, do we have any subjects in the directory? If not - exit
-                    allsubs = [f for f in self.ls(self.datain) if f.startswith('sub-') and self.isdir(self.join(self.datain, f))]
+                    allsubs = self.datain_subjects()
                     if len(allsubs) == 0:
                         self.log_error('INIT', f'Exit Error. No subjects found in {self.input}.')
                         return [False, f'Exit Error. No subjects found in the input directory {self.datain}.']
@@ -328,6 +437,45 @@ class DwiPreprocessingClab():
             self.log_ok('INIT', 'Singularity image loaded.')
             return [True, 'Singularity image loaded']
 
+    def check_backend(self, profile, scale):
+        # With the fake backend the stand-ins of the external tools are written to
+        # tmp/.fakebin and put first in PATH, the worker processes and the commands
+        # run by run_cmds() inherit it, see fun/faketools.py
+        # profile: dict or json file with sleep, cpu and fail of the tools, scale: factor for the times
+
+        if self.backend not in ['real', 'fake']:
+            return [False, f'Exit error. Backend {self.backend} not recognised, use real or fake.']
+        if self.backend == 'real':
+            return [True, 'Real tools']
+
+        import os
+        from fun.faketools import FakeTools
+
+        try:
+            bindir = FakeTools(self.join('tmp', '.fakebin'), profile, scale).install()
+        except:
+            return [False, 'Exit error. Could not install the fake tools in tmp/.fakebin']
+        if not os.environ['PATH'].startswith(bindir + os.pathsep):
+            os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        self.log_warning('INIT', f'Fake backend: external tools replaced by the stand-ins in {bindir}, scale {scale}')
+        print(f'Fake backend, the external tools are stand-ins from {bindir}')
+        return [True, 'Fake tools installed']
+
+    def check_dtypes(self):
+        # Check the compute and storage types of the images, see fun/dtypes.py
+        from fun.dtypes import check
+        return check(self.compute_dtype, self.storage_dtype)
+
+    def check_stat_mask(self):
+        # Check the mask of the noise estimates, see fun/masks.py
+        from fun.masks import check
+        return check(self.stat_mask)
+
+    def check_p2s_sample(self):
+        # Check the subsample of the patch2self regressions, see fun/p2s.py
+        from fun.p2s import check
+        return check(self.p2s_sample, self.p2s_sample_mode)
+
     def check_subid(self, sub):
         # Check if subject name contains sub- prefix
         # Can fix so no return value
@@ -392,7 +540,7 @@ class DwiPreprocessingClab():
                 print(f'Subject {sub} directory found in tmp')
             # remove it 
             try:
-                self.remove(self.join('tmp', sub))
+                self.rmtree(self.join('tmp', sub))
                 self.log_ok(f'{sub}', f'Subject {sub} directory removed from tmp.')
             except:
                 self.log_error(f'{sub}', f'Subject {sub} directory could not be removed from tmp.')
@@ -411,21 +559,85 @@ class DwiPreprocessingClab():
     # Helping methods ######################
     ########################################
 
+    def mk_b0s(self, apim, paim, apb0, pab0, b0s_mask):
+        # Extracts the b0s for topup, AP volumes in b0s_mask and the first 4 volumes of PA
+        # Returns the number of b0s in AP and PA
+        dwi_ap, affine_ap = self.load_nifti(apim)
+        dwi_pa, affine_pa = self.load_nifti(paim)
+
+        b0s_ap = dwi_ap[:,:,:,b0s_mask]
+        b0s_pa = dwi_pa[:,:,:,[True, True, True, True, False]]
+
+        # Save volumes of b0s
+        self.save_nifti(apb0, b0s_ap, affine_ap)
+        self.save_nifti(pab0, b0s_pa, affine_pa)
+        return b0s_ap.shape[3], b0s_pa.shape[3]
+
+    def mk_acqparams(self, sub, acqpar, n_ap, n_pa):
+        # acqparams.txt for topup and eddy, one line for each b0 in AP and PA
+        # 0 -1 0 TotalReadoutTime AP
+        # 0 1 0 TotalReadoutTime PA
+        import json
+
+        # Load sidecar jsons and read TRT
+        ro = {}
+        for d in ['AP', 'PA']:
+            with open(self.join('tmp', sub, sub+f'_{d}.json')) as f:
+                ro[d] = json.load(f)['TotalReadoutTime']
+
+        with open(acqpar, "w") as f:
+            # for each vol in AP and for each vol in PA
+            for v in range(0, n_ap):
+                f.write(f"0 -1 0 {ro['AP']}\n")
+            for v in range(0, n_pa):
+                f.write(f"0 1 0 {ro['PA']}\n")
+
+    def mk_index(self, dwi, index):
+        # eddy index, all volumes of AP belong to the first line of acqparams
+        # only the number of volumes is needed, it is read from the header
+        with open(index, 'w') as f:
+            for i in range(self.meta.vols(dwi)):
+                f.write(f'1\n')
+
+    def datain_subjects(self):
+        # Subject directories of datain, from the catalog if there is one, which is
+        # brought up to date first, see fun/catalog.py
+        if self.catalog is None:
+            return [f for f in self.ls(self.datain) if f.startswith('sub-') and self.isdir(self.join(self.datain, f))]
+        self.log_info('INIT', self.catalog.refresh(self.datain))
+        return self.catalog.subjects(self.datain)
+
+    def refresh_catalog(self):
+        # Brings the catalog of the subjects of the run up to date, from this process
+        # only: at initialisation, and again if datain changed since then
+        # ('all' mode refreshes all of datain when the subjects are listed)
+        subs = [s for s in self.subs if self.isdir(self.join(self.datain, s))]
+        self.log_info('INIT', self.catalog.refresh(self.datain, subs))
+
+    def raw_dwi(self, sub):
+        # Raw dwi files of a subject in datain/sub/dwi, AP and PA nii, json, bval and bvec
+        # from the catalog if there is one, as refreshed at initialisation (see
+        # refresh_catalog()), it is only read here, also from workers and the prefetch thread
+        if self.catalog is None:
+            bfs = [f for f in self.ls(self.join(self.datain, sub, 'dwi')) if '.DS_' not in f]
+        else:
+            if not self.isdir(self.join(self.datain, sub, 'dwi')):
+                raise FileNotFoundError(self.join(self.datain, sub, 'dwi'))
+            bfs = [f for f in self.catalog.files(self.datain, sub, 'dwi') if '.DS_' not in f]
+        return [f for f in bfs if '_SBRef_' not in f and '_ADC_' not in f and '_TRACEW_' not in f and '_ColFA_' not in f and '_FA_' not in f]
+
     def cp_rawdata(self, sub):
-        # Copy raw data to tmp folder
+        # Stage raw data in tmp folder, renamed to sub_AP.nii, sub_PA.json, ...
+        # the raw data is only read, so it is linked where possible, see stage_input()
         # Returns True or False depending on success and message for logging
 
-        import shutil
-
         # get all dwi files for pp
         try:
-            bfs = [f for f in self.ls(self.join(self.datain, sub, 'dwi')) if '.DS_' not in f]
+            fsdwi = self.raw_dwi(sub)
         except:
             self.log_error(f'{sub}', f'cannot find dwi dir for the subject')
             return [False, f'Cannot find DWI dir for this subject']
 
-        # get all _AP_ files
-        fsdwi = [f for f in bfs if '_SBRef_' not in f and '_ADC_' not in f and '_TRACEW_' not in f and '_ColFA_' not in f and '_FA_' not in f]
         if len(fsdwi) != 6:
             print(f'{sub} has {len(fsdwi)} dwi files')
             self.log_error(f'{sub}', f'{sub} has {len(fsdwi)} dwi files and should have 6.')
@@ -437,19 +649,464 @@ class DwiPreprocessingClab():
                 fn = f'{sub}_AP.{f.split(".")[-1]}'
                 if self.verbose:
                     print(f'cp {self.join(self.datain, sub, "dwi", f)} ---> {self.join("tmp", sub, fn)}')
-                shutil.copy(self.join(self.datain, sub, "dwi", f), self.join("tmp", sub, fn))
+                m = self.stage_input(self.join(self.datain, sub, "dwi", f), self.join("tmp", sub, fn))
 
             elif '_PA_' in f:
                 fn = f'{sub}_PA.{f.split(".")[-1]}'
                 if self.verbose:
                     print(f'cp {self.join(self.datain, sub, "dwi", f)} ---> {self.join("tmp", sub, fn)}')
-                shutil.copy(self.join(self.datain, sub, "dwi", f), self.join("tmp", sub, fn))
+                m = self.stage_input(self.join(self.datain, sub, "dwi", f), self.join("tmp", sub, fn))
             else:
-                pass
+                continue
             
-            self.log_ok(f'{sub}', f'Copied raw data to tmp folder: {f}')
+            self.log_ok(f'{sub}', f'Staged raw data in tmp folder ({m}): {f}')
         return [True, f'Copied raw data for {sub} to tmp folder']
 
+    def mk_tmpdirs(self, sub, dirs, resume=False):
+        # Create tmp/sub and the subdirectories listed in dirs
+        # When stages are chained (self.staged) the workspace is shared, and when an
+        # interrupted run is resumed it is reused, so existing dirs are fine
+        self.makedirs(self.join('tmp', sub), exist_ok=self.staged or resume)
+        for d in dirs:
+            self.makedirs(self.join('tmp', sub, d), exist_ok=self.staged or resume)
+
+    def stage_input(self, src, dst, readonly=True):
+        # Puts an input of a stage in tmp, hard link, reflink or symlink when the
+        # stage only reads it and a copy when it has to, see fun/staging.py
+        # A prefetched local copy of src is staged in its place, see prefetch_start()
+        # A .nii.gz staged as .nii (working format 'nii', see work()) is decompressed
+        # Returns the method used, raises OSError if the file cannot be staged
+        from fun.staging import stage_file, unpack
+
+        local = self.prefetched(src)
+        if src.endswith('.nii.gz') and dst.endswith('.nii'):
+            m = unpack(local, dst)
+        else:
+            m = stage_file(local, dst, readonly, None if self.staging == 'auto' else ['copy'])
+        return m if local == src else f'prefetched, {m}'
+
+    def save_nifti_gz(self, fname, data, affine, hdr=None, dtype=None):
+        # save_nifti of dipy, .nii.gz compressed on several threads, see fun/pgzip.py
+        # float images are saved in the storage type, see fun/dtypes.py
+        # the array is kept in the array cache, the next step reading the file gets it
+        from fun.pgzip import save_nifti
+        from fun.dtypes import storage
+        data, dtype = storage(data, dtype, self.storage_dtype)
+        save_nifti(fname, data, affine, hdr, dtype, self.gzip_level, self.gzip_threads_n())
+        if self.arrays is not None and dtype is None:
+            self.arrays.put(fname, data, affine)
+
+    def load_nifti_cached(self, fname, **kwargs):
+        # load_nifti of dipy, float images in the compute type, see fun/dtypes.py
+        # the array of the subject's array cache if it holds the file
+        from dipy.io.image import load_nifti
+        from fun.dtypes import compute
+        if len(kwargs) > 0:
+            return load_nifti(fname, **kwargs)
+        hit = self.arrays.get(fname) if self.arrays is not None else None
+        if hit is not None:
+            return compute(hit[0], self.compute_dtype), hit[1]
+        data, affine = load_nifti(fname)
+        data = compute(data, self.compute_dtype)
+        if self.arrays is not None:
+            self.arrays.put(fname, data, affine)
+        return data, affine
+
+    def release_arrays(self, sub):
+        # End of the lifetime of the images of a subject in the array cache
+        if self.arrays is not None:
+            self.log_info(f'{sub}', self.arrays.clear())
+
+    def estimate_sigmas(self, stacks, paths=None, mask=None):
+        # Noise sigma of each volume of the images, as estimate_sigma of dipy, all of
+        # them in one pool of the threads of the run (of the worker), see fun/sigma.py
+        # computed in float32 if the images are, see compute_dtype
+        # paths: files the images were loaded from (None for one that is not on disk
+        # as it is in memory), their sigmas are taken from the stat cache if the same
+        # content was seen before, see fun/statcache.py
+        # mask: voxels the sigmas are taken over, None for all, see noise_mask()
+        from fun.statcache import cached_sigmas
+        if paths is None:
+            paths = [None] * len(stacks)
+        return cached_sigmas(self.stats, paths, stacks, N=self.n_coils, threads=self.threads if self.threads > 0 else None, \
+            dtype='float32' if self.compute_dtype == 'float32' else 'float64', data_dtype=self.compute_dtype, mask=mask)
+
+    def noise_mask(self, sub, ap_raw):
+        # Voxels the noise estimates of the subject are taken over (see stat_mask) and
+        # the suffix of their files, [None, ''] for the whole field of view
+        from fun.masks import select, box_fraction
+        if self.stat_mask is None:
+            return [None, '']
+        mask = select(self.brain(sub, ap_raw), self.stat_mask)
+        self.log_info(f'{sub}', f'{self.stat_mask} mask: {mask.mean()*100:0.0f}% of the voxels, {box_fraction(mask)*100:0.0f}% of the field of view read')
+        return [mask, f'_{self.stat_mask}']
+
+    def brain(self, sub, ap_raw):
+        # Brain mask of the subject: the bet mask of make_brain_masks() if the subject
+        # has one (a run after eddy), or the median_otsu mask of the mean raw AP b0,
+        # which is kept in the stat cache
+        from fun.masks import brain_mask
+        brain = None
+        for d in [self.join('tmp', sub, 'bmasks'), self.join(self.dataout, sub, 'bmasks')]:
+            f = self.join(d, f'{sub}_b0_bet_f-02_mask.nii.gz')
+            if self.exists(f):
+                try:
+                    m, __ = self.load_nifti(f)
+                    if m.shape == ap_raw.shape[:3]:
+                        brain = m > 0
+                        break
+                except:
+                    pass
+        if brain is None:
+            raw = self.join('tmp', sub, sub + '_AP.nii')
+            brain = self.stats.get(raw, 'brain_mask_otsu') if self.stats is not None else None
+            if brain is None:
+                brain = brain_mask(ap_raw, self.b0s_mask(self.join('tmp', sub, sub + '_AP.bval'), self.join('tmp', sub, sub + '_AP.bvec')))
+                if self.stats is not None:
+                    self.stats.put(raw, 'brain_mask_otsu', brain)
+        return brain
+
+    def denoise_p2s(self, data, bvals, mask=None):
+        # patch2self of dipy on the whole image, or over slabs of p2s_slab_mb MB with
+        # the same regressions fitted on all the voxels (fun/p2s.py), with BLAS on
+        # p2s_threads threads, so that several subjects can share a node
+        # with p2s_sample the regressions are trained on a subsample of the voxels of
+        # mask (the brain, None for all) over slabs
+        from threadpoolctl import threadpool_limits
+        from dipy.denoise.patch2self import patch2self
+        from fun.p2s import patch2self_slabs
+        if self.p2s_sample is not None:
+            return patch2self_slabs(data, bvals, b0_threshold=50, slab_mb=self.p2s_slab_mb or 256, threads=self.p2s_threads, \
+                out_dtype=self.compute_dtype, mask=mask, sample=self.p2s_sample, sample_mode=self.p2s_sample_mode)
+        if self.p2s_slab_mb is not None:
+            return patch2self_slabs(data, bvals, b0_threshold=50, slab_mb=self.p2s_slab_mb, threads=self.p2s_threads, \
+                out_dtype=self.compute_dtype)
+        with threadpool_limits(limits=self.p2s_threads, user_api='blas'):
+            return patch2self(data, bvals, model='ols', shift_intensity=True, \
+                clip_negative_vals=False, b0_threshold=50, verbose=True, out_dtype=self.compute_dtype)
+
+    def p2s_sample_check(self, sub, d, gib, bval, den, mask, noise):
+        # Difference of the sampled patch2self image den to the fits on all the voxels
+        # of the brain (the loss of the sampling) and of the image, in units of the
+        # noise sigma, over the brain, saved as sigma_noise/{sub}_{d}_p2s_sample_check.json
+        # with the time of the three fits, see check_sample() of fun/p2s.py
+        # Returns [True/False (loss of the sampling above TOLERANCE), msg]
+        import json
+        import numpy as np
+        from fun.p2s import check_sample, TOLERANCE
+        if mask is None:
+            mask = np.ones(gib.shape[:3], dtype=bool)
+        res = check_sample(gib, bval, den, mask, noise, self.p2s_sample, self.p2s_sample_mode, b0_threshold=50, \
+            slab_mb=self.p2s_slab_mb or 256, threads=self.p2s_threads, out_dtype=self.compute_dtype)
+        res.update({'sub': sub, 'dir': d, 'sample': self.p2s_sample, 'mode': self.p2s_sample_mode, 'noise': float(noise)})
+        self.p2s_checks.append(res)
+        with open(self.join('tmp', sub, 'sigma_noise', f'{sub}_{d}_p2s_sample_check.json'), 'w') as f:
+            json.dump(res, f, indent=2)
+        m = f'{d} sampled fit vs all the brain voxels {res["sampling"]["mean"]:0.3f} sigma mean ({res["sampling"]["max"]:0.3f} max), ' + \
+            f'vs all the voxels {res["all"]["mean"]:0.3f} ({res["all"]["max"]:0.3f}), ' + \
+            f'{res["s sample"]:0.2f} s vs {res["s mask"]:0.2f} s and {res["s all"]:0.2f} s'
+        return [res['sampling']['mean'] <= TOLERANCE, m]
+
+    def p2s_sample_report(self):
+        # Sampled against full patch2self fits of the held-out subjects (p2s_check)
+        # checked by this process, and by the workers of run_parallel() or run_queue()
+        # from the sigma_noise/ of dataout
+        # Returns [True/False (a loss of the sampling above TOLERANCE), msg]
+        import json
+        from glob import glob
+        from fun.p2s import TOLERANCE
+        checks = list(self.p2s_checks)
+        seen = set([c['sub'] for c in checks])
+        for sub in self.p2s_check or []:
+            if sub in seen:
+                continue
+            for f in sorted(glob(self.join(self.dataout, sub, 'sigma_noise', f'{sub}_*_p2s_sample_check.json'))):
+                with open(f) as fh:
+                    checks.append(json.load(fh))
+        if len(checks) == 0:
+            return [False, f'patch2self sample check: no results for the held-out subjects {self.p2s_check}']
+        mean = lambda k: sum([c[k]['mean'] for c in checks]) / len(checks)
+        worst = max(checks, key=lambda c: c['sampling']['mean'])
+        speed = sum([c['s all'] for c in checks]) / sum([c['s sample'] for c in checks])
+        m = f'patch2self sample check on {len(checks)} images of {len(set([c["sub"] for c in checks]))} held-out subjects: ' + \
+            f'{mean("sampling"):0.3f} sigma mean difference to the fit on all the brain voxels, worst {worst["sampling"]["mean"]:0.3f} ' + \
+            f'({worst["sub"]} {worst["dir"]}), {mean("all"):0.3f} to the fit on all the voxels, fit {speed:0.1f}x faster'
+        return [worst['sampling']['mean'] <= TOLERANCE, m]
+
+    def b0s_mask(self, bval, bvec):
+        # Volumes that are b0s (b <= 50), from the stat cache if the bvals were seen before
+        from dipy.core.gradients import gradient_table
+        if self.stats is not None:
+            mask = self.stats.get(bval, 'b0s_mask_b50')
+            if mask is not None:
+                return mask
+        mask = gradient_table(bval, bvec).b0s_mask
+        if self.stats is not None:
+            self.stats.put(bval, 'b0s_mask_b50', mask)
+        return mask
+
+    def gzip_threads_n(self):
+        # Threads compressing a .nii.gz, gzip_threads or the threads of the run (of the worker)
+        # publish() splits them between the files it compresses at once
+        if self.gzip_threads is not None:
+            return self.gzip_threads
+        return self.threads if self.threads > 0 else None
+
+    def work(self, path):
+        # Path of an image in tmp in the working format; with 'nii' the intermediates
+        # are kept uncompressed, load_nifti maps them into memory rather than
+        # decompressing them each time, and they are compressed once by publish()
+        # External tools write the working format, FSL through fsl_env()
+        from fun.stages import work_name
+        return work_name(path, self.working_format)
+
+    def fsl_env(self):
+        # Prefix of the FSL commands that write images in tmp, FSL picks the
+        # extension from FSLOUTPUTTYPE rather than from the name given
+        return 'FSLOUTPUTTYPE=NIFTI ' if self.working_format == 'nii' else ''
+
+    def prefetch_start(self, stage, steps=None):
+        # Starts copying the inputs of the next subjects (self.prefetch of them, within
+        # self.prefetch_budget GB) to tmp/.prefetch in the background, while the loop
+        # of a stage works on the current one, see fun/prefetch.py
+        # The inputs are those of stage_inputs(), or of pipeline_inputs() for the steps of a pipeline
+        # stage_input() stages the local copies in place of the sources
+        from fun.prefetch import Prefetcher
+
+        if self.prefetch < 1:
+            return
+        if steps is None:
+            files = lambda sub: self.stage_inputs(sub, stage)
+        else:
+            files = lambda sub: self.pipeline_inputs(sub, steps)
+        self.prefetcher = Prefetcher(self.join('tmp', '.prefetch'), files, self.prefetch, self.prefetch_budget*1024**3)
+        self.prefetcher.start(self.subs)
+        self.log_info('ALL', f'{stage}: prefetching the inputs of {self.prefetch} subjects ahead, at most {self.prefetch_budget} GB')
+
+    def prefetch_wait(self, sub):
+        # Called by the loop before a subject, waits if its inputs are being fetched
+        from time import perf_counter
+
+        if self.prefetcher is None:
+            return
+        start, t0 = self.dt.now(), perf_counter()
+        self.prefetcher.wait(sub)
+        self.spans.record('io', 'prefetch_wait', sub, start, perf_counter()-t0, \
+            self.spans.current(), self.spans.where('prefetch_wait'), 'ok')
+        for id, m, level in self.prefetcher.drain():
+            if level == 'warning':
+                self.log_warning(id, m)
+            else:
+                self.log_info(id, m)
+
+    def prefetch_release(self, sub):
+        # Called by the loop after a subject, removes its local copies
+        if self.prefetcher is not None:
+            self.prefetcher.release(sub)
+
+    def prefetch_stop(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            for id, m, level in self.prefetcher.drain():
+                if level == 'warning':
+                    self.log_warning(id, m)
+                else:
+                    self.log_info(id, m)
+            self.prefetcher = None
+
+    def prefetched(self, path):
+        # Local copy of path if it was prefetched, else path
+        if self.prefetcher is None:
+            return path
+        local = self.prefetcher.local(path)
+        return path if local is None else local
+
+    def get_inputs(self, sub, files, src, stage, resume=False):
+        # Stage the files a stage reads from src (dataout or datain) in tmp
+        # files are suffixes of the subject id, e.g. '_AP.bval'
+        # The inputs are only read, so they are linked rather than copied where possible
+        # When stages are chained (self.staged) or an interrupted run is resumed
+        # files that are already in tmp are used as they are
+        # Returns True or False depending on success and message for logging
+        used = {}
+        for f in files:
+            dst = self.work(self.join('tmp', sub, sub+f))
+            if (self.staged or resume) and self.exists(dst):
+                self.log_info(f'{sub}', f'{stage}: Using {self.basename(dst)} already in tmp')
+                continue
+            try:
+                m = self.stage_input(self.join(src, sub, sub+f), dst)
+                used[m] = used.get(m, 0) + 1
+                self.log_ok(f'{sub}', f'{stage}: Staged {sub+f} in tmp folder ({m})')
+            except:
+                self.log_error(f'{sub}', f'{stage}: Could not copy file {f}')
+                print(f'Could not copy file {f}')
+                return [False, f'{stage}: could not copy file {f}']
+        return [True, f'{stage}: all files staged in tmp folder {used}']
+
+    def publish(self, sub, stage, items):
+        # Copy outputs of a subject to dataout, see fun/publisher.py
+        # items: list of (src, dst), files or directories whose content is merged into dst
+        # copies are verified and renamed into place, the transfer is timed as an io span
+        # images in the 'nii' working format are compressed to their .nii.gz names
+        # Returns True or False and message for logging
+        from fun.publisher import Publisher
+        from fun.stages import published_name
+
+        pub = Publisher(level=self.gzip_level, gzip_threads=self.gzip_threads_n())
+        for src, dst in items:
+            pack = self.working_format == 'nii' and self.isfile(src) and published_name(src) != src
+            pub.add(src, published_name(dst) if pack else dst, pack)
+        start = self.dt.now()
+        s, m = pub.run()
+        if hasattr(pub, 'stats'):
+            self.spans.record('io', 'publish', sub, start, pub.stats['seconds'], self.spans.current(), \
+                self.spans.where('publish'), 'ok' if s else 'error', files=pub.stats['files'], \
+                bytes=pub.stats['bytes'], mbps=round(pub.stats['MB/s'], 2))
+        if s:
+            self.log_ok(f'{sub}', f'{stage}: {m}')
+        else:
+            self.log_error(f'{sub}', f'{stage}: {m}')
+        return [s, m]
+
+    def open_journal(self, sub, stage, inputs, params=None, tools=None):
+        # Step journal of a stage in the tmp workspace, see fun/journal.py
+        # inputs: paths of the files the stage reads, if these or the settings
+        # of the stage have changed the journal is started again
+        # params and tools default to stage_settings()
+        # Returns the journal and True if an interrupted run is resumed
+        import os
+        from fun.journal import Journal
+
+        if params is None:
+            params, tools = self.stage_settings(stage)
+        key = {'params': params, 'tools': tools, 'inputs': {}}
+        for i in inputs:
+            if self.exists(i):
+                st = os.stat(i)
+                key['inputs'][self.basename(i)] = [st.st_size, st.st_mtime_ns]
+
+        journal = Journal(self.join('tmp', sub, '.journal', f'{stage}.json'), key)
+        resume = journal.last() is not None
+        if resume:
+            self.log_info(f'{sub}', f'{stage}: resuming interrupted run after step {journal.last()}')
+            print(f'{sub} resuming {stage} after step {journal.last()}')
+        return journal, resume
+
+    def stage_settings(self, stage):
+        # Parameters and tool versions that decide the outcome of a stage
+        # recorded in the manifest, a change of any of these makes the stage run again
+        from fun.manifest import tool_version
+
+        if stage == 'gibbs':
+            params = {'gibbs_method': self.gibbs_method}
+            tools = ['dipy'] if self.gibbs_method == 'dipy' else ['mrdegibbs']
+        elif stage == 'mppca':
+            params = {'n_coils': self.n_coils}
+            tools = ['dwidenoise', 'dipy']
+        elif stage == 'patch2self':
+            params = {'n_coils': self.n_coils, 'model': 'ols', 'b0_threshold': 50}
+            tools = ['dipy']
+        elif stage == 'topup':
+            params = {'config': 'b02b0.cnf'}
+            tools = ['fsl', 'dipy']
+        else:
+            params = {}
+            tools = ['fsl', 'dipy']
+        if stage in ['mppca', 'patch2self']:
+            # the settings added later are recorded only when they are not the
+            # defaults, so the manifests of earlier runs stay valid
+            for k in ['compute_dtype', 'storage_dtype', 'stat_mask']:
+                if getattr(self, k) is not None:
+                    params[k] = getattr(self, k)
+        if stage == 'topup' and self.storage_dtype is not None:
+            # the b0s merged for topup are saved by python, see mk_b0s()
+            params['storage_dtype'] = self.storage_dtype
+        if stage == 'patch2self':
+            # fun/p2s.py fits on all the voxels (or a sample of the brain) where
+            # dipy fits on a sketch, the slab size does not change the result
+            if self.p2s_slab_mb is not None or self.p2s_sample is not None:
+                params['fit'] = 'slabs'
+            if self.p2s_sample is not None:
+                params['p2s_sample'] = self.p2s_sample
+                params['p2s_sample_mode'] = self.p2s_sample_mode
+        return params, {t: tool_version(t, self.backend) for t in tools}
+
+    def stage_inputs(self, sub, stage):
+        # Paths of the files a stage reads, see fun/stages.py
+        from fun.stages import STAGES
+
+        if stage == 'gibbs':
+            if not self.exists(self.join(self.datain, sub, 'dwi')):
+                return []
+            return [self.join(self.datain, sub, 'dwi', f) for f in self.raw_dwi(sub)]
+        src = self.datain if stage == 'eddy' else self.dataout
+        return [self.join(src, sub, sub+f) for f in STAGES[stage]['inputs']]
+
+    def stage_outputs(self, sub, stage):
+        # Paths of the output files of a stage in dataout, see fun/stages.py
+        from fnmatch import fnmatch
+        from fun.stages import STAGES
+
+        outdir = self.join(self.dataout, sub)
+        files = [f for f in self.ls(outdir) if self.isfile(self.join(outdir, f))]
+        return [self.join(outdir, f) for f in files if any([fnmatch(f, sub+o) for o in STAGES[stage]['outputs']])]
+
+    def is_processed(self, sub, stage, inputs, legacy, params=None, tools=None):
+        # Checks the manifest of the subject to decide if a stage can be skipped
+        # inputs: paths of the files the stage reads
+        # legacy: output paths checked when the subject has no manifest for the stage,
+        # i.e. it was processed before manifests were kept
+        # params and tools default to stage_settings()
+        # Returns True if the stage can be skipped and message for logging
+        from fun.manifest import Manifest
+
+        man = Manifest(self.join(self.dataout, sub, f'{sub}_manifest.json'))
+        if stage not in man.stages:
+            if len(legacy) > 0 and all([self.exists(f) for f in legacy]):
+                self.log_warning(f'{sub}', f'{stage}: no manifest, outputs exist so taking it as processed')
+                return [True, f'{stage} outputs exist']
+            return [False, f'{stage} not processed']
+
+        if params is None:
+            params, tools = self.stage_settings(stage)
+        try:
+            return man.check(stage, inputs, params, tools)
+        except:
+            return [False, f'{stage} manifest could not be checked']
+
+    def record_stage(self, sub, stage, inputs, outputs, params=None, tools=None):
+        # Adds the completed stage to the manifest of the subject in dataout
+        from fun.manifest import Manifest
+
+        if params is None:
+            params, tools = self.stage_settings(stage)
+        try:
+            man = Manifest(self.join(self.dataout, sub, f'{sub}_manifest.json'))
+            man.record(stage, inputs, outputs, params, tools)
+            self.log_ok(f'{sub}', f'{stage}: recorded in manifest')
+        except:
+            self.log_warning(f'{sub}', f'{stage}: could not record in manifest')
+
+    def split_threads(self, n):
+        # Threads for each of n tools run at the same time, so together they use self.threads
+        if self.threads > 0:
+            return max(1, self.threads // n)
+        return self.threads
+
+    def run_cmds(self, sub, groups, limit=2, timeout=None):
+        # Runs groups of external commands one after another, commands within a group at the same time
+        # output of the tools goes to logs/<timestamp>_<task>_cmd.log, see fun/cmdrunner.py
+        # Returns True if all succeeded, False and message of the first failure if not
+        from fun.cmdrunner import CmdRunner
+
+        logfile = None
+        if self.log:
+            logfile = self.join('logs', f'{self.logtimestamp}_{self.task.replace(" ","").lower()[:10]}_cmd.log')
+        runner = CmdRunner(limit=limit, timeout=self.cmd_timeout, logfile=logfile, \
+            log_ok=self.log_ok, log_error=self.log_error, spans=self.spans)
+        return runner.chain(sub, groups, timeout)
+
     def check_qa(self, dwi):
         
         # set of common methods for all QA things;
@@ -571,31 +1228,33 @@ class DwiPreprocessingClab():
             return False
         
         # Copy file to the tmpdir
-        raw_img = self.join('tmp', sub, f'{sub}_b0_corrected.nii.gz')
-        img = self.join('tmp', sub, f'{sub}_b0_.nii.gz')
+        raw_img = self.work(self.join('tmp', sub, f'{sub}_b0_corrected.nii.gz'))
+        img = self.work(self.join('tmp', sub, f'{sub}_b0_.nii.gz'))
         mask_otsu = self.join('tmp', sub, 'bmasks', f'{sub}_b0_otsu')
 
-        if self.exists(raw_img):
-            # extract 1st b0
-            # self.sp.run(f'fslroi {raw_img} {img} 0 1', shell=True)
-            # get average image from all corrected
-            self.sp.run(f'fslmaths {raw_img} -Tmean {img}', shell=True)
-        else:
+        if not self.exists(raw_img):
             # self.log_error(f'{sub}', 'BrainMask: Could not extract b0 for subject')
             return False
 
+        # extract 1st b0
+        # fslroi {raw_img} {img} 0 1
+        # get average image from all corrected
+        cmds = [[f'{self.fsl_env()}fslmaths {raw_img} -Tmean {img}'], []]
+
         # run bet
         # Make outline (-o), mask (-m) and mesh (-e) with robust (-R) flag, 
         # and center the mass (-c) in second run
-        print('Running bet')
         for f in [0.2]:
-            print(f'Running bet with f={f}')
-            self.sp.run(f'bet {img} tmp/{sub}/bmasks/{sub}_b0_bet_f-{str(f).replace(".","")} -m -o -e -R -f {f}', shell=True)
+            cmds[1].append(f'bet {img} tmp/{sub}/bmasks/{sub}_b0_bet_f-{str(f).replace(".","")} -m -o -e -R -f {f}')
         
-        # Run dipy's median_otsu
+        # Run dipy's median_otsu, at the same time as bet, both only read the mean b0
         # save both binary mask and masked volume, take first b0 (--vol_idx 0), run the algo 2 times (--numpass 2)
-        print('Running median_otsu')
-        self.sp.run(f'dipy_median_otsu {img} --vol_idx 0 --numpass 2 --save_masked --out_mask {mask_otsu}.nii.gz --out_masked {mask_otsu}_masked.nii.gz', shell=True)
+        cmds[1].append(f'dipy_median_otsu {img} --vol_idx 0 --numpass 2 --save_masked --out_mask {mask_otsu}.nii.gz --out_masked {mask_otsu}_masked.nii.gz')
+
+        print('Running bet and median_otsu')
+        s, m = self.run_cmds(sub, cmds, limit=len(cmds[1]))
+        if not s:
+            return False
 
         # plot all masks
         print('Plotting masks - loading volumes')
@@ -643,6 +1302,17 @@ class DwiPreprocessingClab():
     # Plotting methods #####################
     ########################################
 
+    def lazy_nifti(self, path):
+        # Image for the plots that show a few slices, read slice by slice rather
+        # than loaded whole, see fun/lazynifti.py; the array if the array cache holds it
+        from fun.lazynifti import LazyNifti
+
+        if self.arrays is not None:
+            hit = self.arrays.get(path)
+            if hit is not None:
+                return hit[0]
+        return LazyNifti(path)
+
     def gif_dwi_4d(self, sub, image, gif, title, slice=55, fdur=500):
 
         # Create a gif of a 4D image
@@ -661,7 +1331,7 @@ class DwiPreprocessingClab():
         # Make gif of dwi data
         # Use self.qadir
         try:
-            img, __ = self.load_nifti(image)
+            img = self.lazy_nifti(image)
             self.log_info(f'{sub}', f'plotdwi4d: Loaded image: {image}')
         except:
             print(f'Could not load {image}')
@@ -738,8 +1408,8 @@ class DwiPreprocessingClab():
 
         try:
             # Load images
-            img1, __ = self.load_nifti(file1)
-            img2, __ = self.load_nifti(file2)
+            img1 = self.lazy_nifti(file1)
+            img2 = self.lazy_nifti(file2)
             self.log_info(f'{sub}', f'plt_compare_4d: Loaded images: {file1} and {file2}')
         except:
             print(f'Unable to load images for comparison: {file1} and {file2}')
@@ -793,6 +1463,105 @@ class DwiPreprocessingClab():
         self.log_ok(f'{sub}', f'plt_compare_4d: Made plots for {file1} and {file2}')
         return [True, f'Comparison plots created for {sub}']
 
+    def plt_mppca_vols(self, sub, d, bvl, raw, gib, mpp, resi, sraw, sgib, smpp):
+
+        # QA figure for each volume of mppca, raw, gibbs, mppca and residuals
+        # in all three planes with the noise sigma of each volume
+        # saved to tmp/sub/imgs/mrtrix3_mppca
+
+        import matplotlib.pyplot as plt
+
+        xcmp = 'gray'
+
+        # Take the middle slice in all dimensions of an image
+        d0 = round(raw.shape[0]/2)
+        d1 = round(raw.shape[1]/2)
+        d2 = round(raw.shape[2]/2)
+
+        for i, vs in enumerate(range(0, raw.shape[3])):
+
+            # computes the residuals
+            #rms_gibmppca = np.sqrt(abs((gib[:,:,s,vs] - mpp[:,:,s,vs]) ** 2))
+            #rms_rawmppca = np.sqrt(abs((raw[:,:,s,vs] - mpp[:,:,s,vs]) ** 2))
+
+            fig1, ax = plt.subplots(4, 3, figsize=(6, 8), subplot_kw={'xticks': [], 'yticks': []})
+        
+            fig1.subplots_adjust(hspace=0.05, wspace=0.10)
+            fig1.suptitle(f'{sub} {d} vol={vs} bval={int(bvl[i])}', fontsize=15)
+
+            # Raw image
+            ax.flat[0].imshow(raw[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[1].imshow(raw[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[1].set_title('Raw, ' + r'$\sigma_{noise}$' + f' = {round(sraw[i])}')
+            ax.flat[2].imshow(raw[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+
+            # Gibbs image
+            ax.flat[3].imshow(gib[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[4].imshow(gib[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[4].set_title('Gibbs, ' + r'$\sigma_{noise}$' + f' = {round(sgib[i])}')
+            ax.flat[5].imshow(gib[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            
+            # mppca image
+            ax.flat[6].imshow(mpp[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[7].imshow(mpp[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[7].set_title('MPPCA, ' + r'$\sigma_{noise}$' + f' = {round(smpp[i])}')
+            ax.flat[8].imshow(mpp[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            
+            # Residuals GIBBS - MPPCA
+            ax.flat[9].imshow(resi[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[10].imshow(resi[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[10].set_title('Resid Gibbs - MPPCA')
+            ax.flat[11].imshow(resi[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            
+            sfig = self.join('tmp', sub, 'imgs', 'mrtrix3_mppca', f'{sub}_{d}_v-{1000+int(vs)}.png')
+            fig1.savefig(sfig)
+
+            plt.close()
+
+    def plt_p2s_vols(self, sub, d, bvl, raw, gib, p2s, sraw, sgib, sp2s, slice=42):
+
+        # QA figure for each volume of patch2self, raw, gibbs, patch2self and the
+        # differences of raw and gibbs from patch2self in the axial slice
+        # saved to tmp/sub/imgs/patch2self
+
+        import numpy as np
+        import matplotlib.pyplot as plt
+
+        xcmp = 'gray'
+        s = slice
+
+        for i, vs in enumerate(range(0, raw.shape[3])):
+
+            # computes the residuals
+            rms_gibp2s = np.sqrt(abs((gib[:,:,s,vs] - p2s[:,:,s,vs]) ** 2))
+            rms_rawp2s = np.sqrt(abs((raw[:,:,s,vs] - p2s[:,:,s,vs]) ** 2))
+
+            fig1, ax = plt.subplots(2, 3, figsize=(12, 12),subplot_kw={'xticks': [], 'yticks': []})
+        
+            fig1.subplots_adjust(hspace=0.05, wspace=0.05)
+            fig1.suptitle(f'{sub} {d} vol={vs} bval={int(bvl[i])}', fontsize =20)
+
+            # Raw image
+            ax.flat[0].imshow(raw[:,:,s,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[0].set_title('Raw, ' + r'$\sigma_{noise}$' + f' = {round(sraw[i])}')
+            # Gibbs image
+            ax.flat[1].imshow(gib[:,:,s,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[1].set_title('Gibbs, ' + r'$\sigma_{noise}$' + f' = {round(sgib[i])}')
+            # p2s image
+            ax.flat[2].imshow(p2s[:,:,s,vs].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[2].set_title('P2S, ' + r'$\sigma_{noise}$' + f' = {round(sp2s[i])}')
+            # Raw - p2s
+            ax.flat[3].imshow(rms_rawp2s.T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[3].set_title('Raw - P2S')
+            # Gibbs - p2s
+            ax.flat[4].imshow(rms_gibp2s.T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[4].set_title('Gibbs - P2S')
+            
+            sfig = self.join('tmp', sub, 'imgs', 'patch2self', f'{sub}_{d}_v-{1000+int(vs)}.png')
+            fig1.savefig(sfig)
+
+            plt.close()
+
     def plot_nii_3d(self, nii, sub, title, out, xcmp = 'gray'):
         
         # Plot a 3D nifti file, all three planes
@@ -804,7 +1573,7 @@ class DwiPreprocessingClab():
         fig0.subplots_adjust(hspace=0.05, wspace=0.05)
         fig0.suptitle(f'{title}', fontsize=15)
 
-        niifile, __ = self.load_nifti(nii)
+        niifile = self.lazy_nifti(nii)
         d0 = round(niifile.shape[0]/2)
         d1 = round(niifile.shape[1]/2)
         d2 = round(niifile.shape[2]/2)
@@ -822,7 +1591,7 @@ class DwiPreprocessingClab():
     # DWI Preprocessing ####################
     ########################################
 
-    def gibbs(self):
+    def gibbs(self, skip_processed=True):
         
         # Check if QA required
         # This has been disabled as there was a problem with the QApath
@@ -837,119 +1606,153 @@ class DwiPreprocessingClab():
         self.log_subdump(self.subs)
 
         # Loop over subjects
+        self.prefetch_start('gibbs')
+        self.spans.start('stage', 'gibbs', 'ALL')
         for i, sub in enumerate(self.subs):
+            print(f'Processing subject {sub} ({i+1}/{len(self.subs)} for {self.gibbs_method} gibbs ringing correction)')
+            self.prefetch_wait(sub)
+            self.gibbs_sub(sub, skip_processed)
+            self.prefetch_release(sub)
+        self.spans.end('stage')
+        self.prefetch_stop()
 
-            if self.exists(self.join(self.dataout, sub)):
-                self.log_warning(f'{sub}', f'gibbs: Output directory already exists, skipping subject')
-                print(f'Output directory already exists, skipping subject: {sub}')
-                continue
+        # Loop end
+        if self.telegram:
+            self.log_ok('ALL', f'Gibbs ringing correction completed successfully for {len(self.subs)} subjects')
+            self.tg(f'Gibbs ringing correction completed for all {len(self.subs)} subjects')
 
-            print(f'Processing subject {sub} ({i+1}/{len(self.subs)} for {self.gibbs_method} gibbs ringing correction)')
-            
-            # Log start
-            self.log_subjectStart(sub, f'{self.gibbs_method}gibbs')
+    def gibbs_sub(self, sub, skip_processed=True):
+        # Gibbs ringing correction for a single subject
+        # Returns True or False depending on success and message for logging
 
-            # Perform subject checks
-            # Check indir
-            s, m = self.check_subject_indir(sub)
-            if not s:
-                self.log_error(sub, m)
-                print(m)
-                self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
-                continue
-            else:
-                self.log_ok(sub, m)
-                pass
+        if skip_processed and not self.staged:
+            legacy = [self.join(self.dataout, sub, sub + '_AP_gib.nii.gz'), self.join(self.dataout, sub, sub + '_PA_gib.nii.gz')]
+            s, m = self.is_processed(sub, 'gibbs', self.stage_inputs(sub, 'gibbs'), legacy)
+            if s:
+                self.log_warning(f'{sub}', f'gibbs: {m}, skipping subject')
+                print(f'Already processed, skipping subject: {sub}')
+                return [True, f'gibbs: {sub} already processed']
+            self.log_info(f'{sub}', f'gibbs: {m}')
+
+        # Log start
+        self.log_subjectStart(sub, f'{self.gibbs_method}gibbs')
+
+        self.log_step(sub, 'checks')
+        # Perform subject checks
+        # Check indir
+        s, m = self.check_subject_indir(sub)
+        if not s:
+            self.log_error(sub, m)
+            print(m)
+            self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs', status='error')
+            return [False, m]
+        else:
+            self.log_ok(sub, m)
+            pass
 
-            # Check if we have the subdir in tmp
+        # Check if we have the subdir in tmp
+        # when chained, the pipeline has already prepared it
+        if not self.staged:
             s, m = self.check_subject_tmpdir(sub)
             if not s:
                 self.log_error(sub, m)
                 print(m)
-                self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
-                continue
-            else:
-                self.log_ok(sub, m)
-                pass
-            
-            # Copy the data
-            s, m = self.cp_rawdata(sub)
-            if not s:
-                self.log_error(sub, m)
-                print(m)
-                self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
-                continue
+                self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs', status='error')
+                return [False, m]
             else:
                 self.log_ok(sub, m)
                 pass
+        
+        self.log_step(sub, 'copy in')
+        # Copy the data
+        s, m = self.cp_rawdata(sub)
+        if not s:
+            self.log_error(sub, m)
+            print(m)
+            self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs', status='error')
+            return [False, m]
+        else:
+            self.log_ok(sub, m)
+            pass
 
 
-            # run depending on method selected
-            ap_in = self.join("tmp", sub, sub + "_AP.nii")
-            ap_out= self.join("tmp", sub, sub + "_AP_gib.nii.gz")
-            pa_in = self.join("tmp", sub, sub + "_PA.nii")
-            pa_out= self.join("tmp", sub, sub + "_PA_gib.nii.gz")
-
-            if self.gibbs_method == 'dipy':
-                self.log_info(f'{sub}', f'Running {self.gibbs_method}gibbs ringing correction for AP {sub}')
-                self.sp.run(f'dipy_gibbs_ringing {ap_in} --out_unring {ap_out} --num_processes={self.threads}', shell=True)
-                self.log_info(f'{sub}', f'Running {self.gibbs_method}gibbs ringing correction for PA {sub}')
-                self.sp.run(f'dipy_gibbs_ringing {pa_in} --out_unring {pa_out} --num_processes={self.threads}', shell=True)
-
-            elif self.gibbs_method == 'mrtrix3':
-                self.log_info(f'{sub}', f'Running {self.gibbs_method}gibbs ringing correction for AP {sub}')
-                self.sp.run(f'mrdegibbs {ap_in} {ap_out} -nthreads {self.threads}', shell=True)
-                self.log_info(f'{sub}', f'Running {self.gibbs_method}gibbs ringing correction for PA {sub}')
-                self.sp.run(f'mrdegibbs {pa_in} {pa_out} -nthreads {self.threads}', shell=True)
-
-            # QA
-            # create a directory for the QA plots
-            self.mkdir(self.join('tmp', sub, 'imgs'))
-            self.mkdir(self.join('tmp', sub, 'imgs', 'gibbs'))
-            # make gif, AP raw
-            i = self.join("tmp", sub, f"{sub}_AP.nii")
-            g = self.join("tmp", sub, "imgs", "gibbs", f"{sub}_AP_raw.gif")
-            self.gif_dwi_4d(sub=sub, image=i, gif=g, title=f'{sub} ap raw')
-            # make gif, AP gib
-            i = self.join("tmp", sub, f"{sub}_AP_gib.nii.gz")
-            g = self.join("tmp", sub, "imgs", "gibbs", f"{sub}_AP_gib.gif")
-            self.gif_dwi_4d(sub=sub, image=i, gif=g, title=f'{sub} ap gib')
-            
-            # compare volumes
-            v1 = self.join("tmp", sub, sub + "_AP.nii")
-            v2 = self.join("tmp", sub, sub + "_AP_gib.nii.gz")
-            oo = self.join("tmp", sub, "imgs", "gibbs", f"{sub}_AP_compare_raw_gibbs")
-            self.plt_compare_4d(file1=v1, file2=v2, sub=sub, out=oo, vols=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
-
-            # copy output to dataout folder
-            if self.copy:
-                try:
-                    #self.copytree(self.join('tmp', sub), self.join(self.dataout, sub))
-                    self.sp.run(f"cp -r {self.join('tmp', sub)} {self.join(self.dataout, sub)}", shell=True)
-                    self.log_ok(f'{sub}', f'Copied {sub} to {self.dataout}')
-                except:
-                    self.log_error(f'{sub}', f'Could not copy data to dataout folder: {self.dataout}')
-                    print(f'Could not copy data to dataout folder')
-                    self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
-                    continue
-            
-            if self.clean:
-                try:
-                    self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
-                    self.log_ok(f'{sub}', f'Removed tmp folder for {sub}')
-                except:
-                    self.log_error(f'{sub}', f'Could not remove tmp folder for {sub}')
-                    print(f'Could not remove tmp folder for {sub}')
-                    self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
-                    continue
+        # run depending on method selected
+        ap_in = self.join("tmp", sub, sub + "_AP.nii")
+        ap_out= self.work(self.join("tmp", sub, sub + "_AP_gib.nii.gz"))
+        pa_in = self.join("tmp", sub, sub + "_PA.nii")
+        pa_out= self.work(self.join("tmp", sub, sub + "_PA_gib.nii.gz"))
 
-            self.log_ok(f'{sub}', f'Gibbs ringing correction {self.gibbs_method} for {sub} completed successfully')
-            self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
+        self.log_step(sub, 'degibbs')
+        # AP and PA are independent, run both at the same time with half of the threads each
+        nt = self.split_threads(2)
+        if self.gibbs_method == 'dipy':
+            cmds = [f'dipy_gibbs_ringing {ap_in} --out_unring {ap_out} --num_processes={nt}', \
+                f'dipy_gibbs_ringing {pa_in} --out_unring {pa_out} --num_processes={nt}']
 
-        # Loop end
-        if self.telegram:
-            self.log_ok('ALL', f'Gibbs ringing correction completed successfully for {len(self.subs)} subjects')
-            self.tg(f'Gibbs ringing correction completed for all {len(self.subs)} subjects')
+        elif self.gibbs_method == 'mrtrix3':
+            cmds = [f'mrdegibbs {ap_in} {ap_out} -nthreads {nt}', \
+                f'mrdegibbs {pa_in} {pa_out} -nthreads {nt}']
+
+        self.log_info(f'{sub}', f'Running {self.gibbs_method}gibbs ringing correction for AP and PA {sub}')
+        s, m = self.run_cmds(sub, [cmds])
+        if not s:
+            self.log_error(f'{sub}', f'gibbs: {m}')
+            print(f'{sub} gibbs: {m}')
+            self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs', status='error')
+            return [False, f'gibbs: {m}']
+
+        self.log_step(sub, 'qa')
+        # QA
+        # create a directory for the QA plots
+        self.mkdir(self.join('tmp', sub, 'imgs'))
+        self.mkdir(self.join('tmp', sub, 'imgs', 'gibbs'))
+        # make gif, AP raw
+        i = self.join("tmp", sub, f"{sub}_AP.nii")
+        g = self.join("tmp", sub, "imgs", "gibbs", f"{sub}_AP_raw.gif")
+        self.gif_dwi_4d(sub=sub, image=i, gif=g, title=f'{sub} ap raw')
+        # make gif, AP gib
+        i = self.work(self.join("tmp", sub, f"{sub}_AP_gib.nii.gz"))
+        g = self.join("tmp", sub, "imgs", "gibbs", f"{sub}_AP_gib.gif")
+        self.gif_dwi_4d(sub=sub, image=i, gif=g, title=f'{sub} ap gib')
+        
+        # compare volumes
+        v1 = self.join("tmp", sub, sub + "_AP.nii")
+        v2 = self.work(self.join("tmp", sub, sub + "_AP_gib.nii.gz"))
+        oo = self.join("tmp", sub, "imgs", "gibbs", f"{sub}_AP_compare_raw_gibbs")
+        self.plt_compare_4d(file1=v1, file2=v2, sub=sub, out=oo, vols=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+        self.log_step(sub, 'copy out')
+        # copy output to dataout folder
+        if self.copy and not self.staged:
+            try:
+                # the content of tmp, the subject dir exists already when gibbs is run again
+                # raw data staged as links is published as files, the journal stays in tmp
+                items = [(self.join('tmp', sub, f), self.join(self.dataout, sub, f)) for f in self.ls(self.join('tmp', sub)) if f != '.journal']
+                s, m = self.publish(sub, 'gibbs', items)
+                if not s:
+                    raise IOError(m)
+                self.log_ok(f'{sub}', f'Copied {sub} to {self.dataout}')
+                self.record_stage(sub, 'gibbs', self.stage_inputs(sub, 'gibbs'), self.stage_outputs(sub, 'gibbs'))
+            except:
+                self.log_error(f'{sub}', f'Could not copy data to dataout folder: {self.dataout}')
+                print(f'Could not copy data to dataout folder')
+                self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs', status='error')
+                return [False, f'gibbs: could not copy data to dataout folder']
+        
+        self.log_step(sub, 'clean')
+        if self.clean and not self.staged:
+            try:
+                self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
+                self.log_ok(f'{sub}', f'Removed tmp folder for {sub}')
+            except:
+                self.log_error(f'{sub}', f'Could not remove tmp folder for {sub}')
+                print(f'Could not remove tmp folder for {sub}')
+                self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs', status='error')
+                return [False, f'gibbs: could not remove tmp folder']
+
+        self.log_ok(f'{sub}', f'Gibbs ringing correction {self.gibbs_method} for {sub} completed successfully')
+        self.log_subjectEnd(sub, f'{self.gibbs_method}gibbs')
+        return [True, f'gibbs: {sub} completed']
          
     def mppca(self, skip_processed):
         # Quicker and less aggressive denoising method implemented in mrtrix3
@@ -959,521 +1762,531 @@ class DwiPreprocessingClab():
         # specifically it will ceck for AP and PA nii.gz file with mppca in the name
         # May want to adjust the skip_processed to check for specific filename, which depends on preprocessing steps.
 
-        from dipy.denoise.noise_estimate import estimate_sigma
-        import matplotlib.pyplot as plt
-        import numpy as np
-
         print(f'{len(self.subs)} subjects to process')
         self.log_info('ALL', f'Running mrtrix3_mppca denoising for {len(self.subs)} subjects')
         self.log_subdump(self.subs)
 
         # Loop over subjects
+        self.prefetch_start('mppca')
+        self.spans.start('stage', 'mppca', 'ALL')
         for i, sub in enumerate(self.subs): 
-
-            if skip_processed:
-                if self.exists(self.join(self.dataout, sub, sub + '_AP_gib_mppca.nii.gz')) and self.exists(self.join(self.dataout, sub, sub + '_PA_gib_mppca.nii.gz')):
-                    self.log_ok(f'{sub}', f'Subject {sub} already processed, skipping subject')
-                    print(f'{sub} {i+1} out of {len(self.subs)} - already processed, skipping')
-                    continue
-            
-            print(f'\n{sub} {i+1} out of {len(self.subs)} - processing')
-            # Run mppca denoise
-            # if dir exists in derivatives
-
-            # Log start
-            self.log_subjectStart(sub, 'mrtrix3_mppca')
-
-            if not self.exists(self.join(self.dataout, sub)):
-                self.log_warning(f'{sub}', f'mrtrix3_mppca: Output directory does not exist, skipping subject')
-                print(f'Output directory does not exist, skipping subject: {sub}')
-                self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                continue
-            
-            # make tmp dirs
-            self.mkdir(self.join('tmp', sub))
-            self.mkdir(self.join('tmp', sub, 'imgs'))
-            self.mkdir(self.join('tmp', sub, 'imgs', 'mrtrix3_mppca'))
-            self.mkdir(self.join('tmp', sub, 'sigma_noise'))
-
-            # copy required files
-            files = ['_AP_gib.nii.gz', '_PA_gib.nii.gz', '_AP.nii', '_PA.nii', '_AP.bval', '_AP.bvec']    
-            for f in files:
-                try:
-                    self.copyfile(self.join(self.dataout, sub, sub+f), self.join('tmp', sub, sub+f))
-                    self.log_ok(f'{sub}', f'mrtrix3_mppca: Copied {sub+f} to tmp folder')
-                except:
-                    self.log_error(f'{sub}', f'mrtrix3_mppca: Could not copy file {f}')
-                    print(f'Could not copy file {f}')
-                    self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                    continue
-
-            # Load data, raw and gibbs
-            # Load raw for sigma estimation
-            try:
-                ap_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_AP.nii'))
-                pa_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_PA.nii'))
-                # Load gibbs, for sigma and mppca
-                ap_gib, __ = self.load_nifti(self.join('tmp', sub, sub + '_AP_gib.nii.gz'))
-                pa_gib, __ = self.load_nifti(self.join('tmp', sub, sub + '_PA_gib.nii.gz'))
-                ap_bval = np.loadtxt(self.join('tmp', sub, sub + '_AP.bval'))
-                pa_bval = np.array([5.,5.,5.,5.,5.])
-            except:
-                self.log_error(f'{sub}', f'mrtrix3_mppca: Could not load data')
-                print(f'{sub} Could not load data')
-                self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                continue
-
-            # Estimate sigma for raw volumes
-            try:
-                s_ap_raw = estimate_sigma(ap_raw, N = self.n_coils)
-                s_pa_raw = estimate_sigma(pa_raw, N = self.n_coils)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_raw_sigma.npy'), s_ap_raw)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_raw_sigma.npy'), s_pa_raw)
-            except:
-                self.log_error(f'{sub}', f'mrtrix3_mppca: Could not estimate sigma for raw volumes')
-                print(f'{sub} Could not estimate sigma for raw volumes')
-                self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                continue
-
-            # Estimate sigma for gibbs volumes
-            try:
-                s_ap_gib = estimate_sigma(ap_gib, N = self.n_coils)
-                s_pa_gib = estimate_sigma(pa_gib, N = self.n_coils)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_gib_sigma.npy'), s_ap_gib)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_gib_sigma.npy'), s_pa_gib)
-            except:
-                self.log_error(f'{sub}', f'mrtrix3_mppca: Could not estimate sigma for gibbs volumes')
-                print(f'{sub} Could not estimate sigma for gibbs volumes')
-                self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                continue
-            
-            # run mrtrix3_mppca
-            for d in ['AP', 'PA']:
-                try:
-                    # run mrtrix3_mppca
-                    iin = self.join("tmp", sub, sub+f"_{d}_gib.nii.gz")
-                    out = self.join("tmp", sub, sub+f"_{d}_gib_mppca.nii.gz")
-                    noise = self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+f"_{d}_mppca_noise.nii.gz")
-                    resid = self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+f"_{d}_mppca_resid.nii.gz")
-                    
-                    self.sp.run(f'dwidenoise -nthreads {self.threads} {iin} {out} -noise {noise}', shell=True)
-                    self.sp.run(f'mrcalc {iin} {out} -subtract {resid}', shell=True)
-                    self.log_ok(f'{sub}', f'mrtrix3_mppca: {d} completed successfully')
-                except:
-                    self.log_error(f'{sub}', f'mrtrix3_mppca: {d} failed')
-                    print(f'{sub} {d} mrtrix3_mppca failed')
-                    continue
-            
-            # estimate sigma for AP and PA
-            try:
-                ap_mppca, __ = self.load_nifti(self.join('tmp', sub, sub + '_AP_gib_mppca.nii.gz'))
-                pa_mppca, __ = self.load_nifti(self.join('tmp', sub, sub + '_PA_gib_mppca.nii.gz'))
-                s_ap_mppca = estimate_sigma(ap_mppca, N = self.n_coils)
-                s_pa_mppca = estimate_sigma(pa_mppca, N = self.n_coils)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_gib_mppca_sigma.npy'), s_ap_mppca)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_gib_mppca_sigma.npy'), s_pa_mppca)
-            except:
-                self.log_error(f'{sub}', f'mrtrix3_mppca: Could not estimate sigma for mrtrix3_mppca volumes')
-                print(f'{sub} Could not estimate sigma for mrtrix3_mppca volumes')
-                self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                continue
-            
-            
-            self.log_info(f'{sub}', f'mrtrix3_mppca: plotting all volumes')
-            # plot volumes - noise residuals
-            xcmp = 'gray'
-            try:
-                for d in ['AP', 'PA']:
-
-                    if d == 'AP':
-                        bvl = ap_bval
-                        gib = ap_gib
-                        raw = ap_raw
-                        mpp = ap_mppca
-                        sgib = s_ap_gib
-                        sraw = s_ap_raw
-                        smpp = s_ap_mppca
-                        resi, __ = self.load_nifti(self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+"_AP_mppca_resid.nii.gz"))
-                    else:
-                        bvl = pa_bval
-                        gib = pa_gib
-                        raw = pa_raw
-                        mpp = pa_mppca
-                        sgib = s_pa_gib
-                        sraw = s_pa_raw
-                        smpp = s_pa_mppca
-                        resi, __ = self.load_nifti(self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+"_PA_mppca_resid.nii.gz"))
-
-                    # Take the middle slice in all dimensions of an image
-                    d0 = round(raw.shape[0]/2)
-                    d1 = round(raw.shape[1]/2)
-                    d2 = round(raw.shape[2]/2)
-
-                    for i, vs in enumerate(range(0, raw.shape[3])):
-
-                        # computes the residuals
-                        #rms_gibmppca = np.sqrt(abs((gib[:,:,s,vs] - mpp[:,:,s,vs]) ** 2))
-                        #rms_rawmppca = np.sqrt(abs((raw[:,:,s,vs] - mpp[:,:,s,vs]) ** 2))
-
-                        fig1, ax = plt.subplots(4, 3, figsize=(6, 8), subplot_kw={'xticks': [], 'yticks': []})
-                    
-                        fig1.subplots_adjust(hspace=0.05, wspace=0.10)
-                        fig1.suptitle(f'{sub} {d} vol={vs} bval={int(bvl[i])}', fontsize=15)
-
-                        # Raw image
-                        ax.flat[0].imshow(raw[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[1].imshow(raw[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[1].set_title('Raw, ' + r'$\sigma_{noise}$' + f' = {round(sraw[i])}')
-                        ax.flat[2].imshow(raw[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-
-                        # Gibbs image
-                        ax.flat[3].imshow(gib[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[4].imshow(gib[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[4].set_title('Gibbs, ' + r'$\sigma_{noise}$' + f' = {round(sgib[i])}')
-                        ax.flat[5].imshow(gib[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        
-                        # mppca image
-                        ax.flat[6].imshow(mpp[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[7].imshow(mpp[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[7].set_title('MPPCA, ' + r'$\sigma_{noise}$' + f' = {round(smpp[i])}')
-                        ax.flat[8].imshow(mpp[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        
-                        # Residuals GIBBS - MPPCA
-                        ax.flat[9].imshow(resi[d0,:,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[10].imshow(resi[:,d1,:,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        ax.flat[10].set_title('Resid Gibbs - MPPCA')
-                        ax.flat[11].imshow(resi[:,:,d2,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                        
-                        sfig = self.join('tmp', sub, 'imgs', 'mrtrix3_mppca', f'{sub}_{d}_v-{1000+int(vs)}.png')
-                        fig1.savefig(sfig)
-
-                        plt.close()
-            except:
-                self.log_error(f'{sub}', f'mrtrix3_mppca: error while plotting volumes')
-                print(f'{sub} Error while plotting volumes')
-
-
-            # Plot the noise residuals
-            self.log_info(f'{sub}', f'mrtrix3_mppca: plotting noise')
-            try:
-                for d in ['AP', 'PA']:
-                    
-                    self.plot_nii_3d(nii=self.join('tmp', sub, sub + '_{d}_gib_mppca.nii.gz'), sub=sub,\
-                        title=f'{sub} {d} MPPCA noise', \
-                        out=self.join('tmp', sub, 'imgs', 'mrtrix3_mppca', f'{sub}_{d}_noise.png'))
-
-            except:
-                self.log_error(f'{sub}', f'mrtrix3_mppca: error while plotting noise')
-                print(f'{sub} Error while plotting noise')
-
-            self.log_ok(f'{sub}', f'mrtrix3_mppca: plotting completed')
-            
-            # move all files to derivatives
-            if self.copy:
-                self.log_info(f'{sub}', f'mrtrix3_mppca: copying files to derivatives')
-                try:
-                    # yet again the shutil copy fails me, fallback to the cp method
-                    for file in ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz']:
-                        self.sp.run(f'cp {self.join("tmp", sub, sub+file)} {self.join(self.dataout, sub, sub+file)}', shell=True)
-                        self.log_ok(f'sub', f'mrtrix3_mppca: copied {sub+file} to {self.dataout}')
-
-                    self.sp.run(f'cp -r {self.join("tmp", sub, "imgs", "mrtrix3_mppca")} {self.join(self.dataout, sub, "imgs")}', shell=True)
-                    self.sp.run(f'cp -r {self.join("tmp", sub, "sigma_noise")} {self.join(self.dataout, sub)}', shell=True)
-                    self.log_ok(f'{sub}', f'mrtrix3_mppca: all files copied to derivatives')
-                except:
-                    self.log_error(f'{sub}', f'mrtrix3_mppca: files not copied to derivatives')
-                    print(f'{sub} files not copied to derivatives')
-                    self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                    continue
-
-            if self.clean:
-                self.log_info(f'{sub}', f'mrtrix3_mppca: cleaning tmp folder')
-                try:
-                    #self.rmtree(self.join('tmp', sub))
-                    self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
-                    self.log_ok(f'{sub}', f'mrtrix3_mppca: tmp folder cleaned')
-                except:
-                    self.log_error(f'{sub}', f'mrtrix3_mppca: tmp folder not cleaned')
-                    print(f'{sub} tmp folder not cleaned')
-                    self.log_subjectEnd(sub, 'mrtrix3_mppca')
-                    continue
-
-            self.log_subjectEnd(sub, 'mrtrix3_mppca')
+            print(f'\n{sub} {i+1} out of {len(self.subs)}')
+            self.prefetch_wait(sub)
+            self.mppca_sub(sub, skip_processed)
+            self.prefetch_release(sub)
+        self.spans.end('stage')
+        self.prefetch_stop()
         
         if self.telegram:
             self.log_ok('ALL', f'mrtrix3_mppca completed successfully for {len(self.subs)} subjects')
             self.tg(f'mrtrix3_mppca completed for all {len(self.subs)} subjects')
 
-    def patch2self(self):
-        # Runs patch to self denoising on the data
-        # TODO implement subject skipp is processed. Look for AP, PA file with p2s in the name
+    def mppca_sub(self, sub, skip_processed):
+        # mrtrix3 mppca denoising for a single subject
+        # Returns True or False depending on success and message for logging
 
-        from dipy.core.gradients import gradient_table
-        from dipy.denoise.patch2self import patch2self
-        from dipy.denoise.noise_estimate import estimate_sigma
-        # from dipy.denoise.denspeed import determine_num_threads
-        import matplotlib.pyplot as plt
         import numpy as np
-        from fun.eta import Eta # this takes around a week on a 80 thread meachine and 300 subs
 
-        # set number of threads
-        # determine_num_threads(self.threads)
+        if skip_processed:
+            legacy = [self.join(self.dataout, sub, sub + '_AP_gib_mppca.nii.gz'), self.join(self.dataout, sub, sub + '_PA_gib_mppca.nii.gz')]
+            s, m = self.is_processed(sub, 'mppca', self.stage_inputs(sub, 'mppca'), legacy)
+            if s:
+                self.log_ok(f'{sub}', f'Subject {sub} already processed ({m}), skipping subject')
+                print(f'{sub} already processed, skipping')
+                return [True, f'mrtrix3_mppca: {sub} already processed']
+            self.log_info(f'{sub}', f'mrtrix3_mppca: {m}')
         
-        # Check if we have subjects to process
-        print(f'{len(self.subs)} subjects to process')
-        self.log_info('INIT', f'{len(self.subs)} subjects to process for patch2self denoise, taks name: {self.task}')
+        print(f'{sub} processing')
+        # Run mppca denoise
+        # if dir exists in derivatives
+
+        # Log start
+        self.log_subjectStart(sub, 'mrtrix3_mppca')
+
+        if not self.exists(self.join(self.dataout, sub)) and not self.staged:
+            self.log_warning(f'{sub}', f'mrtrix3_mppca: Output directory does not exist, skipping subject')
+            print(f'Output directory does not exist, skipping subject: {sub}')
+            self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+            return [False, f'mrtrix3_mppca: output directory does not exist']
+        
+        # Steps done by an interrupted run
+        journal, resume = self.open_journal(sub, 'mppca', self.stage_inputs(sub, 'mppca'))
 
-        # Loop over subjects
-        # dump the list of subjects to process to a file
-        self.log_subdump(self.subs)
+        # make tmp dirs
+        self.mk_tmpdirs(sub, ['imgs', self.join('imgs', 'mrtrix3_mppca'), 'sigma_noise'], resume)
 
-        # Timer and ETA
-        eta_p2s = Eta(mode='median', N = len(self.subs))
+        self.log_step(sub, 'copy in')
+        # copy required files
+        files = ['_AP_gib.nii.gz', '_PA_gib.nii.gz', '_AP.nii', '_PA.nii', '_AP.bval', '_AP.bvec']    
+        s, m = self.get_inputs(sub, files, self.dataout, 'mrtrix3_mppca', resume)
+        if not s:
+            self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+            return [False, m]
 
-        # Loop over subjects
-        for i, sub in enumerate(self.subs): 
+        self.log_step(sub, 'load')
+        # Load data, raw and gibbs
+        # Load raw for sigma estimation
+        try:
+            ap_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_AP.nii'))
+            pa_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_PA.nii'))
+            # Load gibbs, for sigma and mppca
+            ap_gib, __ = self.load_nifti(self.work(self.join('tmp', sub, sub + '_AP_gib.nii.gz')))
+            pa_gib, __ = self.load_nifti(self.work(self.join('tmp', sub, sub + '_PA_gib.nii.gz')))
+            ap_bval = np.loadtxt(self.join('tmp', sub, sub + '_AP.bval'))
+            pa_bval = np.array([5.,5.,5.,5.,5.])
+        except:
+            self.log_error(f'{sub}', f'mrtrix3_mppca: Could not load data')
+            print(f'{sub} Could not load data')
+            self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+            return [False, f'mrtrix3_mppca: could not load data']
 
-            # Run patch2self
-            # if dir exists in derivatives
+        self.log_step(sub, 'estimate sigma')
+        # Voxels the sigmas are taken over, see stat_mask
+        try:
+            mask, sfx = self.noise_mask(sub, ap_raw)
+        except:
+            self.log_warning(f'{sub}', f'mrtrix3_mppca: could not make the {self.stat_mask} mask, sigmas over the whole field of view')
+            mask, sfx = None, ''
 
-            # Log start
-            self.log_subjectStart(sub, 'dipyp2s')
+        # Estimate sigma for raw volumes
+        try:
+            s_ap_raw, s_pa_raw = self.estimate_sigmas([ap_raw, pa_raw], \
+                [self.join('tmp', sub, sub + '_AP.nii'), self.join('tmp', sub, sub + '_PA.nii')], mask=mask)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_raw_sigma{sfx}.npy'), s_ap_raw)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_raw_sigma{sfx}.npy'), s_pa_raw)
+        except:
+            self.log_error(f'{sub}', f'mrtrix3_mppca: Could not estimate sigma for raw volumes')
+            print(f'{sub} Could not estimate sigma for raw volumes')
+            self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+            return [False, f'mrtrix3_mppca: could not estimate sigma for raw volumes']
 
-            if not self.exists(self.join(self.dataout, sub)):
-                self.log_warning(f'{sub}', f'patch2self: Output directory does not exist, skipping subject')
-                print(f'Output directory does not exist, skipping subject: {sub}')
-                self.log_subjectEnd(sub, 'dipyp2s')
+        # Estimate sigma for gibbs volumes
+        try:
+            s_ap_gib, s_pa_gib = self.estimate_sigmas([ap_gib, pa_gib], \
+                [self.work(self.join('tmp', sub, sub + f'_{d}_gib.nii.gz')) for d in ['AP', 'PA']], mask=mask)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_gib_sigma{sfx}.npy'), s_ap_gib)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_gib_sigma{sfx}.npy'), s_pa_gib)
+        except:
+            self.log_error(f'{sub}', f'mrtrix3_mppca: Could not estimate sigma for gibbs volumes')
+            print(f'{sub} Could not estimate sigma for gibbs volumes')
+            self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+            return [False, f'mrtrix3_mppca: could not estimate sigma for gibbs volumes']
+        
+        self.log_step(sub, 'denoise')
+        # run mrtrix3_mppca, AP and PA at the same time, residuals once both are denoised
+        cmds = [[], []]
+        files = {}
+        nt = self.split_threads(2)
+        for d in ['AP', 'PA']:
+            iin = self.work(self.join("tmp", sub, sub+f"_{d}_gib.nii.gz"))
+            out = self.work(self.join("tmp", sub, sub+f"_{d}_gib_mppca.nii.gz"))
+            noise = self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+f"_{d}_mppca_noise.nii.gz")
+            resid = self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+f"_{d}_mppca_resid.nii.gz")
+
+            if journal.done(d):
+                self.log_ok(f'{sub}', f'mrtrix3_mppca: {d} done by the interrupted run')
                 continue
             
-            # Timer update, return ETA to log
-            self.log_info(sub, eta_p2s.update())
-            # make tmp dirs
-            self.mkdir(self.join('tmp', sub))
-            self.mkdir(self.join('tmp', sub, 'imgs'))
-            self.mkdir(self.join('tmp', sub, 'imgs', 'patch2self'))
-            self.mkdir(self.join('tmp', sub, 'sigma_noise'))
-
-            # copy required files
-            files = ['_AP.bval', '_AP.bvec', '_AP_gib.nii.gz', '_PA_gib.nii.gz', '_AP.json', '_AP.nii', '_PA.nii']    
-            for f in files:
-                try:
-                    self.copyfile(self.join(self.dataout, sub, sub+f), self.join('tmp', sub, sub+f))
-                    self.log_ok(f'{sub}', f'patch2self: Copied {sub+f} to tmp folder')
-                except:
-                    self.log_error(f'{sub}', f'patch2self: Could not copy file {f}')
-                    print(f'Could not copy file {f}')
-                    self.log_subjectEnd(sub, 'dipyp2s')
-                    continue
+            # -force, a run that was interrupted may have left some of the outputs
+            cmds[0].append(f'dwidenoise -force -nthreads {nt} {iin} {out} -noise {noise}')
+            cmds[1].append(f'mrcalc -force {iin} {out} -subtract {resid}')
+            files[d] = [out, noise, resid]
 
-            # Load gradient table
-            try:
-                gtab = gradient_table(self.join('tmp', sub, sub + '_AP.bval'), self.join('tmp', sub, sub + '_AP.bvec'))
-                txt = f'bvals shape {gtab.bvals.shape}, min = {gtab.bvals.min()}, max = {gtab.bvals.max()} with {len(np.unique(gtab.bvals))} unique values: {np.unique(gtab.bvals)}bvecs shape {gtab.bvecs.shape}, min = {gtab.bvecs.min()}, max = {gtab.bvecs.max()}'
-                self.log_info(f'{sub}', f'patch2self: {txt}')
-                # save b0s mask as numpy array  - which volumes are b0 in AP (bool)
-                np.save(self.join('tmp', sub, f'{sub}_AP_b0mask.npy'), gtab.b0s_mask)
-            except:
-                self.log_error(f'{sub}', f'patch2self: Could not load gradient table')
-                print(f'{sub} Could not load gradient table')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-            
-            # Load data, raw and gibbs
-            # Load raw for sigma estimation
-            try:
-                ap_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_AP.nii'))
-                pa_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_PA.nii'))
-                # Load gibbs, for sigma and patch2self
-                ap_gib, ap_gib_aff = self.load_nifti(self.join('tmp', sub, sub + '_AP_gib.nii.gz'))
-                pa_gib, pa_gib_aff = self.load_nifti(self.join('tmp', sub, sub + '_PA_gib.nii.gz'))
-                ap_bval = np.loadtxt(self.join('tmp', sub, f'{sub}_AP.bval'))
-                pa_bval = np.array([5.,5.,5.,5.,5.])
-            except:
-                self.log_error(f'{sub}', f'patch2self: Could not load data')
-                print(f'{sub} Could not load data')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-
-            # Estimate sigma for raw volumes
-            try:
-                s_ap_raw = estimate_sigma(ap_raw, N = self.n_coils)
-                s_pa_raw = estimate_sigma(pa_raw, N = self.n_coils)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_raw_sigma.npy'), s_ap_raw)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_raw_sigma.npy'), s_pa_raw)
-            except:
-                self.log_error(f'{sub}', f'patch2self: Could not estimate sigma for raw volumes')
-                print(f'{sub} Could not estimate sigma for raw volumes')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-
-            # Estimate sigma for gibbs volumes
-            try:
-                s_ap_gib = estimate_sigma(ap_gib, N = self.n_coils)
-                s_pa_gib = estimate_sigma(pa_gib, N = self.n_coils)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_gib_sigma.npy'), s_ap_gib)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_gib_sigma.npy'), s_pa_gib)
-            except:
-                self.log_error(f'{sub}', f'patch2self: Could not estimate sigma for gibbs volumes')
-                print(f'{sub} Could not estimate sigma for gibbs volumes')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-            
-            # run patch2self on AP
-            try:
-                ap_p2s = patch2self(ap_gib, ap_bval, model='ols', shift_intensity=True, \
-                    clip_negative_vals=False, b0_threshold=50, verbose=True)
-                self.log_ok(f'{sub}', f'patch2self: AP patch2self completed successfully')
-            except:
-                self.log_error(f'{sub}', f'patch2self: AP patch2self failed')
-                print(f'{sub} AP patch2self failed')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-            
-            # run patch2self on PA
-            try:
-                pa_p2s = patch2self(pa_gib, pa_bval, model='ols', shift_intensity=True, \
-                    clip_negative_vals=False, b0_threshold=50, verbose=True)
-                self.log_ok(f'{sub}', f'patch2self: PA patch2self completed successfully')
-            except:
-                self.log_error(f'{sub}', f'patch2self: PA patch2self failed')
-                print(f'{sub} PA patch2self failed')
-                continue
-            
-            # estimate sigma for AP and PA
-            try:
-                s_ap_p2s = estimate_sigma(ap_p2s, N = self.n_coils)
-                s_pa_p2s = estimate_sigma(pa_p2s, N = self.n_coils)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_p2s_sigma.npy'), s_ap_p2s)
-                np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_p2s_sigma.npy'), s_pa_p2s)
-            except:
-                self.log_error(f'{sub}', f'patch2self: Could not estimate sigma for patch2self volumes')
-                print(f'{sub} Could not estimate sigma for patch2self volumes')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-            
-            # save denoised vols
-            # AP
-            try:
-                self.save_nifti(self.join('tmp', sub, sub+'_AP_p2s.nii.gz'), ap_p2s, ap_gib_aff)
-                self.log_ok(f'{sub}', f'patch2self: AP patch2self saved successfully')
-            except:
-                self.log_error(f'{sub}', f'patch2self: AP patch2self save failed')
-                print(f'{sub} AP patch2self save failed')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-            # PA
-            try:
-                self.save_nifti(self.join('tmp', sub, sub+'_PA_p2s.nii.gz'), pa_p2s, pa_gib_aff)
-                self.log_ok(f'{sub}', f'patch2self: PA patch2self saved successfully')
-            except:
-                self.log_error(f'{sub}', f'patch2self: PA patch2self save failed')
-                print(f'{sub} PA patch2self save failed')
-                self.log_subjectEnd(sub, 'dipyp2s')
-                continue
-            
-            self.log_info(f'{sub}', f'patch2self: plotting all volumes')
-            # plot volumes - noise residuals
-            xcmp = 'gray'
-            s = 42
+        if len(files) > 0:
+            s, m = self.run_cmds(sub, cmds)
+            if not s:
+                self.log_error(f'{sub}', f'mrtrix3_mppca: {m}')
+                print(f'{sub} mrtrix3_mppca failed: {m}')
+                self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+                return [False, f'mrtrix3_mppca: {m}']
+            for d in files:
+                journal.complete(d, files[d])
+                self.log_ok(f'{sub}', f'mrtrix3_mppca: {d} completed successfully')
+        
+        self.log_step(sub, 'estimate sigma denoised')
+        # estimate sigma for AP and PA
+        try:
+            ap_mppca, __ = self.load_nifti(self.work(self.join('tmp', sub, sub + '_AP_gib_mppca.nii.gz')))
+            pa_mppca, __ = self.load_nifti(self.work(self.join('tmp', sub, sub + '_PA_gib_mppca.nii.gz')))
+            s_ap_mppca, s_pa_mppca = self.estimate_sigmas([ap_mppca, pa_mppca], \
+                [self.work(self.join('tmp', sub, sub + f'_{d}_gib_mppca.nii.gz')) for d in ['AP', 'PA']], mask=mask)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_gib_mppca_sigma{sfx}.npy'), s_ap_mppca)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_gib_mppca_sigma{sfx}.npy'), s_pa_mppca)
+            if self.stats is not None:
+                self.log_info(f'{sub}', f'mrtrix3_mppca: {self.stats.report()}')
+        except:
+            self.log_error(f'{sub}', f'mrtrix3_mppca: Could not estimate sigma for mrtrix3_mppca volumes')
+            print(f'{sub} Could not estimate sigma for mrtrix3_mppca volumes')
+            self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+            return [False, f'mrtrix3_mppca: could not estimate sigma for mrtrix3_mppca volumes']
+        
+        
+        self.log_step(sub, 'qa')
+        self.log_info(f'{sub}', f'mrtrix3_mppca: plotting all volumes')
+        # plot volumes - noise residuals
+        try:
             for d in ['AP', 'PA']:
 
                 if d == 'AP':
                     bvl = ap_bval
                     gib = ap_gib
                     raw = ap_raw
-                    p2s = ap_p2s
+                    mpp = ap_mppca
                     sgib = s_ap_gib
                     sraw = s_ap_raw
-                    sp2s = s_ap_p2s
+                    smpp = s_ap_mppca
+                    resi = self.lazy_nifti(self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+"_AP_mppca_resid.nii.gz"))
                 else:
                     bvl = pa_bval
                     gib = pa_gib
                     raw = pa_raw
-                    p2s = pa_p2s
+                    mpp = pa_mppca
                     sgib = s_pa_gib
                     sraw = s_pa_raw
-                    sp2s = s_pa_p2s
+                    smpp = s_pa_mppca
+                    resi = self.lazy_nifti(self.join("tmp", sub, "imgs", "mrtrix3_mppca", sub+"_PA_mppca_resid.nii.gz"))
 
+                self.plt_mppca_vols(sub, d, bvl, raw, gib, mpp, resi, sraw, sgib, smpp)
+        except:
+            self.log_error(f'{sub}', f'mrtrix3_mppca: error while plotting volumes')
+            print(f'{sub} Error while plotting volumes')
 
-                for i, vs in enumerate(range(0, raw.shape[3])):
-
-                    # computes the residuals
-                    rms_gibp2s = np.sqrt(abs((gib[:,:,s,vs] - p2s[:,:,s,vs]) ** 2))
-                    rms_rawp2s = np.sqrt(abs((raw[:,:,s,vs] - p2s[:,:,s,vs]) ** 2))
 
-                    fig1, ax = plt.subplots(2, 3, figsize=(12, 12),subplot_kw={'xticks': [], 'yticks': []})
+        # Plot the noise residuals
+        self.log_info(f'{sub}', f'mrtrix3_mppca: plotting noise')
+        try:
+            for d in ['AP', 'PA']:
                 
-                    fig1.subplots_adjust(hspace=0.05, wspace=0.05)
-                    fig1.suptitle(f'{sub} {d} vol={vs} bval={int(bvl[i])}', fontsize =20)
-
-                    # Raw image
-                    ax.flat[0].imshow(raw[:,:,s,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                    ax.flat[0].set_title('Raw, ' + r'$\sigma_{noise}$' + f' = {round(sraw[i])}')
-                    # Gibbs image
-                    ax.flat[1].imshow(gib[:,:,s,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                    ax.flat[1].set_title('Gibbs, ' + r'$\sigma_{noise}$' + f' = {round(sgib[i])}')
-                    # p2s image
-                    ax.flat[2].imshow(p2s[:,:,s,vs].T, cmap=xcmp, interpolation='none',origin='lower')
-                    ax.flat[2].set_title('P2S, ' + r'$\sigma_{noise}$' + f' = {round(sp2s[i])}')
-                    # Raw - p2s
-                    ax.flat[3].imshow(rms_rawp2s.T, cmap=xcmp, interpolation='none',origin='lower')
-                    ax.flat[3].set_title('Raw - P2S')
-                    # Gibbs - p2s
-                    ax.flat[4].imshow(rms_gibp2s.T, cmap=xcmp, interpolation='none',origin='lower')
-                    ax.flat[4].set_title('Gibbs - P2S')
-                    
-                    sfig = self.join('tmp', sub, 'imgs', 'patch2self', f'{sub}_{d}_v-{1000+int(vs)}.png')
-                    fig1.savefig(sfig)
-
-                    plt.close()
-
-            self.log_ok(f'{sub}', f'patch2self: plotting all volumes completed successfully')
-            # move all files to derivatives
-            if self.copy:
-                self.log_info(f'{sub}', f'patch2self: copying files to derivatives')
-                try:
-                    # yet again the shutil copy fails me, fallback to the cp method
-                    for file in ['_AP_p2s.nii.gz', '_PA_p2s.nii.gz', '_AP_b0mask.npy']:
-                        self.sp.run(f'cp {self.join("tmp", sub, sub+file)} {self.join(self.dataout, sub, sub+file)}', shell=True)
-                        self.log_ok(f'sub', f'patch2self: copied {sub+file} to {self.dataout}')
-
-                    self.sp.run(f'cp -r {self.join("tmp", sub, "imgs", "patch2self")} {self.join(self.dataout, sub, "imgs")}', shell=True)
-                    self.sp.run(f'cp -r {self.join("tmp", sub, "sigma_noise")} {self.join(self.dataout, sub)}', shell=True)
-                    self.log_ok(f'{sub}', f'patch2self: all files copied to derivatives')
-                except:
-                    self.log_error(f'{sub}', f'patch2self: files not copied to derivatives')
-                    print(f'{sub} files not copied to derivatives')
-                    self.log_subjectEnd(sub, 'dipyp2s')
-                    continue
+                self.plot_nii_3d(nii=self.join('tmp', sub, 'imgs', 'mrtrix3_mppca', sub + f'_{d}_mppca_noise.nii.gz'), sub=sub,\
+                    title=f'{sub} {d} MPPCA noise', \
+                    out=self.join('tmp', sub, 'imgs', 'mrtrix3_mppca', f'{sub}_{d}_noise.png'))
 
-            if self.clean:
-                self.log_info(f'{sub}', f'patch2self: cleaning tmp folder')
-                try:
-                    #self.rmtree(self.join('tmp', sub))
-                    self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
-                    self.log_ok(f'{sub}', f'patch2self: tmp folder cleaned')
-                except:
-                    self.log_error(f'{sub}', f'patch2self: tmp folder not cleaned')
-                    print(f'{sub} tmp folder not cleaned')
-                    self.log_subjectEnd(sub, 'dipyp2s')
-                    continue
+        except:
+            self.log_error(f'{sub}', f'mrtrix3_mppca: error while plotting noise')
+            print(f'{sub} Error while plotting noise')
+
+        self.log_ok(f'{sub}', f'mrtrix3_mppca: plotting completed')
+        
+        self.log_step(sub, 'copy out')
+        # move all files to derivatives
+        if self.copy and not self.staged:
+            self.log_info(f'{sub}', f'mrtrix3_mppca: copying files to derivatives')
+            try:
+                items = [(self.work(self.join('tmp', sub, sub+f)), self.join(self.dataout, sub, sub+f)) for f in ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz']]
+                for d in [self.join('imgs', 'mrtrix3_mppca'), 'sigma_noise']:
+                    items.append((self.join('tmp', sub, d), self.join(self.dataout, sub, d)))
+                s, m = self.publish(sub, 'mrtrix3_mppca', items)
+                if not s:
+                    raise IOError(m)
+                self.log_ok(f'{sub}', f'mrtrix3_mppca: all files copied to derivatives')
+                self.record_stage(sub, 'mppca', self.stage_inputs(sub, 'mppca'), self.stage_outputs(sub, 'mppca'))
+            except:
+                self.log_error(f'{sub}', f'mrtrix3_mppca: files not copied to derivatives')
+                print(f'{sub} files not copied to derivatives')
+                self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+                return [False, f'mrtrix3_mppca: files not copied to derivatives']
+
+        self.log_step(sub, 'clean')
+        if self.clean and not self.staged:
+            self.log_info(f'{sub}', f'mrtrix3_mppca: cleaning tmp folder')
+            try:
+                #self.rmtree(self.join('tmp', sub))
+                self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
+                self.log_ok(f'{sub}', f'mrtrix3_mppca: tmp folder cleaned')
+            except:
+                self.log_error(f'{sub}', f'mrtrix3_mppca: tmp folder not cleaned')
+                print(f'{sub} tmp folder not cleaned')
+                self.log_subjectEnd(sub, 'mrtrix3_mppca', status='error')
+                return [False, f'mrtrix3_mppca: tmp folder not cleaned']
+
+        self.log_subjectEnd(sub, 'mrtrix3_mppca')
+        return [True, f'mrtrix3_mppca: {sub} completed']
+
+    def patch2self(self, skip_processed=False):
+        # Runs patch to self denoising on the data
+        # TODO implement subject skipp is processed. Look for AP, PA file with p2s in the name
+
+        from fun.eta import Eta # this takes around a week on a 80 thread meachine and 300 subs
+
+        # set number of threads
+        # determine_num_threads(self.threads)
+        
+        # Check if we have subjects to process
+        print(f'{len(self.subs)} subjects to process')
+        self.log_info('INIT', f'{len(self.subs)} subjects to process for patch2self denoise, taks name: {self.task}')
+
+        # Loop over subjects
+        # dump the list of subjects to process to a file
+        self.log_subdump(self.subs)
+
+        # Timer and ETA
+        eta_p2s = Eta(mode='median', N = len(self.subs))
+
+        # Loop over subjects
+        self.prefetch_start('patch2self')
+        self.spans.start('stage', 'patch2self', 'ALL')
+        for i, sub in enumerate(self.subs): 
 
-            self.log_subjectEnd(sub, 'dipyp2s')
+            # Timer update, return ETA to log
+            self.log_info(sub, eta_p2s.update())
+            self.prefetch_wait(sub)
+            self.patch2self_sub(sub, skip_processed)
+            self.prefetch_release(sub)
+        self.spans.end('stage')
+        self.prefetch_stop()
         
         # All subs done
         self.log_ok('ALL', f'Patch2Self completed successfully for {len(self.subs)} subjects')
+        if self.p2s_sample is not None and self.p2s_check:
+            s, m = self.p2s_sample_report()
+            if s:
+                self.log_ok('ALL', m)
+            else:
+                self.log_warning('ALL', m)
 
         if self.telegram:
             self.tg(f'Patch2Self completed for all {len(self.subs)} subjects')
 
-    def topup(self, skip_processed, wait=0):
+    def patch2self_sub(self, sub, skip_processed=False):
+        # Patch2self denoising for a single subject
+        # Returns True or False depending on success and message for logging
 
-        import json
-        import matplotlib.pyplot as plt
+        from dipy.core.gradients import gradient_table
+        # from dipy.denoise.denspeed import determine_num_threads
         import numpy as np
+
+        if skip_processed:
+            legacy = [self.join(self.dataout, sub, sub + '_AP_p2s.nii.gz'), self.join(self.dataout, sub, sub + '_PA_p2s.nii.gz')]
+            s, m = self.is_processed(sub, 'patch2self', self.stage_inputs(sub, 'patch2self'), legacy)
+            if s:
+                self.log_ok(f'{sub}', f'Subject {sub} already processed ({m}), skipping subject')
+                print(f'{sub} already processed, skipping')
+                return [True, f'patch2self: {sub} already processed']
+            self.log_info(f'{sub}', f'patch2self: {m}')
+
+        # Run patch2self
+        # if dir exists in derivatives
+
+        # Log start
+        self.log_subjectStart(sub, 'dipyp2s')
+
+        if not self.exists(self.join(self.dataout, sub)) and not self.staged:
+            self.log_warning(f'{sub}', f'patch2self: Output directory does not exist, skipping subject')
+            print(f'Output directory does not exist, skipping subject: {sub}')
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, f'patch2self: output directory does not exist']
+        
+        # Steps done by an interrupted run
+        journal, resume = self.open_journal(sub, 'patch2self', self.stage_inputs(sub, 'patch2self'))
+
+        # make tmp dirs
+        self.mk_tmpdirs(sub, ['imgs', self.join('imgs', 'patch2self'), 'sigma_noise'], resume)
+
+        self.log_step(sub, 'copy in')
+        # copy required files
+        files = ['_AP.bval', '_AP.bvec', '_AP_gib.nii.gz', '_PA_gib.nii.gz', '_AP.json', '_AP.nii', '_PA.nii']    
+        s, m = self.get_inputs(sub, files, self.dataout, 'patch2self', resume)
+        if not s:
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, m]
+
+        self.log_step(sub, 'load')
+        # Load gradient table
+        try:
+            gtab = gradient_table(self.join('tmp', sub, sub + '_AP.bval'), self.join('tmp', sub, sub + '_AP.bvec'))
+            txt = f'bvals shape {gtab.bvals.shape}, min = {gtab.bvals.min()}, max = {gtab.bvals.max()} with {len(np.unique(gtab.bvals))} unique values: {np.unique(gtab.bvals)}bvecs shape {gtab.bvecs.shape}, min = {gtab.bvecs.min()}, max = {gtab.bvecs.max()}'
+            self.log_info(f'{sub}', f'patch2self: {txt}')
+            # save b0s mask as numpy array  - which volumes are b0 in AP (bool)
+            np.save(self.join('tmp', sub, f'{sub}_AP_b0mask.npy'), gtab.b0s_mask)
+            if self.stats is not None:
+                self.stats.put(self.join('tmp', sub, sub + '_AP.bval'), 'b0s_mask_b50', gtab.b0s_mask)
+        except:
+            self.log_error(f'{sub}', f'patch2self: Could not load gradient table')
+            print(f'{sub} Could not load gradient table')
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, f'patch2self: could not load gradient table']
+        
+        # Load data, raw and gibbs
+        # Load raw for sigma estimation
+        try:
+            ap_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_AP.nii'))
+            pa_raw, __ = self.load_nifti(self.join('tmp', sub, sub + '_PA.nii'))
+            # Load gibbs, for sigma and patch2self
+            ap_gib, ap_gib_aff = self.load_nifti(self.work(self.join('tmp', sub, sub + '_AP_gib.nii.gz')))
+            pa_gib, pa_gib_aff = self.load_nifti(self.work(self.join('tmp', sub, sub + '_PA_gib.nii.gz')))
+            ap_bval = np.loadtxt(self.join('tmp', sub, f'{sub}_AP.bval'))
+            pa_bval = np.array([5.,5.,5.,5.,5.])
+        except:
+            self.log_error(f'{sub}', f'patch2self: Could not load data')
+            print(f'{sub} Could not load data')
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, f'patch2self: could not load data']
+
+        self.log_step(sub, 'estimate sigma')
+        # Voxels the sigmas are taken over, see stat_mask
+        try:
+            mask, sfx = self.noise_mask(sub, ap_raw)
+        except:
+            self.log_warning(f'{sub}', f'patch2self: could not make the {self.stat_mask} mask, sigmas over the whole field of view')
+            mask, sfx = None, ''
+
+        # Estimate sigma for raw volumes
+        try:
+            s_ap_raw, s_pa_raw = self.estimate_sigmas([ap_raw, pa_raw], \
+                [self.join('tmp', sub, sub + '_AP.nii'), self.join('tmp', sub, sub + '_PA.nii')], mask=mask)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_raw_sigma{sfx}.npy'), s_ap_raw)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_raw_sigma{sfx}.npy'), s_pa_raw)
+        except:
+            self.log_error(f'{sub}', f'patch2self: Could not estimate sigma for raw volumes')
+            print(f'{sub} Could not estimate sigma for raw volumes')
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, f'patch2self: could not estimate sigma for raw volumes']
+
+        # Estimate sigma for gibbs volumes
+        try:
+            s_ap_gib, s_pa_gib = self.estimate_sigmas([ap_gib, pa_gib], \
+                [self.work(self.join('tmp', sub, sub + f'_{d}_gib.nii.gz')) for d in ['AP', 'PA']], mask=mask)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_gib_sigma{sfx}.npy'), s_ap_gib)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_gib_sigma{sfx}.npy'), s_pa_gib)
+        except:
+            self.log_error(f'{sub}', f'patch2self: Could not estimate sigma for gibbs volumes')
+            print(f'{sub} Could not estimate sigma for gibbs volumes')
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, f'patch2self: could not estimate sigma for gibbs volumes']
+        
+        # Voxels the regressions are trained on, see p2s_sample
+        brain = None
+        if self.p2s_sample is not None:
+            try:
+                brain = self.brain(sub, ap_raw)
+            except:
+                self.log_warning(f'{sub}', f'patch2self: could not make the brain mask, regressions trained on a sample of all the voxels')
+
+        self.log_step(sub, 'denoise')
+        # run patch2self on AP and PA
+        # each result is saved as soon as it is ready, so a restarted run does not
+        # have to denoise it again
+        p2s = {}
+        for d, gib, bval, aff, sgib in [('AP', ap_gib, ap_bval, ap_gib_aff, s_ap_gib), ('PA', pa_gib, pa_bval, pa_gib_aff, s_pa_gib)]:
+            out = self.work(self.join('tmp', sub, sub+f'_{d}_p2s.nii.gz'))
+            if journal.done(d):
+                try:
+                    p2s[d], __ = self.load_nifti(out)
+                    self.log_ok(f'{sub}', f'patch2self: {d} patch2self loaded from the interrupted run')
+                    continue
+                except:
+                    self.log_warning(f'{sub}', f'patch2self: could not load {d} patch2self from the interrupted run, running again')
+            try:
+                p2s[d] = self.denoise_p2s(gib, bval, brain)
+                self.log_ok(f'{sub}', f'patch2self: {d} patch2self completed successfully')
+            except:
+                self.log_error(f'{sub}', f'patch2self: {d} patch2self failed')
+                print(f'{sub} {d} patch2self failed')
+                self.log_subjectEnd(sub, 'dipyp2s', status='error')
+                return [False, f'patch2self: {d} patch2self failed']
+            if self.p2s_sample is not None and sub in (self.p2s_check or []):
+                # held-out subject, the sampled fit against the fit on all the voxels
+                try:
+                    s, m = self.p2s_sample_check(sub, d, gib, bval, p2s[d], brain, np.median(sgib))
+                    if s:
+                        self.log_info(f'{sub}', f'patch2self: {m}')
+                    else:
+                        self.log_warning(f'{sub}', f'patch2self: {m}')
+                except:
+                    self.log_warning(f'{sub}', f'patch2self: {d} sample check failed')
+            try:
+                self.save_nifti(out, p2s[d], aff)
+                journal.complete(d, [out])
+                self.log_ok(f'{sub}', f'patch2self: {d} patch2self saved successfully')
+            except:
+                self.log_error(f'{sub}', f'patch2self: {d} patch2self save failed')
+                print(f'{sub} {d} patch2self save failed')
+                self.log_subjectEnd(sub, 'dipyp2s', status='error')
+                return [False, f'patch2self: {d} patch2self save failed']
+        ap_p2s = p2s['AP']
+        pa_p2s = p2s['PA']
+        
+        self.log_step(sub, 'estimate sigma denoised')
+        # estimate sigma for AP and PA
+        try:
+            # the file holds the array only if it was saved as computed
+            s_ap_p2s, s_pa_p2s = self.estimate_sigmas([ap_p2s, pa_p2s], \
+                [self.work(self.join('tmp', sub, sub + f'_{d}_p2s.nii.gz')) if self.storage_dtype is None else None for d in ['AP', 'PA']], mask=mask)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_AP_p2s_sigma{sfx}.npy'), s_ap_p2s)
+            np.save(self.join('tmp', sub, 'sigma_noise', f'{sub}_PA_p2s_sigma{sfx}.npy'), s_pa_p2s)
+            if self.stats is not None:
+                self.log_info(f'{sub}', f'patch2self: {self.stats.report()}')
+        except:
+            self.log_error(f'{sub}', f'patch2self: Could not estimate sigma for patch2self volumes')
+            print(f'{sub} Could not estimate sigma for patch2self volumes')
+            self.log_subjectEnd(sub, 'dipyp2s', status='error')
+            return [False, f'patch2self: could not estimate sigma for patch2self volumes']
+        
+        self.log_step(sub, 'qa')
+        self.log_info(f'{sub}', f'patch2self: plotting all volumes')
+        # plot volumes - noise residuals
+        s = 42
+        for d in ['AP', 'PA']:
+
+            if d == 'AP':
+                bvl = ap_bval
+                gib = ap_gib
+                raw = ap_raw
+                p2s = ap_p2s
+                sgib = s_ap_gib
+                sraw = s_ap_raw
+                sp2s = s_ap_p2s
+            else:
+                bvl = pa_bval
+                gib = pa_gib
+                raw = pa_raw
+                p2s = pa_p2s
+                sgib = s_pa_gib
+                sraw = s_pa_raw
+                sp2s = s_pa_p2s
+
+            self.plt_p2s_vols(sub, d, bvl, raw, gib, p2s, sraw, sgib, sp2s, slice=s)
+
+        self.log_ok(f'{sub}', f'patch2self: plotting all volumes completed successfully')
+        self.log_step(sub, 'copy out')
+        # move all files to derivatives
+        if self.copy and not self.staged:
+            self.log_info(f'{sub}', f'patch2self: copying files to derivatives')
+            try:
+                items = [(self.work(self.join('tmp', sub, sub+f)), self.join(self.dataout, sub, sub+f)) for f in ['_AP_p2s.nii.gz', '_PA_p2s.nii.gz', '_AP_b0mask.npy']]
+                for d in [self.join('imgs', 'patch2self'), 'sigma_noise']:
+                    items.append((self.join('tmp', sub, d), self.join(self.dataout, sub, d)))
+                s, m = self.publish(sub, 'patch2self', items)
+                if not s:
+                    raise IOError(m)
+                self.log_ok(f'{sub}', f'patch2self: all files copied to derivatives')
+                self.record_stage(sub, 'patch2self', self.stage_inputs(sub, 'patch2self'), self.stage_outputs(sub, 'patch2self'))
+            except:
+                self.log_error(f'{sub}', f'patch2self: files not copied to derivatives')
+                print(f'{sub} files not copied to derivatives')
+                self.log_subjectEnd(sub, 'dipyp2s', status='error')
+                return [False, f'patch2self: files not copied to derivatives']
+
+        self.log_step(sub, 'clean')
+        if self.clean and not self.staged:
+            self.log_info(f'{sub}', f'patch2self: cleaning tmp folder')
+            try:
+                #self.rmtree(self.join('tmp', sub))
+                self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
+                self.log_ok(f'{sub}', f'patch2self: tmp folder cleaned')
+            except:
+                self.log_error(f'{sub}', f'patch2self: tmp folder not cleaned')
+                print(f'{sub} tmp folder not cleaned')
+                self.log_subjectEnd(sub, 'dipyp2s', status='error')
+                return [False, f'patch2self: tmp folder not cleaned']
+
+        self.log_subjectEnd(sub, 'dipyp2s')
+        return [True, f'patch2self: {sub} completed']
+
+    def topup(self, skip_processed, wait=0):
+
         import time
         #from fun.eta import Eta
-        from dipy.core.gradients import gradient_table
         
         # Runs FSL topup via subprocess
         # https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/topup
@@ -1492,209 +2305,220 @@ class DwiPreprocessingClab():
         self.log_subdump(self.subs)
 
         # Loop over subjects
+        self.prefetch_start('topup')
+        self.spans.start('stage', 'topup', 'ALL')
         for i, sub in enumerate(self.subs): 
+            print(f'{sub} {i+1} out of {len(self.subs)}')
+            self.prefetch_wait(sub)
+            self.topup_sub(sub, skip_processed)
+            self.prefetch_release(sub)
+        self.spans.end('stage')
+        self.prefetch_stop()
 
-            # set acqparams file, we will check if it exists and skip if it does
-            acqpar = self.join("tmp", sub, f"{sub}_acqparams.txt")
+        # Log end of all
+        self.log_ok('ALL', f'Topup completed successfully for {len(self.subs)} subjects')
+        # telegram send info
+        if self.telegram:
+            self.tg(f'Topup {self.task} completed for all {len(self.subs)} subjects')
 
-            if skip_processed:
-                if self.exists(self.join(self.dataout, sub, sub + '_acqparams.txt')):
-                    self.log_ok(f'{sub}', f'Subject {sub} already processed, skipping subject')
-                    print(f'{sub} {i+1} out of {len(self.subs)} - already processed, skipping')
-                    continue
+    def topup_sub(self, sub, skip_processed):
+        # FSL topup for a single subject
+        # Returns True or False depending on success and message for logging
 
-            print(f'{sub} {i+1} out of {len(self.subs)} - processing')
+        import matplotlib.pyplot as plt
+        import numpy as np
 
-            # Log start
-            self.log_subjectStart(sub, 'topup')
+        # set acqparams file, we will check if it exists and skip if it does
+        acqpar = self.join("tmp", sub, f"{sub}_acqparams.txt")
 
-            if not self.exists(self.join(self.dataout, sub)):
-                self.log_warning(f'{sub}', f'topup: Output directory does not exist, skipping subject')
-                print(f'Output directory does not exist, skipping subject: {sub}')
-                self.log_subjectEnd(sub, 'topup')
-                continue
-            
-            # make tmp dirs
-            self.mkdir(self.join('tmp', sub))
-            self.mkdir(self.join('tmp', sub, 'imgs'))
-            self.mkdir(self.join('tmp', sub, 'imgs', 'topup'))
-
-            # copy required files
-            files = ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz', '_AP.json', '_PA.json', '_AP.bval', '_AP.bvec']    
-            for f in files:
-                try:
-                    self.copyfile(self.join(self.dataout, sub, sub+f), self.join('tmp', sub, sub+f))
-                    self.log_ok(f'{sub}', f'topup: Copied {sub+f} to tmp folder')
-                except:
-                    self.log_error(f'{sub}', f'topup: Could not copy file {f}')
-                    print(f'Could not copy file {f}')
-                    self.log_subjectEnd(sub, 'topup')
-                    continue
-            
-            # create acqparams.txt for topup
-            # 0 1 0 TotalReadoutTime AP
-            # 0 -1 0 TotalReadoutTime PA
-            try:
-                # Create b0 mask
-                gtab = gradient_table(f'tmp/{sub}/{sub}_AP.bval', f'tmp/{sub}/{sub}_AP.bvec')
-            except:
-                self.log_error(f'{sub}', f'topup: Could not create gradient table')
-                print(f'{sub} Could not create gradient table')
-                self.log_subjectEnd(sub, 'topup')
-                continue
+        if skip_processed:
+            s, m = self.is_processed(sub, 'topup', self.stage_inputs(sub, 'topup'), [self.join(self.dataout, sub, sub + '_acqparams.txt')])
+            if s:
+                self.log_ok(f'{sub}', f'Subject {sub} already processed ({m}), skipping subject')
+                print(f'{sub} already processed, skipping')
+                return [True, f'topup: {sub} already processed']
+            self.log_info(f'{sub}', f'topup: {m}')
 
-            # Extract b0s
-            apim = self.join('tmp', sub, sub+'_AP_gib_mppca.nii.gz')
-            paim = self.join('tmp', sub, sub+'_PA_gib_mppca.nii.gz')
-            apb0 = self.join('tmp', sub, sub+'_AP_gib_mppca_b0s.nii.gz') # single b in AP direction
-            pab0 = self.join('tmp', sub, sub+'_PA_gib_mppca_b0s.nii.gz') # single b in PA direction
-            b0im = self.join('tmp', sub, sub+'_gib_mppca_b0s.nii.gz') # merged b0s AP + PA
+        print(f'{sub} processing')
 
-            try:
-                # Load volumes
-                dwi_ap, affine_ap = self.load_nifti(apim)
-                dwi_pa, affine_pa = self.load_nifti(paim)
+        # Log start
+        self.log_subjectStart(sub, 'topup')
 
-                # Extract b0s
-                b0s_ap = dwi_ap[:,:,:,gtab.b0s_mask]
-                b0s_pa = dwi_pa[:,:,:,[True, True, True, True, False]]
+        if not self.exists(self.join(self.dataout, sub)) and not self.staged:
+            self.log_warning(f'{sub}', f'topup: Output directory does not exist, skipping subject')
+            print(f'Output directory does not exist, skipping subject: {sub}')
+            self.log_subjectEnd(sub, 'topup', status='error')
+            return [False, f'topup: output directory does not exist']
+        
+        # Steps done by an interrupted run
+        journal, resume = self.open_journal(sub, 'topup', self.stage_inputs(sub, 'topup'))
 
-                # Save volumes of b0s
-                self.save_nifti(apb0, b0s_ap, affine_ap)
-                self.save_nifti(pab0, b0s_pa, affine_pa)
+        # make tmp dirs
+        self.mk_tmpdirs(sub, ['imgs', self.join('imgs', 'topup')], resume)
 
-                # Merge into one AP-PA file
-                self.sp.run(f'fslmerge -t {b0im} {apb0} {pab0}', shell=True)
-            except:
-                self.log_error(f'{sub}', f'topup: Could not extract b0s')
-                print(f'{sub} Could not extract b0s')
-                self.log_subjectEnd(sub, 'topup')
-                continue
-
-            try:
-                # Load sidecar jsons and read TRT
-                ds = ['AP', 'PA']
-                for d in ds:
-                    with open(self.join('tmp', sub, sub+f'_{d}.json')) as f:
-                        data = json.load(f)
-                        ro = data['TotalReadoutTime']
-                        if d == 'AP':
-                            ap_ro = ro
-                        else:
-                            pa_ro = ro
-                        f.close()
+        self.log_step(sub, 'copy in')
+        # copy required files
+        files = ['_AP_gib_mppca.nii.gz', '_PA_gib_mppca.nii.gz', '_AP.json', '_PA.json', '_AP.bval', '_AP.bvec']    
+        s, m = self.get_inputs(sub, files, self.dataout, 'topup', resume)
+        if not s:
+            self.log_subjectEnd(sub, 'topup', status='error')
+            return [False, m]
+        
+        # create acqparams.txt for topup
+        # 0 1 0 TotalReadoutTime AP
+        # 0 -1 0 TotalReadoutTime PA
+        try:
+            # Create b0 mask
+            b0s_mask = self.b0s_mask(f'tmp/{sub}/{sub}_AP.bval', f'tmp/{sub}/{sub}_AP.bvec')
+        except:
+            self.log_error(f'{sub}', f'topup: Could not create gradient table')
+            print(f'{sub} Could not create gradient table')
+            self.log_subjectEnd(sub, 'topup', status='error')
+            return [False, f'topup: could not create gradient table']
+
+        self.log_step(sub, 'b0s')
+        # Extract b0s
+        apim = self.work(self.join('tmp', sub, sub+'_AP_gib_mppca.nii.gz'))
+        paim = self.work(self.join('tmp', sub, sub+'_PA_gib_mppca.nii.gz'))
+        apb0 = self.work(self.join('tmp', sub, sub+'_AP_gib_mppca_b0s.nii.gz')) # single b in AP direction
+        pab0 = self.work(self.join('tmp', sub, sub+'_PA_gib_mppca_b0s.nii.gz')) # single b in PA direction
+        b0im = self.work(self.join('tmp', sub, sub+'_gib_mppca_b0s.nii.gz')) # merged b0s AP + PA
 
+        try:
+            if journal.done('b0s'):
+                # only the number of b0s is needed for the acqparams, it is in the headers
+                n_ap = self.meta.vols(apb0)
+                n_pa = self.meta.vols(pab0)
+                self.log_ok(f'{sub}', f'topup: b0s extracted by the interrupted run')
+            else:
+                # Extract and save b0s
+                n_ap, n_pa = self.mk_b0s(apim, paim, apb0, pab0, b0s_mask)
 
-                with open(acqpar, "w") as f:
-                    # for each vol in AP and for each vol in PA
-                    for v in range(0, b0s_ap.shape[3]):
-                        f.write(f"0 -1 0 {ap_ro}\n")
-                    for v in range(0, b0s_pa.shape[3]):
-                        f.write(f"0 1 0 {pa_ro}\n")
-                    f.close()
-            except:
-                self.log_error(f'{sub}', f'topup: Could not create acqparams.txt file')
-                print(f'{sub} Could not create acqparams.txt file')
-                self.log_subjectEnd(sub, 'topup')
-                continue
+                # Merge into one AP-PA file
+                s, m = self.run_cmds(sub, [[f'{self.fsl_env()}fslmerge -t {b0im} {apb0} {pab0}']])
+                if not s:
+                    self.log_error(f'{sub}', f'topup: {m}')
+                    print(f'{sub} fslmerge failed: {m}')
+                    self.log_subjectEnd(sub, 'topup', status='error')
+                    return [False, f'topup: {m}']
+                journal.complete('b0s', [apb0, pab0, b0im])
+        except:
+            self.log_error(f'{sub}', f'topup: Could not extract b0s')
+            print(f'{sub} Could not extract b0s')
+            self.log_subjectEnd(sub, 'topup', status='error')
+            return [False, f'topup: could not extract b0s']
 
-            # Run topup
-            self.sp.run(f'topup --imain={b0im} --datain={acqpar} --config=b02b0.cnf \
+        try:
+            self.mk_acqparams(sub, acqpar, n_ap, n_pa)
+        except:
+            self.log_error(f'{sub}', f'topup: Could not create acqparams.txt file')
+            print(f'{sub} Could not create acqparams.txt file')
+            self.log_subjectEnd(sub, 'topup', status='error')
+            return [False, f'topup: could not create acqparams.txt file']
+
+        self.log_step(sub, 'topup')
+        # Run topup
+        tpout = [self.work(self.join('tmp', sub, sub + f)) for f in ['_topup_results_fieldcoef.nii.gz', '_topup_results_movpar.txt', '_b0_corrected.nii.gz']]
+        if journal.done('topup'):
+            self.log_ok(f'{sub}', f'topup: topup done by the interrupted run')
+        else:
+            s, m = self.run_cmds(sub, [[f'{self.fsl_env()}topup --imain={b0im} --datain={acqpar} --config=b02b0.cnf \
             --out={self.join("tmp", sub, f"{sub}_topup_results")} \
-            --iout={self.join("tmp", sub, f"{sub}_b0_corrected.nii.gz")} -v', shell=True)
-            # plot topup results 
-            self.plot_nii_3d(nii=self.join('tmp', sub, sub + '_topup_results_fieldcoef.nii.gz'), sub=sub,\
-                        title=f'{sub} Topup FieldCoef', \
-                        out=self.join('tmp', sub, 'imgs', 'topup', f'{sub}_topup_fieldcoef.png'))
-            
-            # vs uncorrected b0s; volume AP and PA
-            # i = 0 and 10
-            # Load volumes
-            raw, __ = self.load_nifti(self.join('tmp', sub, sub+'_gib_mppca_b0s.nii.gz'))
-            cor, __ = self.load_nifti(self.join('tmp', sub, sub+'_b0_corrected.nii.gz'))
-            
-            ivols = [0, 10] # volumes for AP and PA inside the concat b0s
-            xcmp='gray'
-            for j, d in enumerate(['AP', 'PA']):
-                # Plot comparisong btw pre and post topup
-                fig0, ax = plt.subplots(2, 2, subplot_kw={'xticks': [], 'yticks': []})
-                fig0.subplots_adjust(hspace=0.05, wspace=0.05)
-                fig0.suptitle(f'{sub} Topup Corrected {d}', fontsize=15)
-
-                d0 = round(raw.shape[0]/2)
-                d2 = round(raw.shape[2]/2)
-                
-                # Plot the noise residuals
-                ax.flat[0].imshow(raw[d0,:,:,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
-                ax.flat[0].set_title('Before Topup')
-                ax.flat[1].imshow(cor[d0,:,:,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
-                ax.flat[1].set_title('After Topup')
-
-                ax.flat[2].imshow(raw[:,:,d2,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
-                ax.flat[3].imshow(cor[:,:,d2,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
-
-                sfig0 = self.join('tmp', sub, 'imgs', 'topup', f'{sub}_topup_{d}.png')
-                fig0.savefig(sfig0)
-                plt.close() 
-
-            # Plot movpars
-            movpar = np.loadtxt(self.join('tmp', sub, sub+'_topup_results_movpar.txt'))
-            plt.plot(movpar)
-            plt.title(f'{sub} topup movpar')
-            plt.savefig(self.join("tmp", sub, 'imgs', 'topup', f'{sub}_topup_movpar.png'))
-            plt.close()
+            --iout={tpout[2]} -v']])
+            if not s or not journal.complete('topup', tpout):
+                self.log_error(f'{sub}', f'topup: {m}')
+                print(f'{sub} topup failed: {m}')
+                self.log_subjectEnd(sub, 'topup', status='error')
+                return [False, f'topup: {m}']
+        self.log_step(sub, 'qa')
+        # plot topup results 
+        self.plot_nii_3d(nii=tpout[0], sub=sub,\
+                    title=f'{sub} Topup FieldCoef', \
+                    out=self.join('tmp', sub, 'imgs', 'topup', f'{sub}_topup_fieldcoef.png'))
+        
+        # vs uncorrected b0s; volume AP and PA
+        # i = 0 and 10
+        # Load volumes
+        raw = self.lazy_nifti(b0im)
+        cor = self.lazy_nifti(tpout[2])
+        
+        ivols = [0, 10] # volumes for AP and PA inside the concat b0s
+        xcmp='gray'
+        for j, d in enumerate(['AP', 'PA']):
+            # Plot comparisong btw pre and post topup
+            fig0, ax = plt.subplots(2, 2, subplot_kw={'xticks': [], 'yticks': []})
+            fig0.subplots_adjust(hspace=0.05, wspace=0.05)
+            fig0.suptitle(f'{sub} Topup Corrected {d}', fontsize=15)
 
-            # Copy results to output folder
-            if self.copy:
-                # Copy results to derivatives
-                # Files that were copied at the beggining and not touched
-                old_files = [f'{sub}_AP_gib_mppca.nii.gz', f'{sub}_PA_gib_mppca.nii.gz', f'{sub}_AP.json', f'{sub}_PA.json', f'{sub}_AP.bval', f'{sub}_AP.bvec']
-                new_files = [f for f in self.ls(self.join('tmp', sub)) if f not in old_files and self.isfile(self.join('tmp', sub, f))]
-                self.log_info(f'{sub}', f'topup: copying files to derivatives')
-                
-                try:
-                    for file in new_files:
-                        self.sp.run(f'cp {self.join("tmp", sub, file)} {self.join(self.dataout, sub, file)}', shell=True)
-                        self.log_ok(f'{sub}', f'topup: copied {file} to {self.dataout}')
-                    
-                    # Copy images to imgs folder
-                    self.sp.run(f'cp -r {self.join("tmp", sub, "imgs")}/* {self.join(self.dataout, sub, "imgs")}', shell=True)
-                    self.log_ok(f'{sub}', f'topup: all files copied to derivatives')
+            d0 = round(raw.shape[0]/2)
+            d2 = round(raw.shape[2]/2)
+            
+            # Plot the noise residuals
+            ax.flat[0].imshow(raw[d0,:,:,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[0].set_title('Before Topup')
+            ax.flat[1].imshow(cor[d0,:,:,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[1].set_title('After Topup')
+
+            ax.flat[2].imshow(raw[:,:,d2,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
+            ax.flat[3].imshow(cor[:,:,d2,ivols[j]].T, cmap=xcmp, interpolation='none',origin='lower')
+
+            sfig0 = self.join('tmp', sub, 'imgs', 'topup', f'{sub}_topup_{d}.png')
+            fig0.savefig(sfig0)
+            plt.close() 
+
+        # Plot movpars
+        movpar = np.loadtxt(self.join('tmp', sub, sub+'_topup_results_movpar.txt'))
+        plt.plot(movpar)
+        plt.title(f'{sub} topup movpar')
+        plt.savefig(self.join("tmp", sub, 'imgs', 'topup', f'{sub}_topup_movpar.png'))
+        plt.close()
 
-                except:
-                    self.log_error(f'{sub}', f'topup: files not copied to derivatives')
-                    print(f'{sub} files not copied to derivatives')
-                    self.log_subjectEnd(sub, 'topup')
-                    continue
+        self.log_step(sub, 'copy out')
+        # Copy results to output folder
+        if self.copy and not self.staged:
+            # Copy results to derivatives
+            # Files that were copied at the beggining and not touched
+            old_files = [self.work(f'{sub}_AP_gib_mppca.nii.gz'), self.work(f'{sub}_PA_gib_mppca.nii.gz'), f'{sub}_AP.json', f'{sub}_PA.json', f'{sub}_AP.bval', f'{sub}_AP.bvec']
+            new_files = [f for f in self.ls(self.join('tmp', sub)) if f not in old_files and self.isfile(self.join('tmp', sub, f))]
+            self.log_info(f'{sub}', f'topup: copying files to derivatives')
             
-            # Clean tmp
-            if self.clean:
-                self.log_info(f'{sub}', f'topup: cleaning tmp folder')
-                try:
-                    #self.rmtree(self.join('tmp', sub))
-                    self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
-                    self.log_ok(f'{sub}', f'topup: tmp folder cleaned')
-                except:
-                    self.log_error(f'{sub}', f'topup: tmp folder not cleaned')
-                    print(f'{sub} tmp folder not cleaned')
-                    self.log_subjectEnd(sub, 'topup')
-                    continue
+            try:
+                # new files and the images
+                items = [(self.join('tmp', sub, f), self.join(self.dataout, sub, f)) for f in new_files + ['imgs']]
+                s, m = self.publish(sub, 'topup', items)
+                if not s:
+                    raise IOError(m)
+                self.log_ok(f'{sub}', f'topup: all files copied to derivatives')
+                self.record_stage(sub, 'topup', self.stage_inputs(sub, 'topup'), self.stage_outputs(sub, 'topup'))
 
-            # Log end
-            self.log_subjectEnd(sub, 'topup')
+            except:
+                self.log_error(f'{sub}', f'topup: files not copied to derivatives')
+                print(f'{sub} files not copied to derivatives')
+                self.log_subjectEnd(sub, 'topup', status='error')
+                return [False, f'topup: files not copied to derivatives']
+        
+        self.log_step(sub, 'clean')
+        # Clean tmp
+        if self.clean and not self.staged:
+            self.log_info(f'{sub}', f'topup: cleaning tmp folder')
+            try:
+                #self.rmtree(self.join('tmp', sub))
+                self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
+                self.log_ok(f'{sub}', f'topup: tmp folder cleaned')
+            except:
+                self.log_error(f'{sub}', f'topup: tmp folder not cleaned')
+                print(f'{sub} tmp folder not cleaned')
+                self.log_subjectEnd(sub, 'topup', status='error')
+                return [False, f'topup: tmp folder not cleaned']
 
-        # Log end of all
-        self.log_ok('ALL', f'Topup completed successfully for {len(self.subs)} subjects')
-        # telegram send info
-        if self.telegram:
-            self.tg(f'Topup {self.task} completed for all {len(self.subs)} subjects')
+        # Log end
+        self.log_subjectEnd(sub, 'topup')
+        return [True, f'topup: {sub} completed']
 
     def eddy(self, skip_processed):
         # Performs eddy correction together with topup application
         # Followed by eddy qc
 
-        from time import perf_counter
-
         # Check if we have subjects to process
         print(f'{len(self.subs)} subjects to process')
         self.log_info('INIT', f'{len(self.subs)} subjects to process for eddy taks name: {self.task}')
@@ -1704,124 +2528,472 @@ class DwiPreprocessingClab():
         self.log_subdump(self.subs)
 
         # Loop over subjects
+        self.prefetch_start('eddy')
+        self.spans.start('stage', 'eddy', 'ALL')
         for i, sub in enumerate(self.subs):
+            print(f'{sub} {i+1} out of {len(self.subs)}')
+            self.prefetch_wait(sub)
+            self.eddy_sub(sub, skip_processed)
+            self.prefetch_release(sub)
+        self.spans.end('stage')
+        self.prefetch_stop()
+        
+        # send telegram message
+        print(f'{self.task}: eddy finished')
+        if self.telegram:
+            self.tg(f'{self.task}: eddy finished')
 
-            if skip_processed:
-                if self.exists(self.join(self.dataout, sub,  f'{sub}_index.txt')):
-                    self.log_ok(f'{sub}', f'Subject {sub} already processed, skipping subject')
-                    print(f'{sub} {i+1} out of {len(self.subs)} - already processed, skipping')
-                    continue
+    def eddy_sub(self, sub, skip_processed):
+        # Eddy and eddy qc for a single subject
+        # Returns True or False depending on success and message for logging
 
-            print(f'{sub} {i+1} out of {len(self.subs)} - processing')
+        from time import perf_counter
 
-            # Log start
-            self.log_subjectStart(sub, 'eddy')
-            # Start timer
-            t0 = perf_counter()
+        if skip_processed:
+            s, m = self.is_processed(sub, 'eddy', self.stage_inputs(sub, 'eddy'), [self.join(self.dataout, sub,  f'{sub}_index.txt')])
+            if s:
+                self.log_ok(f'{sub}', f'Subject {sub} already processed ({m}), skipping subject')
+                print(f'{sub} already processed, skipping')
+                return [True, f'eddy: {sub} already processed']
+            self.log_info(f'{sub}', f'eddy: {m}')
+
+        print(f'{sub} processing')
+
+        # Log start
+        self.log_subjectStart(sub, 'eddy')
+        # Start timer
+        t0 = perf_counter()
+
+        if not self.exists(self.join(self.dataout, sub)) and not self.staged:
+            self.log_warning(f'{sub}', f'topup: Output directory does not exist, skipping subject')
+            print(f'Output directory does not exist, skipping subject: {sub}')
+            self.log_subjectEnd(sub, 'eddy', status='error')
+            return [False, f'eddy: output directory does not exist']
+        
+        # Steps done by an interrupted run
+        journal, resume = self.open_journal(sub, 'eddy', self.stage_inputs(sub, 'eddy'))
 
-            if not self.exists(self.join(self.dataout, sub)):
-                self.log_warning(f'{sub}', f'topup: Output directory does not exist, skipping subject')
-                print(f'Output directory does not exist, skipping subject: {sub}')
-                self.log_subjectEnd(sub, 'eddy')
-                continue
-            
-            # make tmp dirs
-            try:
-                self.mkdir(self.join('tmp', sub))
-                self.mkdir(self.join('tmp', sub, 'imgs'))
-            except:
-                self.log_error(f'{sub}', f'eddy: tmp folder not created')
-                print(f'{sub} tmp folder not created')
-                self.log_subjectEnd(sub, 'eddy')
-                continue
+        # make tmp dirs
+        try:
+            self.mk_tmpdirs(sub, ['imgs'], resume)
+        except:
+            self.log_error(f'{sub}', f'eddy: tmp folder not created')
+            print(f'{sub} tmp folder not created')
+            self.log_subjectEnd(sub, 'eddy', status='error')
+            return [False, f'eddy: tmp folder not created']
 
-            # Copy files to tmp
-            
-            self.log_info(f'{sub}', f'eddy: copying files to tmp')
-            
-            files = [f'{sub}_AP_gib_mppca.nii.gz', \
-            f'{sub}_PA_gib_mppca.nii.gz', \
-            f'{sub}_gib_mppca_b0s.nii.gz', \
-            f'{sub}_AP.json', \
-            f'{sub}_PA.json', \
-            f'{sub}_AP.bval', \
-            f'{sub}_AP.bvec', \
-            f'{sub}_topup_results_movpar.txt', \
-            f'{sub}_topup_results_fieldcoef.nii.gz', \
-            f'{sub}_acqparams.txt',\
-            f'{sub}_b0_corrected.nii.gz']
-            
-            for file in files:
-                self.sp.run(f'cp {self.join(self.datain, sub, file)} {self.join("tmp", sub, file)}', shell=True)
-            
-            # Make brainmask
+        self.log_step(sub, 'copy in')
+        # Copy files to tmp
+        
+        self.log_info(f'{sub}', f'eddy: copying files to tmp')
+        
+        files = [f'{sub}_AP_gib_mppca.nii.gz', \
+        f'{sub}_PA_gib_mppca.nii.gz', \
+        f'{sub}_gib_mppca_b0s.nii.gz', \
+        f'{sub}_AP.json', \
+        f'{sub}_PA.json', \
+        f'{sub}_AP.bval', \
+        f'{sub}_AP.bvec', \
+        f'{sub}_topup_results_movpar.txt', \
+        f'{sub}_topup_results_fieldcoef.nii.gz', \
+        f'{sub}_acqparams.txt',\
+        f'{sub}_b0_corrected.nii.gz']
+        
+        # when chained, topup has left these in the workspace already
+        s, m = self.get_inputs(sub, [f[len(sub):] for f in files], self.datain, 'eddy', resume)
+        if not s:
+            self.log_subjectEnd(sub, 'eddy', status='error')
+            return [False, m]
+        
+        self.log_step(sub, 'brain mask')
+        # Make brainmask
+        if journal.done('bmask'):
+            self.log_ok(f'{sub}', f'eddy: brain masks made by the interrupted run')
+        else:
+            # make_brain_masks() stops if its dirs exist, e.g. left by an interrupted run
+            self.rmtree(self.join('tmp', sub, 'bmasks'), ignore_errors=True)
+            self.rmtree(self.join('tmp', sub, 'imgs', 'bmask'), ignore_errors=True)
             self.make_brain_masks(sub)
+            # eddy cannot run without the mask
+            if not journal.complete('bmask', [self.join('tmp', sub, 'bmasks', f'{sub}_b0_bet_f-02_mask.nii.gz')]):
+                self.log_error(f'{sub}', f'eddy: brain mask not created')
+                print(f'{sub} brain mask not created')
+                self.log_subjectEnd(sub, 'eddy', status='error')
+                return [False, f'eddy: brain mask not created']
+
+        self.log_step(sub, 'index')
+        # Make index
+        try: 
+            self.mk_index(self.work(self.join('tmp', sub, f'{sub}_AP_gib_mppca.nii.gz')), self.join('tmp', sub, f'{sub}_index.txt'))
+        except:
+            self.log_error(f'{sub}', f'eddy: index file not created')
+            print(f'{sub} index file not created')
+            self.log_subjectEnd(sub, 'eddy', status='error')
+            return [False, f'eddy: index file not created']
+
+        bmask = self.join('tmp', sub, 'bmasks', f'{sub}_b0_bet_f-02_mask.nii.gz')
+        mdata = self.work(self.join('tmp', sub, f'{sub}_AP_gib_mppca.nii.gz'))
+        index = self.join('tmp', sub, f'{sub}_index.txt')
+        acqpr = self.join('tmp', sub, f'{sub}_acqparams.txt')
+        bvals = self.join('tmp', sub, f'{sub}_AP.bval')
+        bvecs = self.join('tmp', sub, f'{sub}_AP.bvec')
+        eddyo = self.join('tmp', sub, f'{sub}_dwi')
+        tpout = self.join('tmp', sub, f'{sub}_topup_results')
+        qcout = self.join('tmp', sub, f'{sub}_eddy_qc')
+        
+        self.log_step(sub, 'eddy')
+        # Run Eddy correction
+        # eddy_openmp --imain=data --mask=my_hifi_b0_brain_mask --acqp=acqparams.txt --index=index.txt --bvecs=bvecs --bvals=bvals --topup=my_topup_results --repol --out=eddy_corrected_data --verbose
+        if journal.done('eddy'):
+            self.log_ok(f'{sub}', f'eddy: eddy done by the interrupted run')
+        else:
+            s, m = self.run_cmds(sub, [[f'eddy_openmp --imain={mdata} --mask={bmask} --acqp={acqpr} --index={index} --bvecs={bvecs} --bvals={bvals} \
+                --topup={tpout} --repol --out={eddyo} --verbose --cnr_maps --fwhm=0 --flm=quadratic']])
+            if not s or not journal.complete('eddy', [f'{eddyo}.nii.gz', f'{eddyo}.eddy_rotated_bvecs']):
+                self.log_error(f'{sub}', f'eddy: {m}')
+                print(f'{sub} eddy failed: {m}')
+                self.log_subjectEnd(sub, 'eddy', status='error')
+                return [False, f'eddy: {m}']
+
+        self.log_step(sub, 'qa')
+        # Run eddy QC
+        # eddy_quad <eddy_output_basename> -idx <eddy_index_file> -par <eddy_acqparams_file> -m <nodif_mask> -b <bvals>
+        # eddy_quad stops if the output dir exists, e.g. left by an interrupted run
+        if self.exists(qcout):
+            self.rmtree(qcout)
+        s, m = self.run_cmds(sub, [[f'eddy_quad {eddyo} -idx {index} -par {acqpr} -m {bmask} -b {bvals} -o {qcout}']])
+        if not s:
+            # the corrected data is fine, only the QC report is missing
+            self.log_warning(f'{sub}', f'eddy: {m}')
+
+        self.log_step(sub, 'copy out')
+        # Copy files to dataout
+        if self.copy and not self.staged:
+            self.log_info(f'{sub}', f'eddy: copying files to dataout')
+            # the bmasks dir, the mask plots in imgs/bmask and sub-x_eddy_qc dir (missing if eddy_quad failed)
+            dirs = [d for d in ['bmasks', self.join('imgs', 'bmask'), f'{sub}_eddy_qc'] if self.exists(self.join('tmp', sub, d))]
+            # Copy all files that are not in files list above
+            infiles = set([self.work(f) for f in files]) # files that were copied in the tmp dir
+            allfiles = set([f for f in self.ls(self.join("tmp", sub)) if self.isfile(self.join("tmp", sub, f))]) # all files that are in the dir
+            outfiles = list(allfiles - infiles) # only the new files are kept
+            s, m = self.publish(sub, 'eddy', [(self.join('tmp', sub, f), self.join(self.dataout, sub, f)) for f in dirs + outfiles])
+            if not s:
+                print(f'{sub} files not copied to dataout')
+                self.log_subjectEnd(sub, 'eddy', status='error')
+                return [False, f'eddy: files not copied to dataout: {m}']
+
+            self.log_ok(f'{sub}', f'eddy: finished copying files to dataout')
+            self.record_stage(sub, 'eddy', self.stage_inputs(sub, 'eddy'), self.stage_outputs(sub, 'eddy'))
+
+        self.log_step(sub, 'clean')
+        # Clean tmp folder
+        if self.clean and not self.staged:
+            self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
+            self.log_info(f'{sub}', f'eddy: tmp folder cleaned')
+
+        # Stop timer
+        t1 = perf_counter()
+        print(f"{sub} eddy duration {(t1 - t0)/60:0.4f} minutes")
+        # Log end
+        self.log_subjectEnd(sub, 'eddy, duration: ' + str((t1 - t0)/60))
+        return [True, f'eddy: {sub} completed']
 
-            # Make index
-            try: 
-                img, __ = self.load_nifti(self.join('tmp', sub, f'{sub}_AP_gib_mppca.nii.gz'))
-                with open(self.join('tmp', sub, f'{sub}_index.txt'), 'w') as f:
-                    for i in range(img.shape[3]):
-                        f.write(f'1\n')
-            except:
-                self.log_error(f'{sub}', f'eddy: index file not created')
-                print(f'{sub} index file not created')
-                self.log_subjectEnd(sub, 'eddy')
-                continue    
-
-            bmask = self.join('tmp', sub, 'bmasks', f'{sub}_b0_bet_f-02_mask.nii.gz')
-            mdata = self.join('tmp', sub, f'{sub}_AP_gib_mppca.nii.gz')
-            index = self.join('tmp', sub, f'{sub}_index.txt')
-            acqpr = self.join('tmp', sub, f'{sub}_acqparams.txt')
-            bvals = self.join('tmp', sub, f'{sub}_AP.bval')
-            bvecs = self.join('tmp', sub, f'{sub}_AP.bvec')
-            eddyo = self.join('tmp', sub, f'{sub}_dwi')
-            tpout = self.join('tmp', sub, f'{sub}_topup_results')
-            qcout = self.join('tmp', sub, f'{sub}_eddy_qc')
-            
-            # Run Eddy correction
-            # eddy_openmp --imain=data --mask=my_hifi_b0_brain_mask --acqp=acqparams.txt --index=index.txt --bvecs=bvecs --bvals=bvals --topup=my_topup_results --repol --out=eddy_corrected_data --verbose
-            self.sp.run(f'eddy_openmp --imain={mdata} --mask={bmask} --acqp={acqpr} --index={index} --bvecs={bvecs} --bvals={bvals} \
-                --topup={tpout} --repol --out={eddyo} --verbose --cnr_maps --fwhm=0 --flm=quadratic', shell=True)
-
-            # Run eddy QC
-            # eddy_quad <eddy_output_basename> -idx <eddy_index_file> -par <eddy_acqparams_file> -m <nodif_mask> -b <bvals>
-            self.sp.run(f'eddy_quad {eddyo} -idx {index} -par {acqpr} -m {bmask} -b {bvals} -o {qcout}', shell=True)
-
-            # Copy files to dataout
-            if self.copy:
-                self.log_info(f'{sub}', f'eddy: copying files to dataout')
-                # Copy the bmasks dir
-                self.sp.run(f'cp -r {self.join("tmp", sub, "bmasks")} {self.join(self.dataout, sub)}', shell=True)
-                # Copy the imgs/bmasks dir
-                self.sp.run(f'cp -r {self.join("tmp", sub, "imgs", "bmasks")} {self.join(self.dataout, sub, "imgs")}', shell=True)
-                # Copy sub-x_eddy_qc dir
-                self.sp.run(f'cp -r {self.join("tmp", sub, f"{sub}_eddy_qc")} {self.join(self.dataout, sub)}', shell=True)
-                # Copy all files that are not in files list above
-                infiles = set(files) # files that were copied in the tmp dir
-                allfiles = set([f for f in self.ls(self.join("tmp", sub)) if self.isfile(self.join("tmp", sub, f))]) # all files that are in the dir
-                outfiles = list(allfiles - infiles) # only the new files are kept
-                for file in outfiles:
-                    self.sp.run(f'cp {self.join("tmp", sub, file)} {self.join(self.dataout, sub )}', shell=True)
-
-                self.log_ok(f'{sub}', f'eddy: finished copying files to dataout')
-
-            # Clean tmp folder
-            if self.clean:
-                self.sp.run(f'rm -rf {self.join("tmp", sub)}', shell=True)
-                self.log_info(f'{sub}', f'eddy: tmp folder cleaned')
+    ########################################
+    # Pipeline #############################
+    ########################################
 
-            # Stop timer
-            t1 = perf_counter()
-            print(f"{sub} eddy duration {(t1 - t0)/60:0.4f} minutes")
-            # Log end
-            self.log_subjectEnd(sub, 'eddy, duration: ' + str((t1 - t0)/60))
-        
-        # send telegram message
-        print(f'{self.task}: eddy finished')
+    def pipeline(self, steps=['gibbs', 'mppca', 'topup', 'eddy'], skip_processed=False, publish_intermediates=False):
+        # Runs a chain of stages for all subjects, one subject at a time
+        # Files passed between the stages stay in the tmp workspace, see pipeline_sub()
+
+        from fun.eta import Eta
+
+        print(f'{len(self.subs)} subjects to process')
+        self.log_info('INIT', f'{len(self.subs)} subjects to process for pipeline {" -> ".join(steps)}, taks name: {self.task}')
+        self.log_subdump(self.subs)
+
+        # Timer and ETA
+        eta = Eta(mode='median', N = len(self.subs))
+
+        self.prefetch_start('pipeline', steps)
+        self.spans.start('stage', 'pipeline', 'ALL', steps=steps)
+        for i, sub in enumerate(self.subs):
+            print(f'{sub} {i+1} out of {len(self.subs)}')
+            # Timer update, return ETA to log
+            self.log_info(sub, eta.update())
+            self.prefetch_wait(sub)
+            self.pipeline_sub(sub, steps, skip_processed, publish_intermediates)
+            self.prefetch_release(sub)
+        self.spans.end('stage')
+        self.prefetch_stop()
+
+        self.log_ok('ALL', f'pipeline completed for {len(self.subs)} subjects')
         if self.telegram:
-            self.tg(f'{self.task}: eddy finished')
-            
+            self.tg(f'pipeline {self.task} completed for all {len(self.subs)} subjects')
+
+    def pipeline_inputs(self, sub, steps):
+        # Paths of the files a chain of stages reads that are not made within the chain
+        from fun.stages import StageGraph
+
+        graph = StageGraph(steps)
+        inputs = []
+        for step in steps:
+            if step == 'gibbs':
+                inputs += self.stage_inputs(sub, step)
+            else:
+                src = self.datain if step == 'eddy' else self.dataout
+                inputs += [self.join(src, sub, sub+f) for f in graph.fetch(step)]
+        return inputs
+
+    def pipeline_sub(self, sub, steps=['gibbs', 'mppca', 'topup', 'eddy'], skip_processed=False, publish_intermediates=False):
+        # Runs the chain of stages for a single subject in one tmp workspace
+        # Inputs that are not made within the chain are copied in once, the
+        # intermediate files are passed between the stages in tmp and only the
+        # outputs of the last stage, small files worth keeping and QA are published
+        # to dataout (publish_intermediates=True publishes everything)
+        # Returns True or False depending on success and message for logging
+
+        from time import perf_counter
+        from fnmatch import fnmatch
+        from fun.stages import STAGES, StageGraph
+
+        graph = StageGraph(steps)
+        s, m = graph.check()
+        if not s:
+            self.log_error(f'{sub}', f'pipeline: {m}')
+            print(m)
+            return [False, f'pipeline: {m}']
+
+        # Inputs that are not made within the chain and the settings of all stages
+        # these decide if the chain has to be run again, see is_processed()
+        inputs = self.pipeline_inputs(sub, steps)
+        params, tools = {'steps': steps}, {}
+        for step in steps:
+            p, t = self.stage_settings(step)
+            params[step] = p
+            tools.update(t)
+
+        # Skip if the chain is up to date, or with no manifest if the outputs of the last stage are in dataout
+        if skip_processed:
+            last = [self.join(self.dataout, sub, sub+f) for f in STAGES[steps[-1]]['outputs'] if f.startswith('_') and '*' not in f]
+            s, m = self.is_processed(sub, 'pipeline', inputs, last, params, tools)
+            if s:
+                self.log_ok(f'{sub}', f'Subject {sub} already processed ({m}), skipping subject')
+                print(f'{sub} already processed, skipping')
+                return [True, f'pipeline: {sub} already processed']
+            self.log_info(f'{sub}', f'pipeline: {m}')
+
+        # Check the inputs that are not made within the chain before anything is run
+        for i in inputs:
+            if not self.exists(i):
+                self.log_error(f'{sub}', f'pipeline: input {i} not found')
+                print(f'{sub} input {i} not found')
+                return [False, f'pipeline: input {i} not found']
+
+        self.log_info(f'{sub}', f'pipeline: {" -> ".join(steps)}')
+        t0 = perf_counter()
+        # the stages are timed as subjects nested in this one
+        span = self.spans.start('subject', 'pipeline', sub, steps=steps)
+
+        # One workspace for the whole chain, kept when an interrupted run is resumed
+        ws = self.join('tmp', sub)
+        journal, resume = self.open_journal(sub, 'pipeline', inputs, params, tools)
+        if not resume:
+            s, m = self.check_subject_tmpdir(sub)
+            if not s:
+                self.log_error(f'{sub}', f'pipeline: {m}')
+                print(m)
+                self.spans.end('subject', 'error')
+                return [False, f'pipeline: {m}']
+
+        self.staged = True
+        try:
+            for step in steps:
+                if journal.done(step):
+                    self.log_ok(f'{sub}', f'pipeline: {step} done by the interrupted run')
+                    continue
+                s, m = getattr(self, f'{step}_sub')(sub, False)
+                if not s:
+                    self.log_error(f'{sub}', f'pipeline: stopped at {step}: {m}')
+                    print(f'{sub} pipeline stopped at {step}')
+                    self.spans.end('subject', 'error')
+                    return [False, f'pipeline: stopped at {step}: {m}']
+                outs = [self.work(self.join(ws, sub+f)) if f.startswith('_') else self.join(ws, f) for f in STAGES[step]['outputs'] if '*' not in f]
+                journal.complete(step, outs)
+        except Exception as e:
+            # a stage that raised left its spans open, close them and the chain as errors
+            while span in [x['id'] for x in self.spans.stack()]:
+                self.spans.end(status='error')
+            self.log_error(f'{sub}', f'pipeline: stopped at {step}, it raised: {e}')
+            print(f'{sub} pipeline stopped at {step}')
+            return [False, f'pipeline: stopped at {step}, it raised: {e}']
+        finally:
+            # the stages run on their own afterwards copy in and clean up again
+            self.staged = False
+            self.release_arrays(sub)
+
+        # Publish
+        if self.copy:
+            self.log_step(sub, 'publish')
+            self.log_info(f'{sub}', f'pipeline: publishing to dataout')
+            self.makedirs(self.join(self.dataout, sub, 'imgs'), exist_ok=True)
+            items = []
+            for item in graph.publish(publish_intermediates):
+                if item.startswith('_'):
+                    names = [f for f in self.ls(ws) if fnmatch(f, self.work(sub+item))]
+                else:
+                    names = [item] if self.exists(self.join(ws, item)) else []
+                if len(names) == 0:
+                    self.log_warning(f'{sub}', f'pipeline: nothing to publish for {item}')
+                # the content of dirs is merged, so existing dirs are not nested
+                items += [(self.join(ws, n), self.join(self.dataout, sub, n)) for n in names]
+            s, m = self.publish(sub, 'pipeline', items)
+            if not s:
+                print(f'{sub} pipeline could not publish')
+                self.spans.end('subject', 'error')
+                return [False, f'pipeline: could not publish: {m}']
+            self.log_ok(f'{sub}', f'pipeline: finished publishing to dataout')
+            outputs = []
+            for step in steps:
+                outputs += self.stage_outputs(sub, step)
+            self.record_stage(sub, 'pipeline', inputs, list(dict.fromkeys(outputs)), params, tools)
+
+        if self.clean:
+            self.log_step(sub, 'clean')
+            self.sp.run(f'rm -rf {ws}', shell=True)
+            self.log_info(f'{sub}', f'pipeline: tmp folder cleaned')
+
+        self.spans.end('subject')
+        t1 = perf_counter()
+        print(f'{sub} pipeline duration {(t1 - t0)/60:0.4f} minutes')
+        self.log_ok(f'{sub}', f'pipeline: completed, duration: {(t1 - t0)/60}')
+        return [True, f'pipeline: {sub} completed']
+
+    ########################################
+    # Scheduling ###########################
+    ########################################
+
+    def run_parallel(self, stage, jobs, **kwargs):
+        # Runs a preprocessing stage for several subjects at the same time
+        # Each subject is processed in its own worker process, self.threads
+        # are split between the workers so each one gets its own budget
+        # stage: name of the stage; gibbs, mppca, patch2self, topup, eddy or pipeline
+        # jobs: number of subjects processed concurrently
+        # kwargs: passed to the stage, e.g. skip_processed=True or steps=[...] for pipeline
+        # Returns a list of per subject outcomes, these are also logged
+
+        from fun.scheduler import Scheduler
+
+        if stage not in ['gibbs', 'mppca', 'patch2self', 'topup', 'eddy', 'pipeline']:
+            print(f'Invalid stage {stage}')
+            self.log_error('ALL', f'run_parallel: Invalid stage: {stage}')
+            return [False, f'Invalid stage {stage}']
+
+        print(f'{len(self.subs)} subjects to process, {jobs} at a time')
+        self.log_info('INIT', f'{len(self.subs)} subjects to process for {stage} with {jobs} concurrent jobs, taks name: {self.task}')
+        self.log_subdump(self.subs)
+
+        sch = Scheduler(self, jobs)
+        self.spans.start('stage', stage, 'ALL', jobs=jobs)
+        results = sch.run(stage, self.subs, **kwargs)
+        self.spans.end('stage')
+
+        failed = [r['sub'] for r in results if not r['status']]
+        self.log_ok('ALL', f'{stage} completed for {len(self.subs)} subjects, {len(failed)} failed: {failed}')
+        print(f'{stage} completed for {len(self.subs)} subjects, {len(failed)} failed')
+        if self.telegram:
+            self.tg(f'{stage} {self.task} completed for all {len(self.subs)} subjects, {len(failed)} failed')
+
+        return results
+
+    def run_mixed(self, stages, cores=None, mem=None, profiles=None, **kwargs):
+        # Runs several stages for all subjects, jobs from different stages and
+        # subjects are packed onto the machine by the cores and memory declared
+        # for each stage (see PROFILES in fun/scheduler.py), e.g. single threaded
+        # topup runs next to eddy without oversubscribing the machine
+        # stages: list of stages, run in this order for each subject
+        # cores: cores budget, defaults to self.threads or all cores
+        # mem: memory budget in GB, defaults to 90% of the RAM
+        # profiles: dict to override the profiles, e.g. {'eddy': {'cores': 16, 'mem': 12}}
+        # kwargs: passed to every stage, e.g. skip_processed=True
+        # Returns a list of per subject and stage outcomes, these are also logged
+
+        import os
+        from fun.scheduler import ResourceScheduler
+
+        for stage in stages:
+            if stage not in ['gibbs', 'mppca', 'patch2self', 'topup', 'eddy', 'pipeline']:
+                print(f'Invalid stage {stage}')
+                self.log_error('ALL', f'run_mixed: Invalid stage: {stage}')
+                return [False, f'Invalid stage {stage}']
+
+        if cores is None:
+            cores = self.threads if self.threads is not None and self.threads > 0 else os.cpu_count()
+        if mem is None:
+            mem = 0.9 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+        print(f'{len(self.subs)} subjects to process, {cores} cores and {mem:0.1f} GB')
+        self.log_info('INIT', f'{len(self.subs)} subjects to process for {" -> ".join(stages)}, taks name: {self.task}')
+        self.log_subdump(self.subs)
+
+        sch = ResourceScheduler(self, cores, mem, profiles)
+        self.spans.start('stage', '+'.join(stages), 'ALL', cores=cores)
+        results = sch.run(stages, self.subs, **kwargs)
+        self.spans.end('stage')
+
+        failed = sorted(set([r['sub'] for r in results if not r['status']]))
+        self.log_ok('ALL', f'{" -> ".join(stages)} completed for {len(self.subs)} subjects, {len(failed)} failed: {failed}')
+        print(f'{" -> ".join(stages)} completed for {len(self.subs)} subjects, {len(failed)} failed')
+        if self.telegram:
+            self.tg(f'{" -> ".join(stages)} {self.task} completed for all {len(self.subs)} subjects, {len(failed)} failed')
+
+        return results
+
+    def run_queue(self, stage, queue_dir, jobs=1, ttl=900, **kwargs):
+        # Takes subjects from a queue kept on a shared filesystem until none are left
+        # Start it on any number of machines with the same subjects and queue_dir,
+        # each subject is processed once and a subject held by a dead machine is
+        # taken again after ttl seconds, see fun/workqueue.py
+        # stage: name of the stage; gibbs, mppca, patch2self, topup, eddy or pipeline
+        # queue_dir: directory on the shared filesystem, e.g. next to dataout
+        # jobs: number of workers on this machine, self.threads are split between them
+        # kwargs: passed to the stage, e.g. skip_processed=True
+        # Returns a list of outcomes of the subjects processed on this machine
+
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+        from fun.workqueue import WorkQueue, drain
+
+        if stage not in ['gibbs', 'mppca', 'patch2self', 'topup', 'eddy', 'pipeline']:
+            print(f'Invalid stage {stage}')
+            self.log_error('ALL', f'run_queue: Invalid stage: {stage}')
+            return [False, f'Invalid stage {stage}']
+
+        self.log_info('INIT', f'{len(self.subs)} subjects in queue {queue_dir} for {stage} with {jobs} workers, taks name: {self.task}')
+        self.log_subdump(self.subs)
+
+        self.spans.start('stage', stage, 'ALL', jobs=jobs)
+        if jobs > 1:
+            total = os.cpu_count() if self.threads is None or self.threads < 1 else self.threads
+            threads = max(1, total // jobs)
+            results = []
+            with ProcessPoolExecutor(max_workers=jobs) as ex:
+                futures = [ex.submit(drain, self, queue_dir, stage, ttl, threads, kwargs) for j in range(jobs)]
+                for f in futures:
+                    results += f.result()
+        else:
+            results = drain(self, queue_dir, stage, ttl, None, kwargs)
+        self.spans.end('stage')
+
+        q = WorkQueue(queue_dir, stage, self.subs)
+        failed = [r['sub'] for r in results if not r['status']]
+        self.log_ok('ALL', f'{stage} queue empty, {len(results)} subjects processed here, {len(failed)} failed: {failed}, queue {q.status()}')
+        print(f'{stage} queue empty, {len(results)} subjects processed here, {len(failed)} failed')
+        if self.telegram:
+            self.tg(f'{stage} {self.task} queue empty, {len(results)} subjects processed here, {len(failed)} failed')
+
+        return results
+
 class DwiAnalysisClab():
 
     """
@@ -1834,7 +3006,7 @@ class DwiAnalysisClab():
     """
 
     def __init__(self, dwi_preproc_dir, dwi_mrtrix_dir, t1_dir, freesurfer_dir, subjects_list, skip_processed=True, threads=40,\
-                telegram=True, tmp_dir = 'tmp', clear_tmp=True, move_from_tmp=True):
+                telegram=True, tmp_dir = 'tmp', clear_tmp=True, move_from_tmp=True, catalog=None):
 
         self.dwi_preproc_dir = dwi_preproc_dir # path to dwi_preproc_dir, where the preprocessed data lives
         self.dwi_preproc_subs = [] # list of preprocessed subs
@@ -1854,6 +3026,7 @@ class DwiAnalysisClab():
         self.move = move_from_tmp
         self.durations = []
         self.dirs_checked = False
+        self.catalog = catalog # sqlite file indexing the subjects of the four directories, None to list them, see fun/catalog.py
 
         self.tmp()
 
@@ -1893,6 +3066,17 @@ class DwiAnalysisClab():
         from os.path import exists
         from os import makedirs, listdir
 
+        # subjects of a directory, from the catalog if there is one, brought up to date first
+        if self.catalog is not None:
+            from fun.catalog import Catalog
+            cat = Catalog(self.catalog)
+            def subs(d):
+                print(cat.refresh(d, depth=0))
+                return cat.subjects(d)
+        else:
+            def subs(d):
+                return [f for f in listdir(d) if f.startswith('sub-')]
+
         print('Checking directories and subjects...')
         print(f'Provided {len(self.subjects_list)} subjects.')
 
@@ -1903,7 +3087,7 @@ class DwiAnalysisClab():
                 print(f'Preprocessed data directory {self.dwi_preproc_dir} does not exist. Please check the path.')
                 return False
             else:
-                self.dwi_preproc_subs = [f for f in listdir(self.dwi_preproc_dir) if f.startswith('sub-')]
+                self.dwi_preproc_subs = subs(self.dwi_preproc_dir)
                 if len(self.dwi_preproc_subs) == 0:
                     print('No subjects found in preprocessed data directory. Please check the path.')
                     return False
@@ -1922,7 +3106,7 @@ class DwiAnalysisClab():
                     print('Exiting...')
                     return False
             else:
-                self.dwi_mrtix_subs = [f for f in listdir(self.dwi_mrtrix_dir) if f.startswith('sub-')]
+                self.dwi_mrtix_subs = subs(self.dwi_mrtrix_dir)
                 if len(self.dwi_mrtix_subs) == 0:
                     print('No subjects found in MRTrix3 directory. Continuing...')
                 else:
@@ -1933,7 +3117,7 @@ class DwiAnalysisClab():
                 print(f'Freesurfer directory {self.freesurfer_dir} does not exist. Please check the path.')
                 return False
             else:
-                self.freesurfer_subs = [f for f in listdir(self.freesurfer_dir) if f.startswith('sub-')]
+                self.freesurfer_subs = subs(self.freesurfer_dir)
                 if len(self.freesurfer_subs) == 0:
                     print('No subjects found in freesurfer directory. Please check the path.')
                     return False
@@ -1944,7 +3128,7 @@ class DwiAnalysisClab():
                 print('T1 directory does not exist. Please check the path.')
                 return False
             else:
-                self.t1subs = [f for f in listdir(self.t1dir) if f.startswith('sub-')]
+                self.t1subs = subs(self.t1dir)
                 if len(self.t1subs) == 0:
                     print('No subjects found in t1 directory. Please check the path.')
                     return False
@@ -1993,6 +3177,7 @@ class DwiAnalysisClab():
         import subprocess as sp
         from os import makedirs
         from os.path import exists, join
+        from fun.cmdrunner import CmdRunner
         
         if not sub.startswith('sub-'):
             sub = 'sub-' + sub
@@ -2031,64 +3216,72 @@ class DwiAnalysisClab():
         # Make sub- dir in tmp
         makedirs(f'tmp/{sub}', exist_ok=True)
 
-        # run mrconvert, pack in eddy corrected bvecs, bvals
-        sp.run(f'mrconvert -fslgrad {pdwi}/{sub}_dwi.eddy_rotated_bvecs {pdwi}/{sub}_AP.bval -nthreads {self.threads} {pdwi}/{sub}_dwi.nii.gz {dwi}', shell=True)
-
-        # copy t1w to tmp
-        sp.run(f'mrconvert {t1w} {join(tdwi, sub+"_t1w.mif")}', shell=True)
-
-        # correct bias, improves the brain extraction inm later step. 
-        # we overwrite the image here, so use -force
-        sp.run(f'dwibiascorrect ants -nthreads {self.threads} {dwi} {dwi} -bias {tdwi}/bias.mif -force', shell=True)
-
-        # run brain mask
-        sp.run(f'dwi2mask {dwi} {tdwi}/mask.mif -nthreads {self.threads}', shell=True)
-
-        # run dwi2response for Multi-tissue CSD
-        # Method citation: Tournier et al. NeuroImage 2007. Robust determination of the fibre orientation distribution in diffusion MRI: Non-negativity constrained super-resolved spherical deconvolution
-        # link https://mrtrix.readthedocs.io/en/latest/constrained_spherical_deconvolution/response_function_estimation.html#dhollander
-        sp.run(f'dwi2response dhollander {dwi} {tdwi}/wm.txt {tdwi}/gm.txt {tdwi}/csf.txt -voxels {tdwi}/voxels.mif -mask {tdwi}/mask.mif -nthreads {self.threads} -quiet', shell=True)
-
-        # CSD (constrained spherical deconvolution)
-        # Multi-shell multi-tissue constrained spherical deconvolution (MSMT-CSD)
-        sp.run(f'dwi2fod -nthreads {self.threads} msmt_csd {dwi} {tdwi}/wm.txt {tdwi}/wm.mif {tdwi}/gm.txt {tdwi}/gm.mif {tdwi}/csf.txt {tdwi}/csf.mif -mask {tdwi}/mask.mif', shell=True)
-        
-        # Normalise
-        sp.run(f'mtnormalise {tdwi}/wm.mif {tdwi}/wm_norm.mif {tdwi}/gm.mif {tdwi}/gm_norm.mif {tdwi}/csf.mif {tdwi}/csf_norm.mif -mask {tdwi}/mask.mif', shell=True)
-
-        # DT
-        sp.run(f'dwi2tensor {dwi} {tdwi}/{sub}_dt.mif -mask {tdwi}/mask.mif -nthreads {self.threads} -b0 {tdwi}/b0.mif -dkt {tdwi}/{sub}_dkt.mif', shell=True)
-
-        # DTI metrics
-        sp.run(f'tensor2metric -adc {tdwi}/{sub}_dt_adc.mif -fa {tdwi}/{sub}_dt_fa.mif -ad {tdwi}/{sub}_dt_ad.mif -rd {tdwi}/{sub}_dt_rd.mif -value {tdwi}/{sub}_dt_eigval.mif -vector {tdwi}/{sub}_dt_eigvec.mif -cl {tdwi}/{sub}_dt_cl.mif -cp {tdwi}/{sub}_dt_cp.mif -cs {tdwi}/{sub}_dt_cs.mif {tdwi}/{sub}_dt.mif', shell=True)
-
-        # DKI metrics, this is in development, not sure if it works
-        # f'tensor2metric -mk {tdwi}/{sub}_dk_mk.mif -ak {tdwi}/{sub}_dk_ak.mif -rk {tdwi}/{sub}_dk_rk.mif -mask {tdwi}/mask.mif -dkt {tdwi}/{sub}_dkt.mif'
-
-        # Segment tissues, with freesurfer's help
-        sp.run(f'5ttgen hsvs -hippocampi subfields -thalami nuclei -white_stem -nthreads {self.threads} {fsd} {tdwi}/5tt.mif', shell=True)
-
-        # Create mean b0 image
-        sp.run(f'dwiextract {dwi} - -bzero | mrmath - mean {tdwi}/mean_b0.mif -axis 3', shell=True)
-
-        # To use FSL's FLIRT we need to convert the image to NIFTI
-        sp.run(f'mrconvert {tdwi}/mean_b0.mif {tdwi}/mean_b0.nii.gz', shell=True)
-        sp.run(f'mrconvert {tdwi}/5tt.mif {tdwi}/5tt.nii.gz', shell=True)
-
-        # extract GM from the 5tt image
-        sp.run(f'fslroi {tdwi}/5tt.nii.gz {tdwi}/5tt_vol0.nii.gz 0 1', shell=True)
-
-        # FLIRT registration
-        sp.run(f'flirt -in {tdwi}/mean_b0.nii.gz -ref {tdwi}/5tt_vol0.nii.gz -interp nearestneighbour -dof 6 -omat {tdwi}/diff2struct_fsl.mat', shell=True)
-
-        # Convert transformation matrix to mrtrix format
-        sp.run(f'transformconvert {tdwi}/diff2struct_fsl.mat {tdwi}/mean_b0.nii.gz {tdwi}/5tt.nii.gz flirt_import {tdwi}/diff2struct_mrtrix.txt', shell=True)
-
-        # Transform the 5tt image
-        sp.run(f'mrtransform {tdwi}/5tt.mif -linear {tdwi}/diff2struct_mrtrix.txt -inverse {tdwi}/5tt_coreg.mif', shell=True)
-
-        # mask for seeding
-        sp.run(f'5tt2gmwmi {tdwi}/5tt_coreg.mif {tdwi}/5tt_coreg_gmwmi.mif', shell=True)
+        # External tools run through CmdRunner: the commands of a group are independent
+        # and run at the same time, groups run one after another and the first
+        # failure stops the rest, so no step runs on the missing output of another
+        runner = CmdRunner(limit=4)
+        # tools that run at the same time share the threads
+        nt = max(1, self.threads // 2)
+
+        groups = [
+            # run mrconvert, pack in eddy corrected bvecs, bvals
+            # copy t1w to tmp
+            [f'mrconvert -fslgrad {pdwi}/{sub}_dwi.eddy_rotated_bvecs {pdwi}/{sub}_AP.bval -nthreads {self.threads} {pdwi}/{sub}_dwi.nii.gz {dwi}',
+             f'mrconvert {t1w} {join(tdwi, sub+"_t1w.mif")}'],
+
+            # correct bias, improves the brain extraction inm later step. 
+            # we overwrite the image here, so use -force
+            [f'dwibiascorrect ants -nthreads {self.threads} {dwi} {dwi} -bias {tdwi}/bias.mif -force'],
+
+            # run brain mask
+            [f'dwi2mask {dwi} {tdwi}/mask.mif -nthreads {self.threads}'],
+
+            # run dwi2response for Multi-tissue CSD
+            # Method citation: Tournier et al. NeuroImage 2007. Robust determination of the fibre orientation distribution in diffusion MRI: Non-negativity constrained super-resolved spherical deconvolution
+            # link https://mrtrix.readthedocs.io/en/latest/constrained_spherical_deconvolution/response_function_estimation.html#dhollander
+            [f'dwi2response dhollander {dwi} {tdwi}/wm.txt {tdwi}/gm.txt {tdwi}/csf.txt -voxels {tdwi}/voxels.mif -mask {tdwi}/mask.mif -nthreads {self.threads} -quiet'],
+
+            # CSD (constrained spherical deconvolution)
+            # Multi-shell multi-tissue constrained spherical deconvolution (MSMT-CSD)
+            [f'dwi2fod -nthreads {self.threads} msmt_csd {dwi} {tdwi}/wm.txt {tdwi}/wm.mif {tdwi}/gm.txt {tdwi}/gm.mif {tdwi}/csf.txt {tdwi}/csf.mif -mask {tdwi}/mask.mif'],
+
+            # Normalise
+            # DT
+            # Segment tissues, with freesurfer's help
+            # Create mean b0 image
+            [f'mtnormalise {tdwi}/wm.mif {tdwi}/wm_norm.mif {tdwi}/gm.mif {tdwi}/gm_norm.mif {tdwi}/csf.mif {tdwi}/csf_norm.mif -mask {tdwi}/mask.mif',
+             f'dwi2tensor {dwi} {tdwi}/{sub}_dt.mif -mask {tdwi}/mask.mif -nthreads {nt} -b0 {tdwi}/b0.mif -dkt {tdwi}/{sub}_dkt.mif',
+             f'5ttgen hsvs -hippocampi subfields -thalami nuclei -white_stem -nthreads {nt} {fsd} {tdwi}/5tt.mif',
+             f'dwiextract {dwi} - -bzero | mrmath - mean {tdwi}/mean_b0.mif -axis 3'],
+
+            # DTI metrics
+            # DKI metrics, this is in development, not sure if it works
+            # f'tensor2metric -mk {tdwi}/{sub}_dk_mk.mif -ak {tdwi}/{sub}_dk_ak.mif -rk {tdwi}/{sub}_dk_rk.mif -mask {tdwi}/mask.mif -dkt {tdwi}/{sub}_dkt.mif'
+            # To use FSL's FLIRT we need to convert the image to NIFTI
+            [f'tensor2metric -adc {tdwi}/{sub}_dt_adc.mif -fa {tdwi}/{sub}_dt_fa.mif -ad {tdwi}/{sub}_dt_ad.mif -rd {tdwi}/{sub}_dt_rd.mif -value {tdwi}/{sub}_dt_eigval.mif -vector {tdwi}/{sub}_dt_eigvec.mif -cl {tdwi}/{sub}_dt_cl.mif -cp {tdwi}/{sub}_dt_cp.mif -cs {tdwi}/{sub}_dt_cs.mif {tdwi}/{sub}_dt.mif',
+             f'mrconvert {tdwi}/mean_b0.mif {tdwi}/mean_b0.nii.gz',
+             f'mrconvert {tdwi}/5tt.mif {tdwi}/5tt.nii.gz'],
+
+            # extract GM from the 5tt image
+            [f'fslroi {tdwi}/5tt.nii.gz {tdwi}/5tt_vol0.nii.gz 0 1'],
+
+            # FLIRT registration
+            [f'flirt -in {tdwi}/mean_b0.nii.gz -ref {tdwi}/5tt_vol0.nii.gz -interp nearestneighbour -dof 6 -omat {tdwi}/diff2struct_fsl.mat'],
+
+            # Convert transformation matrix to mrtrix format
+            [f'transformconvert {tdwi}/diff2struct_fsl.mat {tdwi}/mean_b0.nii.gz {tdwi}/5tt.nii.gz flirt_import {tdwi}/diff2struct_mrtrix.txt'],
+
+            # Transform the 5tt image
+            [f'mrtransform {tdwi}/5tt.mif -linear {tdwi}/diff2struct_mrtrix.txt -inverse {tdwi}/5tt_coreg.mif'],
+
+            # mask for seeding
+            [f'5tt2gmwmi {tdwi}/5tt_coreg.mif {tdwi}/5tt_coreg_gmwmi.mif'],
+        ]
+
+        s, m = runner.chain(sub, groups)
+        if not s:
+            print(f'{sub} failed: {m}')
+            return False
 
         # QA TODO
         # sp.run(f'mrview {dwi} -overlay.load {tdwi}/5tt_coreg_gmwmi.mif', shell=True)
@@ -0,0 +1,24 @@
+import argparse
+from main import DwiPreprocessingClab
+
+"""
+Wrapper for running several stages for a list of subjects on one machine.
+Jobs from the stages are packed by their declared cores and memory (PROFILES
+in fun/scheduler.py), e.g. topup runs on the cores left over by eddy, so there
+is no need to stagger the batches by hand with run_batch_topup.py -w.
+"""
+
+args = argparse.ArgumentParser()
+args.add_argument('input', type=str, help='Input CSV file')
+args.add_argument('task', type=str, help='Task name')
+args.add_argument('-s', '--stages', type=str, nargs='+', default=['mppca', 'topup', 'eddy'], help='Stages to run, in order')
+args.add_argument('-c', '--cores', type=int, default=None, help='Cores budget, all cores if not set')
+args.add_argument('-m', '--mem', type=float, default=None, help='Memory budget in GB, 90%% of RAM if not set')
+args = args.parse_args()
+
+p = DwiPreprocessingClab(task=args.task, mode='l',\
+    input=args.input, \
+    datain='/mnt/nasips/COST_mri/derivatives/dwi/',\
+    dataout='/mnt/nasips/COST_mri/derivatives/dwi/')
+
+p.run_mixed(args.stages, cores=args.cores, mem=args.mem, skip_processed=True)
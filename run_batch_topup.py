@@ -3,12 +3,15 @@ from main import DwiPreprocessingClab
 
 """
 Wrapper for running topup in multiple batches. Each batch runs on a separate thread
+With -j N the subjects from the list are run N at a time by the built in scheduler,
+so there is no need to split the list and start multiple instances of this script.
 """
 
 args = argparse.ArgumentParser()
 args.add_argument('input', type=str, help='Input CSV file')
 args.add_argument('task', type=str, help='Task name')
 args.add_argument('-w', '--wait', type=int, default=0, help='Wait time')
+args.add_argument('-j', '--jobs', type=int, default=1, help='Number of subjects processed at the same time')
 args = args.parse_args()
 
 p = DwiPreprocessingClab(task=args.task, mode='l',\
@@ -16,4 +19,7 @@ p = DwiPreprocessingClab(task=args.task, mode='l',\
     datain='/mnt/nasips/COST_mri/derivatives/dwi/',\
     dataout='/mnt/nasips/COST_mri/derivatives/dwi/')
 
-p.topup(skip_processed=True, wait=args.wait)
+if args.jobs > 1:
+    p.run_parallel('topup', args.jobs, skip_processed=True)
+else:
+    p.topup(skip_processed=True, wait=args.wait)
@@ -0,0 +1,27 @@
+import argparse
+from main import DwiPreprocessingClab
+
+"""
+Worker that takes subjects from a queue on the shared drive until none are left.
+Start it with the same list and queue dir on as many servers as needed, each
+subject is processed once and subjects of a server that went down are taken
+again after --ttl seconds. Replaces splitting the list with splitSubs2Batches.py.
+"""
+
+args = argparse.ArgumentParser()
+args.add_argument('input', type=str, help='Input CSV file')
+args.add_argument('task', type=str, help='Task name')
+args.add_argument('stage', type=str, help='Stage to run: gibbs, mppca, patch2self, topup, eddy or pipeline')
+args.add_argument('-q', '--queue', type=str, default='/mnt/nasips/COST_mri/derivatives/queue', help='Queue directory on the shared drive')
+args.add_argument('-j', '--jobs', type=int, default=1, help='Number of workers on this server')
+args.add_argument('-t', '--threads', type=int, default=-1, help='Threads for this server, all if not set')
+args.add_argument('--ttl', type=int, default=900, help='Seconds after which the subject of a dead worker is taken again')
+args = args.parse_args()
+
+p = DwiPreprocessingClab(task=args.task, mode='l',\
+    input=args.input, \
+    datain='/mnt/nasips/COST_mri/derivatives/dwi/',\
+    dataout='/mnt/nasips/COST_mri/derivatives/dwi/',\
+    threads=args.threads)
+
+p.run_queue(args.stage, args.queue, jobs=args.jobs, ttl=args.ttl, skip_processed=True)
@@ -0,0 +1,32 @@
+import argparse
+from glob import glob
+from fun.spans import summarise
+
+"""
+Summary of the timing spans written by DwiPreprocessingClab to logs/*_spans.jsonl
+Median and 95th percentile of every stage, subject, step and external command
+across the cohort, the ones that take the most time in total come first.
+"""
+
+args = argparse.ArgumentParser()
+args.add_argument('spans', type=str, nargs='*', default=None, help='Span files, all logs/*_spans.jsonl if not given')
+args.add_argument('-k', '--kind', type=str, nargs='+', default=None, help='Kinds to report: stage, subject, step, cmd, io')
+args.add_argument('-o', '--output', type=str, default=None, help='Save the summary as csv')
+args = args.parse_args()
+
+files = args.spans if args.spans else sorted(glob('logs/*_spans.jsonl'))
+if len(files) == 0:
+    exit('No span files found')
+
+rows = summarise(files, args.kind)
+
+print(f'{len(files)} span files')
+print(f'{"kind":<8} {"path":<40} {"n":>6} {"failed":>6} {"median s":>10} {"p95 s":>10} {"max s":>10} {"total h":>8}')
+for r in rows:
+    print(f'{r["kind"]:<8} {r["path"][-40:]:<40} {r["n"]:>6} {r["failed"]:>6} {r["median"]:>10.1f} {r["p95"]:>10.1f} {r["max"]:>10.1f} {r["total"]/3600:>8.2f}')
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        f.write('kind,path,n,failed,median,p95,max,total\n')
+        for r in rows:
+            f.write(f'{r["kind"]},{r["path"]},{r["n"]},{r["failed"]},{r["median"]},{r["p95"]},{r["max"]},{r["total"]}\n')